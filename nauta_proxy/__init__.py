@@ -1,15 +1,18 @@
 # -*- coding: utf-8 -*-
-from time import sleep
+from time import monotonic, sleep, time
 import argparse
-import imaplib
 import json
 import os
 import socket
 import subprocess
 import threading
 
-from .database import DBManager
-from .proxy import Proxy, SmtpHandler, ImapHandler, IMAP_SERVER
+from . import control
+from .database import DBManager, HeaderRules
+from .maintenance import Maintenance
+from .metrics import METRICS, parse, quantile, scrape, serve_metrics
+from .proxy import (AsyncProxy, Proxy, SmtpHandler, ImapHandler,
+                    TRAFFIC_CLASSES, serve_async)
 
 
 __author__ = 'Asiel Díaz Benítez'
@@ -22,8 +25,7 @@ def termux(cmd):
         return json.loads(resp)
 
 
-def start_proxy(proxy_port, handler, db):
-    proxy = Proxy(proxy_port, handler, db)
+def start_proxy(proxy):
     proxy.log('Proxy Started')
     try:
         proxy.serve_forever()
@@ -31,13 +33,80 @@ def start_proxy(proxy_port, handler, db):
         proxy.server_close()
 
 
-def expunge_inbox(db):
+def stop_proxies(proxies, drain=0, servers=()):
+    """Stop accepting connections and close the sessions in the background.
+
+    Sessions are closed as soon as they are between commands, the ones
+    still busy after ``drain`` seconds are closed anyway. The other
+    ``servers`` of the proxy (metrics, control) are closed right away, so
+    a new proxy can start while the sessions drain.
+    """
+    for proxy in proxies:
+        proxy.stop_accepting()
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+    def close():
+        deadline = monotonic() + drain
+        while sum(proxy.close_sessions(monotonic() < deadline)
+                  for proxy in proxies):
+            sleep(0.1)
+        for proxy in proxies:
+            proxy.stop()
+    # not a daemon, so the process waits for the sessions to end
+    threading.Thread(target=close).start()
+
+
+def stop_when_asked(db, stop):
+    """Stop when ``--stop`` can only set the flag in the db."""
+    while not db.get_stop():
+        sleep(1)
+    stop()
+
+
+def control_commands(db, worker, proxies, servers):
+    """Commands of the control socket, answered by the running proxy."""
+    stopping = threading.Lock()
+
+    def stop(drain=0):
+        if stopping.acquire(False):
+            stop_proxies(proxies, drain, servers)
+
+    def log(save=None, level=None):
+        if save is not None:
+            db.set_savelog(save)
+        if level is not None:
+            db.set_loglevel(level)
+
+    def stats():
+        return get_stats(db, parse(METRICS.render()))
+
+    return {
+        'stop': stop,
+        'mode': lambda mode: db.set_optimize(mode),
+        'log': log,
+        'headers': lambda headers: db.set_ignoredheaders(headers),
+        'stats': stats,
+        'maintenance': lambda **args: worker.submit(**args).wait(),
+    }
+
+
+def send_control(cmd, fallback, **args):
+    """Send a command to the running proxy, call ``fallback`` if it isn't.
+    """
+    try:
+        return control.request(cmd, **args)
+    except OSError:
+        return fallback()
+
+
+def expunge_inbox(db, worker):
     while True:
         if db.get_optimize():
-            try:
-                expunge_dc(db, 'INBOX')
-            except:
-                pass
+            # sessions with INBOX selected see the EXPUNGE responses
+            stale = db.get_serverstats_age() >= ImapHandler.quota_max_age
+            worker.submit('expunge', ['INBOX'], quota=stale)
         sleep(60*30)
 
 
@@ -60,8 +129,11 @@ def convert_bytes(amount):
     return amount
 
 
-def get_stats(db):
-    state = 'En Ejecución' if is_running() else 'Detenido'
+def get_stats(db, samples=None):
+    """Text of the stats, ``samples`` are the metrics of the running proxy.
+    """
+    running = samples is not None or is_running()
+    state = 'En Ejecución' if running else 'Detenido'
     mode = db.get_optimize()
     if mode == 1:
         mode = 'Lite'
@@ -74,47 +146,122 @@ def get_stats(db):
         db.get_imap_msgs(), convert_bytes(db.get_imap()))
     text += 'Enviado: {:,} / {}\n'.format(
         db.get_smtp_msgs(), convert_bytes(db.get_smtp()))
+    wire, plain = db.get_imap_wire(), db.get_imap_plain()
+    if wire < plain:
+        text += 'Compresión IMAP: {} de {} ({:.0%} ahorrado)\n'.format(
+            convert_bytes(wire), convert_bytes(plain), 1 - wire/plain)
+    transcoded, saved = db.get_smtp_saved()
+    if transcoded:
+        text += 'Adjuntos decodificados: {:,} mensajes / {} ahorrado\n'.format(
+            transcoded, convert_bytes(saved))
+    transcoded, saved = db.get_imap_saved()
+    if transcoded:
+        text += 'Descargas en binario: {:,} mensajes / {} ahorrado\n'.format(
+            transcoded, convert_bytes(saved))
+    hits, saved = db.get_index_stats()
+    if hits:
+        text += 'Índice de buzones: {:,} consultas / {} ahorrado\n'.format(
+            hits, convert_bytes(saved))
+    prefetched, hits, wasted = db.get_prefetch_stats()
+    if prefetched:
+        text += 'Lectura anticipada: {:,} de {:,} usados ({:.0%}) / {} ' \
+            'desperdiciado\n'.format(hits, prefetched, hits/prefetched,
+                                     convert_bytes(wasted))
+    if db.get_cache_size():
+        hits, misses, saved = db.get_cache_stats()
+        text += 'Caché: {:,} aciertos / {:,} fallos / {} ahorrado\n'.format(
+            hits, misses, convert_bytes(saved))
+    if samples is None and running and db.get_metrics_port():
+        try:
+            samples = scrape(db.get_metrics_port())
+        except OSError:
+            pass
+    if samples:
+        text += get_metrics_summary(samples)
+    if db.get_spooling():
+        queued, failed, oldest = db.get_spool().stats()
+        text += 'Cola de envío: {:,}'.format(queued)
+        if oldest:
+            text += ' (desde hace {:.0f}s)'.format(time() - oldest)
+        text += ' / {:,} fallidos\n'.format(failed)
     serv_msgs, serv_kb = db.get_serverstats()
     text += 'Servidor: {:,} / {}\n'.format(
         serv_msgs, convert_bytes(serv_kb*1024))
     return text
 
 
+def get_metrics_summary(samples):
+    def value(name, **labels):
+        return sum(v for (n, l), v in samples.items()
+                   if n == name and labels.items() <= dict(l).items())
+
+    text = 'Conexiones: {:.0f} IMAP / {:.0f} SMTP\n'.format(
+        value('nauta_proxy_connections', protocol='IMAP'),
+        value('nauta_proxy_connections', protocol='SMTP'))
+    for protocol, src, dst in (('IMAP', 'server', 'client'),
+                               ('SMTP', 'client', 'server')):
+        before = value('nauta_proxy_bytes_total', protocol=protocol,
+                       side=src, direction='in')
+        saved = before - value('nauta_proxy_bytes_total', protocol=protocol,
+                               side=dst, direction='out')
+        msgs = value('nauta_proxy_messages_total', protocol=protocol)
+        if before and msgs:
+            text += 'Reescritura {}: {} ahorrado ({} por mensaje)\n'.format(
+                protocol, convert_bytes(int(saved)),
+                convert_bytes(int(saved/msgs)))
+    name = 'nauta_proxy_command_seconds'
+    for (n, labels), count in sorted(samples.items()):
+        if n == name + '_count' and count:
+            p50 = quantile(samples, name, labels, 0.5)
+            p95 = quantile(samples, name, labels, 0.95)
+            text += 'Latencia {} {}: p50 ≤{}s / p95 ≤{}s ({:.0f})\n'.format(
+                dict(labels)['protocol'], dict(labels)['command'],
+                '{:g}'.format(p50), '{:g}'.format(p95), count)
+    names = {'interactive': 'interactivo', 'message': 'mensajes',
+             'bulk': 'masivo'}
+    traffic = []
+    for klass in TRAFFIC_CLASSES:
+        size = value('nauta_proxy_traffic_bytes_total', **{'class': klass})
+        if size:
+            traffic.append('{} {} ({:.1f}s en espera)'.format(
+                names[klass], convert_bytes(int(size)),
+                value('nauta_proxy_traffic_wait_seconds_total',
+                      **{'class': klass})))
+    if traffic:
+        text += 'Tráfico: {}\n'.format(' / '.join(traffic))
+    count = value('nauta_proxy_relay_seconds_count')
+    if count:
+        text += 'Tiempo de reenvío: {:.3f}ms promedio\n'.format(
+            value('nauta_proxy_relay_seconds_sum')/count*1000)
+    return text
+
+
+def maintain(db, action, folders=(), quota=True):
+    """Run a maintenance job in the running proxy, or here if it isn't."""
+    if not db.get_credentials():
+        return None
+    def run():
+        worker = Maintenance(db)
+        job = worker.submit(action, folders, quota)
+        worker.run_pending()
+        worker.close()
+        return job.wait()
+    return send_control('maintenance', run, action=action, folders=folders,
+                        quota=quota)
+
+
 def empty_dc(db, folder):
-    c = db.get_credentials()
-    if c:
-        with imaplib.IMAP4(*IMAP_SERVER) as imap:
-            imap.login(*c)
-            resp = imap.select(folder)
-            assert resp[0] == 'OK', resp[1]
-            imap.store('1:*', '+FLAGS.SILENT', r'\Deleted')
-            imap.close()
-            quota = imap.getquotaroot('INBOX')
-        quota = quota[1][1][0].split(b'(')[1][:-1].split()
-        db.set_serverstats((int(quota[-2]), int(quota[1])))
+    maintain(db, 'empty', [folder])
 
 
 def expunge_dc(db, folder):
-    c = db.get_credentials()
-    if c:
-        with imaplib.IMAP4(*IMAP_SERVER) as imap:
-            imap.login(*c)
-            resp = imap.select(folder)
-            assert resp[0] == 'OK', resp[1]
-            imap.close()
-            quota = imap.getquotaroot('INBOX')
-        quota = quota[1][1][0].split(b'(')[1][:-1].split()
-        db.set_serverstats((int(quota[-2]), int(quota[1])))
+    maintain(db, 'expunge', [folder])
 
 
 def update_serverstats(db):
-    c = db.get_credentials()
-    if c:
-        with imaplib.IMAP4(*IMAP_SERVER) as imap:
-            imap.login(*c)
-            quota = imap.getquotaroot('INBOX')
-        quota = quota[1][1][0].split(b'(')[1][:-1].split()
-        db.set_serverstats((int(quota[-2]), int(quota[1])))
+    if db.get_serverstats_age() < ImapHandler.quota_max_age:
+        return  # already learned from the proxied sessions
+    maintain(db, 'quota')
 
 
 def main():
@@ -125,6 +272,16 @@ def main():
                    choices=['1', '0'])
     p.add_argument("--log", help="1 (save logs) or 0 (don't save logs)",
                    choices=['1', '0'])
+    p.add_argument("--loglevel", help="minimum level of the messages shown in the console, trace also shows every relayed chunk (default: info)",
+                   choices=['trace', 'debug', 'info', 'warning'])
+    p.add_argument("--capture", help="1 (save a trace of every session in ~/nauta_proxy_traces, with the credentials hidden) or 0 (don't save traces)",
+                   choices=['1', '0'])
+    p.add_argument("--spool", help="1 (confirm sent messages as soon as they are saved and deliver them to the server in the background, in order) or 0 (relay SMTP sessions to the server)",
+                   choices=['1', '0'])
+    p.add_argument("--replay", help="replay a session trace through the proxy and a local stand-in server",
+                   metavar='TRACE')
+    p.add_argument("--realtime", help="with --replay, keep the original timing of the session instead of replaying it as fast as possible",
+                   action="store_true")
     p.add_argument("--serverstats", help="update server stats",
                    action="store_true")
     p.add_argument("--upgrade", help="check for updates of nauta proxy",
@@ -135,13 +292,40 @@ def main():
                    const="INBOX/DeltaChat", nargs='?')
     p.add_argument("--notheaders", help="set headers to ignore, or print the current ignored headers if no argument is given",
                    const="", nargs='?')
+    p.add_argument("--rule", help="set the action for a header in sent (send) or received (receive) messages: drop, drop+ (only in Lite+ mode), keep, to (rewrite addresses) or default (remove rule)",
+                   nargs=3, metavar=('DIRECTION', 'HEADER', 'ACTION'))
+    p.add_argument("--rules", help="print the header rules", action="store_true")
     p.add_argument("-r", help="reset db", action="store_true")
     p.add_argument("-n", help="show notification", action="store_true")
     p.add_argument("--stats", help="print the stats", action="store_true")
     p.add_argument("--stop", help="stop proxy", action="store_true")
+    p.add_argument("--drain", help="stop proxy after the open sessions finish their current commands, waiting at most the given seconds (default: 60)",
+                   type=int, const=60, nargs='?', metavar='SECONDS')
     p.add_argument("--options", help="show options (needs termux)",
                    action="store_true")
+    p.add_argument("--engine", help="relay engine: legacy (one thread per connection) or asyncio (single event loop)",
+                   choices=['legacy', 'asyncio'], default='legacy')
+    p.add_argument("--cache", help="set the size in MB of the cache of received messages, 0 disables it",
+                   type=int)
+    p.add_argument("--prefetch", help="set how many of the next messages to fetch in the same request when Delta Chat downloads one, 0 disables it",
+                   type=int)
+    p.add_argument("--priority", help="1 (give commands and small messages priority over big downloads and uploads on the link) or 0 (all connections share it equally)",
+                   choices=['1', '0'])
+    p.add_argument("--rate", help="cap the bandwidth of a class of traffic in KB/s, 0 for no cap: interactive (commands and notifications), message (small messages) or bulk (big messages and attachments)",
+                   nargs=2, metavar=('CLASS', 'KB/S'))
+    p.add_argument("--metrics", help="port of the local metrics endpoint in Prometheus format (http://127.0.0.1:PORT/metrics), 0 disables it (default: 8083)",
+                   type=int)
+    p.add_argument("--pool", help="number of connections to keep open in advance to each server (default: 0)",
+                   type=int, default=0)
     args = p.parse_args()
+    if args.rate and (args.rate[0] not in TRAFFIC_CLASSES or
+                      not args.rate[1].isdigit()):
+        p.error('argument --rate: invalid class or rate: {} {}'.format(
+            *args.rate))
+    if args.rule and (args.rule[0] not in HeaderRules.directions or
+                      args.rule[2] not in HeaderRules.actions + ('default',)):
+        p.error('argument --rule: invalid direction or action: {} {}'.format(
+            args.rule[0], args.rule[2]))
     db = DBManager()
     cmd = 'bash ~/.shortcuts/Nauta-Proxy -r'
 
@@ -184,7 +368,8 @@ def main():
             elif res['index'] == 5:
                 update_serverstats(db)
                 termux('termux-dialog confirm -t "{}" -i "{}"'.format(
-                    'Nauta Proxy {}'.format(__version__), get_stats(db)))
+                    'Nauta Proxy {}'.format(__version__),
+                    send_control('stats', lambda: get_stats(db))))
             elif res['index'] == 6:
                 args.upgrade = True
         else:
@@ -194,14 +379,10 @@ def main():
         db.reset()
     elif args.n:
         os.system(cmd)
-    elif args.stop:
-        db.set_stop(True)
-        with socket.create_connection(('127.0.0.1', 8082)):
-            pass
-        with socket.create_connection(('127.0.0.1', 8081)):
-            pass
+    elif args.stop or args.drain is not None:
+        send_control('stop', lambda: db.set_stop(True), drain=args.drain or 0)
     elif args.stats:
-        print(get_stats(db))
+        print(send_control('stats', lambda: get_stats(db)))
     elif args.serverstats:
         update_serverstats(db)
     elif args.empty:
@@ -214,23 +395,77 @@ def main():
             if args.notheaders.startswith('+'):
                 args.notheaders = '{} {}'.format(
                     db.get_ignoredheaders(), args.notheaders[1:])
-                db.set_ignoredheaders(args.notheaders)
+            send_control('headers', lambda: db.set_ignoredheaders(
+                args.notheaders), headers=args.notheaders)
         else:
             print(db.get_ignoredheaders())
+    elif args.rule:
+        db.set_header_rule(*args.rule)
+    elif args.rules:
+        for rule in db.get_header_rules():
+            print(*rule)
     elif args.mode is not None:
-        db.set_optimize(int(args.mode))
+        send_control('mode', lambda: db.set_optimize(int(args.mode)),
+                     mode=int(args.mode))
+    elif args.cache is not None:
+        db.set_cache_size(args.cache)
+    elif args.prefetch is not None:
+        db.set_prefetch(args.prefetch)
+    elif args.priority is not None:
+        db.set_priority(args.priority == '1')
+    elif args.rate:
+        db.set_rate(args.rate[0], int(args.rate[1]))
+    elif args.metrics is not None:
+        db.set_metrics_port(args.metrics)
     elif args.log is not None:
-        db.set_savelog(args.log == '1')
+        send_control('log', lambda: db.set_savelog(args.log == '1'),
+                     save=args.log == '1')
+    elif args.loglevel is not None:
+        send_control('log', lambda: db.set_loglevel(args.loglevel),
+                     level=args.loglevel)
+    elif args.capture is not None:
+        db.set_capture(args.capture == '1')
+    elif args.spool is not None:
+        db.set_spooling(args.spool == '1')
+    elif args.replay:
+        from .replay import replay
+        print(replay(args.replay, args.engine, args.realtime))
     elif args.upgrade:
         subprocess.run(('pip', 'install', '-U', 'nauta-proxy'))
     else:
+        worker = Maintenance(db)
+        # filled once the control socket shows no other proxy is running,
+        # the threaded engine binds its ports when the proxy is created
+        proxies, servers = [], []
+        commands = control_commands(db, worker, proxies, servers)
+        try:
+            server = control.serve_control(commands)
+        except control.ProxyRunning as ex:
+            p.error(str(ex))
+        if server:
+            servers.append(server)
+        engine = AsyncProxy if args.engine == 'asyncio' else Proxy
+        proxies += [engine(8081, SmtpHandler, db, args.pool),
+                    engine(8082, ImapHandler, db, args.pool)]
         db.set_stop(False)
-        threading.Thread(target=start_proxy, args=(
-            8081, SmtpHandler, db)).start()
-        threading.Thread(target=start_proxy, args=(
-            8082, ImapHandler, db)).start()
+        db.counters.start()
+        db.watch()
+        if db.get_metrics_port():
+            servers.append(serve_metrics(db.get_metrics_port()))
+        worker.start()
+        spool = db.get_spool(create=db.get_spooling())
+        # also delivers what was left queued by the last run
+        if spool and (db.get_spooling() or spool.stats()[0]):
+            spool.start(SmtpHandler.real_server)
+        threading.Thread(target=stop_when_asked,
+                         args=(db, commands['stop']), daemon=True).start()
+        if args.engine == 'asyncio':
+            threading.Thread(target=serve_async, args=(proxies,)).start()
+        else:
+            for proxy in proxies:
+                threading.Thread(target=start_proxy, args=(proxy,)).start()
         threading.Thread(
-            target=expunge_inbox, args=(db,), daemon=True).start()
+            target=expunge_inbox, args=(db, worker), daemon=True).start()
 
     if args.options:
         os.system(cmd)
@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+"""Offline benchmarks of the proxy against local fake Nauta servers.
+
+Every run starts the proxy in a child process, pointed to the fake servers
+of :mod:`.servers`, and drives it with a synthetic Delta Chat workload. Run
+with ``python -m nauta_proxy.bench``.
+"""
+import base64
+import json
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from .servers import FakeImapServer, FakeSmtpServer, Link, Mailbox
+
+
+MODES = ('Normal', 'Lite', 'Lite+')
+
+
+class Workload:
+    """Messages sent and fetched by each of ``clients`` sessions, while
+    another one downloads an attachment of ``download`` bytes over and
+    over in the background."""
+
+    def __init__(self, name, description, messages, size=200, attachment=0,
+                 clients=1, download=0):
+        self.name = name
+        self.description = description
+        self.messages = messages
+        self.size = size
+        self.attachment = attachment
+        self.clients = clients
+        self.download = download
+
+
+WORKLOADS = (
+    Workload('chat', 'many small chat messages', 300),
+    Workload('attachments', 'large attachments', 4, attachment=1024**2*3),
+    Workload('concurrent', 'concurrent connections', 40, clients=10),
+    Workload('mixed', 'chat during a large download', 100,
+             download=1024**2*3),
+)
+
+
+def fold(name, value, width=76):
+    lines = [value[i:i+width] for i in range(0, len(value), width)]
+    return name + b': ' + b'\r\n\t'.join(lines) + b'\r\n'
+
+
+def make_message(n, size, attachment=0, received=False):
+    """Return a message like the ones sent by Delta Chat.
+
+    With ``received`` it also has the trace headers added by the server.
+    """
+    key = base64.b64encode(os.urandom(1200))
+    headers = []
+    if received:
+        headers.append(b'Return-Path: <alice@nauta.cu>\r\n')
+        headers.append(
+            b'Received: from smtp.nauta.cu (smtp.nauta.cu [181.225.231.14])'
+            b'\r\n\tby imap.nauta.cu (Postfix) with ESMTPS id 4F3A1%i\r\n'
+            b'\tfor <bob@nauta.cu>; Sat, 17 Oct 2026 10:00:00 -0400\r\n' % (n,))
+        headers.append(b'Received-SPF: pass (nauta.cu: domain of '
+                       b'alice@nauta.cu designates 181.225.231.14)\r\n')
+        headers.append(fold(b'DKIM-Signature', b'v=1; a=rsa-sha256; '
+                            b'd=nauta.cu; s=default; b=' +
+                            base64.b64encode(os.urandom(256))))
+    headers += [
+        b'Subject: Chat: Hello\r\n',
+        b'Chat-Version: 1.0\r\n',
+        fold(b'Autocrypt', b'addr=alice@nauta.cu; keydata=' + key),
+        b'From: "Alice" <alice@nauta.cu>\r\n',
+        b'To: "Bob" <bob@nauta.cu>\r\n',
+        b'Date: Sat, 17 Oct 2026 10:00:00 -0400\r\n',
+        b'Message-ID: <Mr.%i.bench@nauta.cu>\r\n' % (n,),
+        b'In-Reply-To: <Mr.%i.bench@nauta.cu>\r\n' % (n-1,),
+        b'References: <Mr.%i.bench@nauta.cu>\r\n' % (n-1,),
+        b'X-Mailer: Delta Chat Core 1.40.0/Android\r\n',
+        b'MIME-Version: 1.0\r\n',
+    ]
+    text = (b'lorem ipsum dolor sit amet ' * (size//27 + 1))[:size] + b'\r\n'
+    if not attachment:
+        headers.append(b'Content-Type: text/plain; charset=utf-8\r\n')
+        return b''.join(headers) + b'\r\n' + text
+    data = base64.encodebytes(os.urandom(attachment)).replace(b'\n', b'\r\n')
+    headers.append(b'Content-Type: multipart/mixed; boundary="bench"\r\n')
+    return b''.join(headers) + (
+        b'\r\n--bench\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n' +
+        text + b'--bench\r\nContent-Type: application/octet-stream\r\n'
+        b'Content-Transfer-Encoding: base64\r\n'
+        b'Content-Disposition: attachment; filename="file.bin"\r\n\r\n' +
+        data + b'--bench--\r\n')
+
+
+class Client:
+    def __init__(self, address):
+        self.sock = socket.create_connection(address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile('rb')
+        self.sent = self.received = 0
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def send(self, data):
+        self.sent += len(data)
+        self.sock.sendall(data)
+
+    def readline(self):
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError('connection closed by proxy')
+        self.received += len(line)
+        return line
+
+    def read(self, size):
+        data = self.file.read(size)
+        self.received += len(data)
+        return data
+
+
+class ImapClient(Client):
+    literal = re.compile(rb'\{([0-9]+)\}\r\n$')
+
+    def __init__(self, address):
+        super().__init__(address)
+        self.tag = 0
+        self.readline()
+
+    def command(self, cmd):
+        self.tag += 1
+        tag = b'b%i ' % (self.tag,)
+        self.send(tag + cmd + b'\r\n')
+        while True:
+            line = self.readline()
+            m = self.literal.search(line)
+            if m:
+                self.read(int(m[1]))
+            elif line.startswith(tag):
+                if not line.startswith(b'OK', len(tag)):
+                    raise RuntimeError(line)
+                return line
+
+
+class SmtpClient(Client):
+    def __init__(self, address):
+        super().__init__(address)
+        self.reply(b'220')
+
+    def reply(self, code):
+        line = self.readline()
+        while line[3:4] == b'-':
+            line = self.readline()
+        if not line.startswith(code):
+            raise RuntimeError(line)
+        return line
+
+    def command(self, cmd, code=b'250'):
+        self.send(cmd + b'\r\n')
+        return self.reply(code)
+
+
+def session(imap, smtp, workload, latencies):
+    """A Delta Chat session: send the messages, then fetch the inbox."""
+    client = SmtpClient(smtp)
+    try:
+        client.command(b'EHLO [127.0.0.1]')
+        for n in range(workload.messages):
+            message = make_message(n, workload.size, workload.attachment)
+            start = time.perf_counter()
+            client.command(b'MAIL FROM:<alice@nauta.cu>')
+            client.command(b'RCPT TO:<bob@nauta.cu>')
+            client.command(b'DATA', b'354')
+            client.send(message + b'.\r\n')
+            client.reply(b'250')
+            latencies['send'].append(time.perf_counter() - start)
+        client.command(b'QUIT', b'2')
+    finally:
+        client.close()
+        latencies['bytes'].append(client.sent + client.received)
+
+    client = ImapClient(imap)
+    try:
+        client.command(b'LOGIN "bob@nauta.cu" "secret"')
+        client.command(b'SELECT "INBOX"')
+        client.command(b'UID FETCH 1:* (UID RFC822.SIZE)')
+        for uid in range(1, workload.messages+1):
+            start = time.perf_counter()
+            client.command(b'UID FETCH %i (FLAGS BODY.PEEK[])' % (uid,))
+            latencies['fetch'].append(time.perf_counter() - start)
+        # the flags are synced again every time the inbox is selected
+        for _ in range(2):
+            client.command(b'SELECT "INBOX"')
+            client.command(b'UID FETCH 1:* (FLAGS)')
+        client.command(b'LOGOUT')
+    finally:
+        client.close()
+        latencies['bytes'].append(client.sent + client.received)
+
+
+def download(imap, uid, stop, latencies):
+    """Fetch message ``uid`` until ``stop`` is set."""
+    client = ImapClient(imap)
+    try:
+        client.command(b'LOGIN "bob@nauta.cu" "secret"')
+        client.command(b'SELECT "INBOX"')
+        while not stop.is_set():
+            client.command(b'UID FETCH %i (FLAGS BODY.PEEK[])' % (uid,))
+        client.command(b'LOGOUT')
+    finally:
+        client.close()
+        latencies['bytes'].append(client.sent + client.received)
+
+
+def percentile(values, q):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[int(round((len(values)-1)*q))]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_proxy(config, home):
+    """Start the proxy in a child process and wait until it is listening."""
+    env = dict(os.environ, HOME=home)
+    # make the child import this same copy of the package
+    path = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, (path, os.environ.get('PYTHONPATH'))))
+    log = os.path.join(home, 'proxy.log')
+    with open(log, 'wb') as fd:
+        child = subprocess.Popen(
+            (sys.executable, '-m', 'nauta_proxy.bench', '--serve',
+             json.dumps(config)), env=env, stdout=fd, stderr=fd)
+    deadline = time.monotonic() + 30
+    while True:
+        with open(log, 'rb') as fd:
+            if fd.read().count(b'Proxy Started') == 2:
+                return child
+        if child.poll() is not None or time.monotonic() > deadline:
+            child.kill()
+            with open(log, 'rb') as fd:
+                raise RuntimeError('proxy failed to start:\n' +
+                                   fd.read().decode(errors='replace'))
+        time.sleep(0.05)
+
+
+def stop_proxy(child):
+    """Stop the proxy, return its ``(cpu seconds, peak RSS in bytes)``."""
+    child.send_signal(signal.SIGTERM)
+    if not hasattr(os, 'wait4'):
+        child.wait()
+        return None, None
+    usage = os.wait4(child.pid, 0)[2]
+    child.returncode = -signal.SIGTERM
+    # ru_maxrss is in kilobytes on Linux and Android
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss*1024
+
+
+def serve(config):
+    """Entry point of the proxy child process."""
+    from .. import proxy
+    from ..database import DBManager
+
+    db = DBManager()
+    db.set_optimize(config['mode'])
+    db.set_prefetch(config['prefetch'])
+    db.set_priority(config['priority'])
+    for klass, rate in config['rates']:
+        db.set_rate(klass, rate)
+    handlers = []
+    for port, upstream, handler in (
+            (config['smtp_port'], config['smtp'], proxy.SmtpHandler),
+            (config['imap_port'], config['imap'], proxy.ImapHandler)):
+        handlers.append((port, type(handler.__name__, (handler,), {
+            'real_server': tuple(upstream)})))
+    db.counters.start()
+    if config['engine'] == 'asyncio':
+        proxy.serve_async([proxy.AsyncProxy(port, handler, db, config['pool'])
+                           for port, handler in handlers])
+        return
+    servers = [proxy.Proxy(port, handler, db, config['pool'])
+               for port, handler in handlers]
+    for server in servers:
+        server.log('Proxy Started')
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    threading.Event().wait()
+
+
+def run(workload, engine, mode, imap, smtp, pool=0, prefetch=0,
+        priority=False, rates=()):
+    """Run ``workload`` through a fresh proxy and return its metrics."""
+    imap.mailboxes['INBOX'] = mailbox = Mailbox()
+    for n in range(workload.messages):
+        mailbox.append(make_message(
+            n, workload.size, workload.attachment, received=True))
+    if workload.download:
+        mailbox.append(make_message(
+            workload.messages, workload.size, workload.download,
+            received=True))
+    config = {
+        'engine': engine, 'mode': mode, 'pool': pool, 'prefetch': prefetch,
+        'priority': priority, 'rates': list(rates),
+        'imap_port': free_port(), 'smtp_port': free_port(),
+        'imap': imap.server_address, 'smtp': smtp.server_address}
+    with tempfile.TemporaryDirectory() as home:
+        child = start_proxy(config, home)
+        try:
+            time.sleep(0.2)
+            imap.reset()
+            smtp.reset()
+            latencies = {'send': [], 'fetch': [], 'bytes': []}
+            errors = []
+
+            def client():
+                try:
+                    session(('127.0.0.1', config['imap_port']),
+                            ('127.0.0.1', config['smtp_port']),
+                            workload, latencies)
+                except Exception as ex:
+                    errors.append(ex)
+
+            stop = threading.Event()
+            background = threading.Thread(target=download, args=(
+                ('127.0.0.1', config['imap_port']), workload.messages + 1,
+                stop, latencies))
+            if workload.download:
+                background.start()
+                time.sleep(0.5)  # until the download fills the link
+            start = time.perf_counter()
+            clients = [threading.Thread(target=client)
+                       for _ in range(workload.clients)]
+            for thread in clients:
+                thread.start()
+            for thread in clients:
+                thread.join()
+            seconds = time.perf_counter() - start
+            stop.set()
+            if workload.download:
+                background.join()
+        finally:
+            cpu, rss = stop_proxy(child)
+    if errors:
+        raise errors[0]
+    messages = len(latencies['send']) + len(latencies['fetch'])
+    client_bytes = sum(latencies['bytes'])
+    return {
+        'workload': workload.name,
+        'engine': engine,
+        'mode': mode,
+        'messages': messages,
+        'seconds': seconds,
+        'msgs_per_sec': messages/seconds,
+        'client_bytes': client_bytes,
+        'bytes_per_sec': client_bytes/seconds,
+        'upstream_bytes': imap.sent + imap.received + smtp.sent +
+        smtp.received,
+        'send_p50': percentile(latencies['send'], 0.5),
+        'send_p95': percentile(latencies['send'], 0.95),
+        'fetch_p50': percentile(latencies['fetch'], 0.5),
+        'fetch_p95': percentile(latencies['fetch'], 0.95),
+        'cpu': cpu,
+        'rss': rss,
+    }
+
+
+def add_savings(results):
+    """Set the upstream bytes saved by each result against Normal mode."""
+    normal = {(r['workload'], r['engine']): r['upstream_bytes']
+              for r in results if r['mode'] == 0}
+    for r in results:
+        base = normal.get((r['workload'], r['engine']))
+        r['saved'] = base - r['upstream_bytes'] if base else None
+
+
+def report(results, previous=None):
+    """Return the results as a table, with the change from ``previous``."""
+    previous = {(r['workload'], r['engine'], r['mode']): r
+                for r in previous or ()}
+    header = ('{:<12} {:<8} {:<6} {:>8} {:>8} {:>15} {:>15} {:>7} {:>7} '
+              '{:>10} {:>12}').format(
+        'workload', 'engine', 'mode', 'msgs/s', 'MB/s', 'send p50/p95',
+        'fetch p50/p95', 'CPU s', 'RSS MB', 'upstream', 'saved')
+    lines = [header, '-'*len(header)]
+    for r in results:
+        old = previous.get((r['workload'], r['engine'], r['mode']))
+        line = ('{:<12} {:<8} {:<6} {:>8.1f} {:>8.2f} {:>7.1f}/{:<7.1f} '
+                '{:>7.1f}/{:<7.1f} {:>7} {:>7} {:>10} {:>12}').format(
+            r['workload'], r['engine'], MODES[r['mode']],
+            r['msgs_per_sec'], r['bytes_per_sec']/1024**2,
+            r['send_p50']*1000, r['send_p95']*1000,
+            r['fetch_p50']*1000, r['fetch_p95']*1000,
+            '-' if r['cpu'] is None else '{:.2f}'.format(r['cpu']),
+            '-' if r['rss'] is None else '{:.1f}'.format(r['rss']/1024**2),
+            '{:,}'.format(r['upstream_bytes']),
+            '-' if r['saved'] is None else '{:,}'.format(r['saved']))
+        lines.append(line)
+        if old:
+            lines.append('{:<28} {:>8} {:>8} {:>15} {:>15} {:>7} {:>7} '
+                         '{:>10}'.format('  vs previous', *(
+                             change(old[key], r[key]) for key in (
+                                 'msgs_per_sec', 'bytes_per_sec', 'send_p50',
+                                 'fetch_p50', 'cpu', 'rss',
+                                 'upstream_bytes'))))
+    return '\n'.join(lines)
+
+
+def change(old, new):
+    if not old or new is None:
+        return '-'
+    return '{:+.0%}'.format(new/old - 1)
+
+
+def main(argv=None):
+    import argparse
+
+    p = argparse.ArgumentParser(
+        prog='python -m nauta_proxy.bench',
+        description='Benchmark the proxy against local fake Nauta servers')
+    p.add_argument('-w', '--workload', action='append',
+                   choices=[w.name for w in WORKLOADS],
+                   help='workload to run, can be repeated (default: all)')
+    p.add_argument('--engine', action='append',
+                   choices=['legacy', 'asyncio'],
+                   help='relay engine to benchmark, can be repeated '
+                   '(default: both)')
+    p.add_argument('--mode', action='append', type=int, choices=[1, 2],
+                   help='optimization mode besides Normal (0), which is '
+                   'always run to compute the savings (default: 1 and 2)')
+    p.add_argument('--scale', type=float, default=1,
+                   help='multiply the number of messages of each workload')
+    p.add_argument('--pool', type=int, default=0,
+                   help='upstream connections to keep open in advance')
+    p.add_argument('--prefetch', type=int, default=0,
+                   help='messages to fetch ahead in Lite modes')
+    p.add_argument('--throttle', type=int, default=0, metavar='KB/S',
+                   help='make the fake servers share a link of this speed')
+    p.add_argument('--priority', action='store_true',
+                   help='give chat traffic priority over bulk transfers')
+    p.add_argument('--rate', action='append', nargs=2, default=[],
+                   metavar=('CLASS', 'KB/S'),
+                   help='cap the bandwidth of a class of traffic, can be '
+                   'repeated')
+    p.add_argument('--compress', action='store_true',
+                   help='offer COMPRESS=DEFLATE from the fake IMAP server')
+    p.add_argument('--chunking', action='store_true',
+                   help='offer CHUNKING (BDAT) from the fake SMTP server')
+    p.add_argument('--binary', action='store_true',
+                   help='offer BINARY from the fake IMAP server')
+    p.add_argument('--condstore', action='store_true',
+                   help='offer CONDSTORE from the fake IMAP server')
+    p.add_argument('--save', metavar='FILE',
+                   help='save the results as JSON to compare them later')
+    p.add_argument('--compare', metavar='FILE',
+                   help='show the change from results saved with --save')
+    p.add_argument('--serve', help=argparse.SUPPRESS)
+    args = p.parse_args(argv)
+
+    if args.serve:
+        serve(json.loads(args.serve))
+        return
+
+    workloads = [
+        Workload(w.name, w.description, max(int(w.messages*args.scale), 1),
+                 w.size, w.attachment, w.clients, w.download)
+        for w in WORKLOADS if not args.workload or w.name in args.workload]
+    modes = [0] + sorted(set(args.mode or (1, 2)))
+    link = Link(args.throttle*1024) if args.throttle else None
+    imap = FakeImapServer(compress=args.compress, binary=args.binary,
+                          condstore=args.condstore, link=link)
+    smtp = FakeSmtpServer(chunking=args.chunking, link=link)
+    imap.start()
+    smtp.start()
+    results = []
+    try:
+        for workload in workloads:
+            for engine in args.engine or ('legacy', 'asyncio'):
+                for mode in modes:
+                    print('{} ({}): {} {}...'.format(
+                        workload.name, workload.description, engine,
+                        MODES[mode]), file=sys.stderr)
+                    results.append(run(
+                        workload, engine, mode, imap, smtp, args.pool,
+                        args.prefetch, args.priority,
+                        [(klass, int(rate)) for klass, rate in args.rate]))
+    finally:
+        imap.stop()
+        smtp.stop()
+    add_savings(results)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as fd:
+            previous = json.load(fd)
+    print(report(results, previous))
+    if args.save:
+        with open(args.save, 'w') as fd:
+            json.dump(results, fd, indent=2)
@@ -0,0 +1,529 @@
+# -*- coding: utf-8 -*-
+"""Scripted stand-ins for the Nauta IMAP (Dovecot) and SMTP (Postfix) servers.
+
+They speak just enough of each protocol to serve Delta Chat sessions
+relayed by the proxy, and count the bytes exchanged on the wire.
+"""
+import base64
+import re
+import socket
+import socketserver
+import threading
+import time
+import zlib
+
+
+IMAP_CAPABILITY = (b'IMAP4rev1 SASL-IR LOGIN-REFERRALS ID ENABLE IDLE '
+                   b'LITERAL+ STARTTLS AUTH=PLAIN AUTH=LOGIN')
+SMTP_EHLO = (b'PIPELINING', b'SIZE 10240000', b'VRFY', b'ETRN', b'STARTTLS',
+             b'ENHANCEDSTATUSCODES', b'8BITMIME', b'DSN')
+
+
+class Link:
+    """A narrow link of ``rate`` bytes/s shared by the fake servers.
+
+    Data goes through in order, each chunk waiting for those before it, and
+    sessions only send the next chunk once the last one went through, like
+    TCP over a mobile network with its window full.
+    """
+    chunk = 1024*16
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.free = 0
+
+    def transmit(self, size):
+        """Wait until ``size`` bytes went through the link."""
+        with self.lock:
+            now = time.monotonic()
+            self.free = max(self.free, now) + size/self.rate
+            end = self.free
+        time.sleep(end - now)
+
+
+class FakeServer(socketserver.ThreadingTCPServer):
+    """Serve ``handler`` sessions on localhost from a background thread.
+
+    With a Link, the sessions send and receive through it.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, handler, port=0, link=None):
+        self.lock = threading.Lock()
+        self.sent = self.received = 0
+        self.link = link
+        super().__init__(('127.0.0.1', port), handler)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.server_address
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count(self, sent=0, received=0):
+        with self.lock:
+            self.sent += sent
+            self.received += received
+
+    def reset(self):
+        with self.lock:
+            self.sent = self.received = 0
+
+
+class FakeSession(socketserver.BaseRequestHandler):
+    """Line oriented session with optional DEFLATE (RFC 4978) framing."""
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.link = self.server.link
+        if self.link:
+            # don't let the kernel take more than the link carries
+            self.request.setsockopt(
+                socket.SOL_SOCKET, socket.SO_SNDBUF, self.link.chunk)
+        self.buf = bytearray()
+        self.inflate = self.deflate = None
+
+    def recv(self):
+        size = self.link.chunk if self.link else 1024*64
+        data = self.request.recv(size)
+        if self.link and data:
+            self.link.transmit(len(data))
+        self.server.count(received=len(data))
+        if self.inflate and data:
+            data = self.inflate.decompress(data)
+        self.buf += data
+        return data
+
+    def readline(self):
+        start = 0
+        while True:
+            i = self.buf.find(b'\n', start)
+            if i != -1:
+                line = bytes(self.buf[:i+1])
+                del self.buf[:i+1]
+                return line
+            start = len(self.buf)
+            if not self.recv():
+                return b''
+
+    def read(self, size):
+        while len(self.buf) < size:
+            if not self.recv():
+                break
+        data = bytes(self.buf[:size])
+        del self.buf[:size]
+        return data
+
+    def send(self, data):
+        if self.deflate:
+            data = self.deflate.compress(data) + \
+                self.deflate.flush(zlib.Z_SYNC_FLUSH)
+        self.server.count(sent=len(data))
+        if not self.link:
+            self.request.sendall(data)
+            return
+        for i in range(0, len(data), self.link.chunk):
+            chunk = data[i:i+self.link.chunk]
+            self.link.transmit(len(chunk))
+            self.request.sendall(chunk)
+
+
+class Mailbox:
+    """Messages of a folder as ``[uid, flags, message, modseq]`` lists."""
+
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.messages = []
+        self.next_uid = 1
+        self.modseq = 1
+
+    def append(self, message, flags=b''):
+        self.modseq += 1
+        self.messages.append([self.next_uid, flags, message, self.modseq])
+        self.next_uid += 1
+
+
+def sequence_set(spec, maximum):
+    """Expand an IMAP sequence set like ``1,4:*`` into a set of numbers."""
+    numbers = set()
+    for part in spec.split(b','):
+        first, _, last = part.partition(b':')
+        first = maximum if first == b'*' else int(first)
+        last = first if not last else maximum if last == b'*' else int(last)
+        if first > last:
+            first, last = last, first
+        numbers.update(range(first, last+1))
+    return numbers
+
+
+def header_fields(header):
+    """Split a message header into its (folded) fields."""
+    return re.findall(rb'[^ \t\r\n][^\n]*\n(?:[ \t][^\n]*\n)*', header)
+
+
+def mime_tree(message):
+    """Split a message or body part into ``(header, body, parts)``.
+
+    ``parts`` has the mime_tree() of every part of a multipart body.
+    """
+    if message.startswith(b'\r\n'):
+        header, body = b'\r\n', message[2:]
+    else:
+        i = message.find(b'\r\n\r\n')
+        i = len(message) if i == -1 else i + 4
+        header, body = message[:i], message[i:]
+    m = re.search(rb'(?i)boundary="?([^";\r\n]+)', header)
+    parts = []
+    if m and re.search(rb'(?i)content-type:\s*multipart/', header):
+        chunks = (b'\r\n' + body).split(b'\r\n--' + m[1])
+        parts = [mime_tree(chunk.split(b'\r\n', 1)[1])
+                 for chunk in chunks[1:-1]]
+    return header, body, parts
+
+
+def body_structure(tree):
+    """Return the BODYSTRUCTURE of a mime_tree()."""
+    header, body, parts = tree
+    m = re.search(rb'(?i)content-type:\s*([^/\s]+)/([^;\s]+)', header)
+    kind, subtype = (m[1].upper(), m[2].upper()) if m else (b'TEXT',
+                                                           b'PLAIN')
+    if parts:
+        boundary = re.search(rb'(?i)boundary="?([^";\r\n]+)', header)[1]
+        return b'(%s "%s" ("BOUNDARY" "%s") NIL NIL NIL)' % (
+            b''.join(map(body_structure, parts)), subtype, boundary)
+    m = re.search(rb'(?i)content-transfer-encoding:\s*(\S+)', header)
+    encoding = m[1].upper() if m else b'7BIT'
+    lines = b' %i' % (body.count(b'\n'),) if kind == b'TEXT' else b''
+    return b'("%s" "%s" NIL NIL NIL "%s" %i%s NIL NIL NIL NIL)' % (
+        kind, subtype, encoding, len(body), lines)
+
+
+def mime_part(message, section):
+    """Return the mime_tree() of a numbered section, like ``2.1``."""
+    tree = mime_tree(message)
+    for number in section.split(b'.'):
+        if tree[2]:
+            tree = tree[2][int(number)-1]
+        elif number != b'1':
+            raise IndexError(section)
+    return tree
+
+
+def body_section(message, section):
+    """Return the given BODY[section] of ``message``."""
+    i = message.find(b'\r\n\r\n')
+    i = len(message) if i == -1 else i + 4
+    header, text = message[:i], message[i:]
+    if not section:
+        return message
+    if section[:1].isdigit():
+        return mime_part(message, section)[1]
+    if section == b'TEXT':
+        return text
+    if section == b'HEADER':
+        return header
+    m = re.match(rb'HEADER\.FIELDS(\.NOT)? \((.*)\)$', section)
+    names = set(m[2].lower().split())
+    fields = [field for field in header_fields(header)
+              if (field.split(b':', 1)[0].lower() in names) != bool(m[1])]
+    return b''.join(fields) + b'\r\n'
+
+
+class FakeImapSession(FakeSession):
+    """Dovecot, as configured on imap.nauta.cu."""
+    command = re.compile(rb'([^ ]+) ([a-zA-Z]+) ?(.*)\r\n$')
+    fetch_item = re.compile(rb'(BODY|BINARY)(?:\.PEEK)?\[([^\]]*)\]'
+                            rb'(?:<([0-9]+)\.([0-9]+)>)?|[A-Z0-9.]+')
+    changedsince = re.compile(rb' \(CHANGEDSINCE ([0-9]+)\)$', re.I)
+
+    def handle(self):
+        self.mailbox = None
+        self.condstore = False
+        self.send(b'* OK [CAPABILITY ' + IMAP_CAPABILITY +
+                  b'] Dovecot ready.\r\n')
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            m = self.command.match(line)
+            if not m:
+                self.send(b'* BAD Error in IMAP command received by '
+                          b'server.\r\n')
+                continue
+            tag, cmd, args = m[1], m[2].upper().decode(), m[3]
+            method = getattr(self, 'do_' + cmd, None)
+            if method is None:
+                self.send(tag + b' BAD Error in IMAP command ' +
+                          m[2] + b': Unknown command.\r\n')
+            elif method(tag, args) is False:
+                return
+
+    def do_CAPABILITY(self, tag, args):
+        self.send(b'* CAPABILITY ' + self.capability() + b'\r\n' +
+                  tag + b' OK Pre-login capabilities listed, post-login '
+                  b'capabilities have more.\r\n')
+
+    def do_NOOP(self, tag, args):
+        self.send(tag + b' OK NOOP completed.\r\n')
+
+    def do_LOGIN(self, tag, args):
+        self.send(tag + b' OK [CAPABILITY ' + self.capability(True) +
+                  b'] Logged in\r\n')
+
+    def do_COMPRESS(self, tag, args):
+        self.send(tag + b' OK Begin compression.\r\n')
+        self.inflate = zlib.decompressobj(-15)
+        self.deflate = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self.buf[:] = self.inflate.decompress(bytes(self.buf))
+
+    def do_SELECT(self, tag, args):
+        name = args.split(b' (', 1)[0].strip(b'"')
+        self.condstore = self.server.condstore and \
+            b'CONDSTORE' in args.upper()
+        self.mailbox = self.server.mailboxes.get(name.decode())
+        if self.mailbox is None:
+            self.send(tag + b' NO Mailbox doesn\'t exist: ' + name + b'\r\n')
+            return
+        self.send(
+            b'* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)\r\n'
+            b'* OK [PERMANENTFLAGS (\\Answered \\Flagged \\Deleted \\Seen '
+            b'\\Draft \\*)] Flags permitted.\r\n'
+            b'* %i EXISTS\r\n* 0 RECENT\r\n'
+            b'* OK [UIDVALIDITY %i] UIDs valid\r\n'
+            b'* OK [UIDNEXT %i] Predicted next UID\r\n' % (
+                len(self.mailbox.messages), self.mailbox.uidvalidity,
+                self.mailbox.next_uid) +
+            (b'* OK [HIGHESTMODSEQ %i] Highest\r\n' % (self.mailbox.modseq,)
+             if self.condstore else b'') +
+            tag + b' OK [READ-WRITE] Select completed.\r\n')
+
+    do_EXAMINE = do_SELECT
+
+    def do_FETCH(self, tag, args, uid=False):
+        spec, items = args.split(b' ', 1)
+        changedsince = self.changedsince.search(items)
+        if changedsince:
+            items = items[:changedsince.start()]
+            changedsince = int(changedsince[1])
+        items = [(m[0] if m[2] is None else m[1] + b'[' + m[2] + b']',
+                  m[2], m[3] and (int(m[3]), int(m[4])))
+                 for m in self.fetch_item.finditer(items.strip(b'()'))]
+        if changedsince is not None and (b'MODSEQ', None, None) not in items:
+            items.append((b'MODSEQ', None, None))
+        messages = self.mailbox.messages if self.mailbox else []
+        maximum = messages[-1][0] if uid and messages else len(messages)
+        wanted = sequence_set(spec, maximum)
+        for seq, (msg_uid, flags, message, modseq) in enumerate(messages, 1):
+            if (msg_uid if uid else seq) not in wanted:
+                continue
+            if changedsince is not None and modseq <= changedsince:
+                continue
+            resp = []
+            if uid or (b'UID', None, None) in items:
+                resp.append(b'UID %i' % (msg_uid,))
+            for name, section, partial in items:
+                if name == b'FLAGS':
+                    resp.append(b'FLAGS (' + flags + b')')
+                elif name == b'MODSEQ':
+                    resp.append(b'MODSEQ (%i)' % (modseq,))
+                elif name == b'RFC822.SIZE':
+                    resp.append(b'RFC822.SIZE %i' % (len(message),))
+                elif name == b'BODYSTRUCTURE':
+                    resp.append(b'BODYSTRUCTURE ' +
+                                body_structure(mime_tree(message)))
+                elif section is not None:
+                    data = body_section(message, section)
+                    literal = b'{%i}'
+                    if name.startswith(b'BINARY'):
+                        data = base64.b64decode(data)
+                        literal = b'~{%i}' if b'\0' in data else literal
+                    if partial:
+                        data = data[partial[0]:partial[0]+partial[1]]
+                        name += b'<%i>' % (partial[0],)
+                    resp.append(name + b' ' + literal % (len(data),) +
+                                b'\r\n' + data)
+            self.send(b'* %i FETCH (%s)\r\n' % (seq, b' '.join(resp)))
+        self.send(tag + b' OK Fetch completed.\r\n')
+
+    def do_SEARCH(self, tag, args, uid=False):
+        messages = self.mailbox.messages if self.mailbox else []
+        found = [m[0] if uid else seq for seq, m in enumerate(messages, 1)]
+        self.send(b'* SEARCH' + b''.join(b' %i' % (n,) for n in found) +
+                  b'\r\n' + tag + b' OK Search completed.\r\n')
+
+    def do_UID(self, tag, args):
+        cmd, args = args.split(b' ', 1)
+        method = getattr(self, 'do_' + cmd.upper().decode(), None)
+        if method is None:
+            self.send(tag + b' BAD Error in IMAP command UID: Unknown '
+                      b'command.\r\n')
+        else:
+            method(tag, args, uid=True)
+
+    def do_STORE(self, tag, args, uid=False):
+        spec, op, flags = args.split(b' ', 2)
+        messages = self.mailbox.messages if self.mailbox else []
+        maximum = messages[-1][0] if uid and messages else len(messages)
+        wanted = sequence_set(spec, maximum)
+        flags = flags.strip(b'()').split()
+        for seq, msg in enumerate(messages, 1):
+            if (msg[0] if uid else seq) in wanted:
+                current = msg[1].split()
+                if op.upper().startswith(b'-'):
+                    current = [f for f in current if f not in flags]
+                else:
+                    current += [f for f in flags if f not in current]
+                msg[1] = b' '.join(current)
+                self.mailbox.modseq += 1
+                msg[3] = self.mailbox.modseq
+                if not op.upper().endswith(b'.SILENT'):
+                    resp = [b'FLAGS (' + msg[1] + b')']
+                    if uid:
+                        resp.insert(0, b'UID %i' % (msg[0],))
+                    if self.condstore:
+                        resp.append(b'MODSEQ (%i)' % (msg[3],))
+                    self.send(b'* %i FETCH (%s)\r\n' % (
+                        seq, b' '.join(resp)))
+        self.send(tag + b' OK Store completed.\r\n')
+
+    def do_CLOSE(self, tag, args):
+        if self.mailbox:
+            self.mailbox.messages = [m for m in self.mailbox.messages
+                                     if b'\\Deleted' not in m[1].split()]
+            self.mailbox.modseq += 1
+        self.mailbox = None
+        self.send(tag + b' OK Close completed.\r\n')
+
+    def do_GETQUOTAROOT(self, tag, args):
+        messages = [m[2] for box in self.server.mailboxes.values()
+                    for m in box.messages]
+        self.send(b'* QUOTAROOT ' + args + b' "User quota"\r\n'
+                  b'* QUOTA "User quota" (STORAGE %i 102400 MESSAGE %i '
+                  b'100000)\r\n' % (sum(map(len, messages))//1024,
+                                    len(messages)) +
+                  tag + b' OK Getquotaroot completed.\r\n')
+
+    def do_IDLE(self, tag, args):
+        self.send(b'+ idling\r\n')
+        if self.readline().upper() != b'DONE\r\n':
+            self.send(tag + b' BAD Expected DONE.\r\n')
+        else:
+            self.send(tag + b' OK Idle completed.\r\n')
+
+    def do_LOGOUT(self, tag, args):
+        self.send(b'* BYE Logging out\r\n' + tag +
+                  b' OK Logout completed.\r\n')
+        return False
+
+    def capability(self, logged=False):
+        caps = IMAP_CAPABILITY
+        if logged:
+            caps += b' QUOTA'
+            if self.server.compress:
+                caps += b' COMPRESS=DEFLATE'
+            if self.server.binary:
+                caps += b' BINARY'
+            if self.server.condstore:
+                caps += b' CONDSTORE'
+        return caps
+
+
+class FakeSmtpSession(FakeSession):
+    """Postfix, as configured on smtp.nauta.cu."""
+
+    def handle(self):
+        self.send(b'220 smtp.nauta.cu ESMTP Postfix\r\n')
+        queued = 0
+        chunks = []
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            cmd = line[:4].upper()
+            if cmd in (b'EHLO', b'HELO'):
+                ehlo = SMTP_EHLO
+                if self.server.chunking:
+                    ehlo = ehlo[:-1] + (b'CHUNKING',) + ehlo[-1:]
+                self.send(b''.join(b'250-' + ext + b'\r\n' for ext in
+                                   (b'smtp.nauta.cu',) + ehlo[:-1]) +
+                          b'250 ' + ehlo[-1] + b'\r\n')
+            elif cmd == b'MAIL':
+                self.send(b'250 2.1.0 Ok\r\n')
+            elif cmd == b'RCPT':
+                self.send(b'250 2.1.5 Ok\r\n')
+            elif cmd == b'DATA':
+                self.send(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+                self.server.add_message(self.read_message())
+                queued += 1
+                self.send(b'250 2.0.0 Ok: queued as %X\r\n' % (
+                    0x4F3A1000 + queued,))
+            elif cmd == b'BDAT' and self.server.chunking:
+                args = line.split()
+                chunks.append(self.read(int(args[1])))
+                if len(args) < 3:
+                    self.send(b'250 2.0.0 Ok: %s octets received\r\n' % (
+                        args[1],))
+                    continue
+                self.server.add_message(b''.join(chunks))
+                chunks.clear()
+                queued += 1
+                self.send(b'250 2.0.0 Ok: queued as %X\r\n' % (
+                    0x4F3A1000 + queued,))
+            elif cmd == b'RSET' or cmd == b'NOOP':
+                self.send(b'250 2.0.0 Ok\r\n')
+            elif cmd == b'QUIT':
+                self.send(b'221 2.0.0 Bye\r\n')
+                return
+            else:
+                self.send(b'502 5.5.2 Error: command not recognized\r\n')
+
+    def read_message(self):
+        """Read the message of a DATA command, up to the final dot."""
+        self.buf[:0] = b'\r\n'
+        start = 0
+        while True:
+            i = self.buf.find(b'\r\n.\r\n', start)
+            if i != -1:
+                message = bytes(self.buf[2:i+2])
+                del self.buf[:i+5]
+                return message
+            start = max(len(self.buf) - 4, 0)
+            if not self.recv():
+                return b''
+
+
+class FakeImapServer(FakeServer):
+    """Fake IMAP server, ``mailboxes`` maps folder names to Mailbox."""
+
+    def __init__(self, port=0, compress=False, binary=False,
+                 condstore=False, link=None):
+        self.compress = compress
+        self.binary = binary
+        self.condstore = condstore
+        self.mailboxes = {'INBOX': Mailbox()}
+        super().__init__(FakeImapSession, port, link)
+
+
+class FakeSmtpServer(FakeServer):
+    """Fake SMTP server, counts the messages and bytes queued."""
+
+    def __init__(self, port=0, chunking=False, link=None):
+        self.chunking = chunking
+        self.messages = 0
+        self.message_bytes = 0
+        super().__init__(FakeSmtpSession, port, link)
+
+    def add_message(self, message):
+        with self.lock:
+            self.messages += 1
+            self.message_bytes += len(message)
+
+    def reset(self):
+        super().reset()
+        with self.lock:
+            self.messages = self.message_bytes = 0
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Local control channel of the running proxy.
+
+The proxy listens on a Unix socket in the home directory, requests and
+responses are single JSON lines::
+
+    {"cmd": "mode", "args": {"mode": 2}}
+    {"ok": true, "result": null}
+
+See ``control_commands()`` in :mod:`nauta_proxy` for the commands.
+"""
+import atexit
+import json
+import os
+import socket
+import socketserver
+import threading
+
+
+class ControlError(Exception):
+    """The proxy received the request but it failed."""
+
+
+class ProxyRunning(OSError):
+    """Another proxy is listening on the control socket."""
+
+
+def control_path():
+    return os.path.join(os.path.expanduser('~'), '.nauta_proxy.sock')
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                req = json.loads(line.decode())
+                command = self.server.commands.get(req.get('cmd'))
+                if command is None:
+                    raise ValueError(
+                        'unknown command: {}'.format(req.get('cmd')))
+                result = command(**req.get('args', {}))
+                resp = {'ok': True, 'result': result}
+            except Exception as ex:
+                resp = {'ok': False, 'error': str(ex) or repr(ex)}
+            self.wfile.write(json.dumps(resp).encode() + b'\n')
+
+
+if hasattr(socket, 'AF_UNIX'):
+    class ControlServer(socketserver.ThreadingMixIn,
+                        socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def __init__(self, path, commands):
+            self.path = path
+            self.commands = commands
+            if os.path.exists(path):
+                with socket.socket(socket.AF_UNIX) as sock:
+                    try:
+                        sock.connect(path)
+                    except OSError:
+                        pass  # left by a proxy that was killed
+                    else:
+                        raise ProxyRunning(
+                            'a proxy is already running: {}'.format(path))
+                os.unlink(path)
+            super().__init__(path, ControlHandler)
+            os.chmod(path, 0o600)
+            self.inode = os.stat(path).st_ino
+
+        def server_close(self):
+            super().server_close()
+            try:
+                # a proxy started while this one was draining owns it now
+                if os.stat(self.path).st_ino == self.inode:
+                    os.unlink(self.path)
+            except OSError:
+                pass
+
+
+def serve_control(commands, path=None):
+    """Serve ``commands`` (name -> function) from a background thread.
+
+    Returns None where Unix sockets aren't available.
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    server = ControlServer(path or control_path(), commands)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    atexit.register(server.server_close)
+    return server
+
+
+def request(cmd, path=None, timeout=None, **args):
+    """Send a request to the running proxy and return its result.
+
+    Raises OSError if the proxy isn't running and ControlError if the
+    request failed.
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        raise OSError('control socket not supported')
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path or control_path())
+        sock.sendall(json.dumps({'cmd': cmd, 'args': args}).encode() + b'\n')
+        with sock.makefile('rb') as fd:
+            line = fd.readline()
+    if not line:
+        raise ConnectionError('the proxy closed the control socket')
+    resp = json.loads(line.decode())
+    if not resp['ok']:
+        raise ControlError(resp['error'])
+    return resp['result']
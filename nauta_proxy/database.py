@@ -1,66 +1,481 @@
 # -*- coding: utf-8 -*-
+import atexit
 import os
 import re
 import sqlite3
 import threading
+import time
+
+from .index import MailboxIndexes
+from .proxy import TRAFFIC_CLASSES
+from .spool import Spool
+
+
+class Counters:
+    """Write-behind traffic counters.
+
+    Increments only touch memory, the accumulated deltas are added to the
+    database in a single transaction every ``interval`` seconds and at exit,
+    so a crash loses at most one interval and the database always holds the
+    last flushed values. Deltas (not totals) are written, so a reset done by
+    another process is not overwritten by the running proxy.
+    """
+
+    def __init__(self, db, keys, interval=10):
+        self.db = db
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = dict.fromkeys(keys, 0)
+        self.base = self._load()
+        self._timer = None
+
+    def _load(self):
+        with self.db.lock:
+            rows = self.db.db.execute(
+                'SELECT key, value FROM stats WHERE key IN ({})'.format(
+                    ','.join('?'*len(self.pending))), tuple(self.pending))
+            return {key: int(value) for key, value in rows}
+
+    def start(self):
+        if self._timer is None:
+            self._timer = threading.Thread(target=self._run, daemon=True)
+            self._timer.start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        event = threading.Event()
+        while not event.wait(self.interval):
+            self.flush()
+
+    def add(self, key, amount=1):
+        with self.lock:
+            self.pending[key] += amount
+            return self.base[key] + self.pending[key]
+
+    def get(self, key):
+        with self.lock:
+            return self.base[key] + self.pending[key]
+
+    def set(self, key, val):
+        with self.lock:
+            self.db.execute(
+                'UPDATE stats SET value=? WHERE key=?', (val, key))
+            self.base[key] = val
+            self.pending[key] = 0
+
+    def reset(self):
+        with self.lock:
+            self.pending = dict.fromkeys(self.pending, 0)
+            self.base = self._load()
+
+    def flush(self):
+        with self.lock:
+            deltas = [(v, k) for k, v in self.pending.items() if v]
+            with self.db.lock, self.db.db:
+                self.db.db.executemany(
+                    'UPDATE stats SET value=value+? WHERE key=?', deltas)
+            self.base = self._load()
+            self.pending = dict.fromkeys(self.pending, 0)
+
+
+class MessageCache:
+    """Persistent store of fetched message bodies with LRU eviction.
+
+    Bodies are keyed by (account, mailbox, UIDVALIDITY, UID), which never
+    changes its content on the server. The least recently used bodies are
+    deleted when the total size goes over ``max_size`` bytes. Access times
+    of cache hits are kept in memory and written with the next insert,
+    every ``batch`` hits and at exit.
+    """
+    batch = 100
+
+    def __init__(self, path, max_size):
+        self.max_size = max_size
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        # key -> atime of the hits not written yet
+        self.touched = {}
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS messages
+                               (account TEXT,
+                                mailbox TEXT,
+                                uidvalidity INTEGER,
+                                uid INTEGER,
+                                body BLOB NOT NULL,
+                                atime REAL NOT NULL,
+                                PRIMARY KEY(account, mailbox, uidvalidity,
+                                            uid))''')
+            self.db.execute('CREATE INDEX IF NOT EXISTS messages_atime '
+                            'ON messages(atime)')
+            self.size = self.db.execute(
+                'SELECT COALESCE(SUM(LENGTH(body)), 0) FROM messages'
+            ).fetchone()[0]
+        atexit.register(self.flush)
+
+    def __contains__(self, key):
+        with self.lock:
+            return self.db.execute(
+                'SELECT 1 FROM messages WHERE account=? AND mailbox=? '
+                'AND uidvalidity=? AND uid=?', key).fetchone() is not None
+
+    def get(self, key):
+        with self.lock:
+            r = self.db.execute(
+                'SELECT body FROM messages WHERE account=? AND mailbox=? '
+                'AND uidvalidity=? AND uid=?', key).fetchone()
+            if r is None:
+                return None
+            self.touched[tuple(key)] = time.time()
+            if len(self.touched) >= self.batch:
+                with self.db:
+                    self._write_touched()
+            return r[0]
+
+    def flush(self):
+        """Write the access times of the hits."""
+        with self.lock, self.db:
+            self._write_touched()
+
+    def _write_touched(self):
+        self.db.executemany(
+            'UPDATE messages SET atime=? WHERE account=? AND mailbox=? '
+            'AND uidvalidity=? AND uid=?',
+            [(atime,) + key for key, atime in self.touched.items()])
+        self.touched.clear()
+
+    def put(self, key, body):
+        if len(body) > self.max_size // 4:
+            return
+        with self.lock, self.db:
+            # the order of eviction needs the access times
+            self._write_touched()
+            old = self.db.execute(
+                'SELECT LENGTH(body) FROM messages WHERE account=? AND '
+                'mailbox=? AND uidvalidity=? AND uid=?', key).fetchone()
+            self.size += len(body) - (old[0] if old else 0)
+            self.db.execute(
+                'REPLACE INTO messages VALUES (?,?,?,?,?,?)',
+                tuple(key) + (body, time.time()))
+            if self.size <= self.max_size:
+                return
+            rows = self.db.execute(
+                'SELECT rowid, LENGTH(body) FROM messages ORDER BY atime')
+            expired = []
+            for rowid, size in rows:
+                if self.size <= self.max_size:
+                    break
+                expired.append((rowid,))
+                self.size -= size
+            self.db.executemany(
+                'DELETE FROM messages WHERE rowid=?', expired)
+
+
+class HeaderRules:
+    """Header filtering rules, shared by the IMAP and SMTP handlers.
+
+    Rules map a direction ('send' for SMTP, 'receive' for IMAP) and a
+    lowercase header name to an action: 'drop' (Lite and Lite+), 'drop+'
+    (Lite+ only), 'keep' or 'to' (rewrite the addresses of a To: header).
+    """
+    directions = ('send', 'receive')
+    actions = ('drop', 'drop+', 'keep', 'to')
+    defaults = (
+        ('send', 'autocrypt', 'drop'),
+        ('send', 'x-mailer', 'drop'),
+        ('send', 'subject', 'drop'),
+        ('send', 'references', 'drop'),
+        ('send', 'in-reply-to', 'drop'),
+        ('send', 'chat-version', 'drop+'),
+        ('send', 'to', 'to'),
+        ('receive', 'autocrypt', 'drop'),
+        ('receive', 'return-path', 'drop'),
+        ('receive', 'received', 'drop'),
+        ('receive', 'received-spf', 'drop'),
+        ('receive', 'dkim-signature', 'drop'))
+
+    def __init__(self, rows):
+        self.rules = tuple(map(tuple, rows))
+        self._selected = {}
+
+    def select(self, direction, mode):
+        """Return ``(drop, rewrite)`` for the given direction and mode.
+
+        ``drop`` is a set of header names and ``rewrite`` maps header names
+        to their rewrite action, both as lowercase bytes.
+        """
+        key = (direction, mode)
+        if key not in self._selected:
+            drop, rewrite = [], {}
+            if mode:
+                for d, name, action in self.rules:
+                    if d != direction:
+                        continue
+                    if action == 'drop' or action == 'drop+' and mode == 2:
+                        drop.append(name.encode())
+                    elif action not in ('keep', 'drop+'):
+                        rewrite[name.encode()] = action
+            self._selected[key] = (tuple(drop), frozenset(drop), rewrite)
+        return self._selected[key][1:]
+
+    def names(self, direction, mode):
+        """Names dropped in the given direction, in insertion order."""
+        self.select(direction, mode)
+        return self._selected[(direction, mode)][0]
 
 
 class DBManager:
-    def __init__(self):
-        p = os.path.join(os.path.expanduser('~'), '.nauta_proxy.db')
+    def __init__(self, path=None):
+        p = path or os.path.join(os.path.expanduser('~'), '.nauta_proxy.db')
         self.db = sqlite3.connect(p, check_same_thread=False)
         self.lock = threading.RLock()
         self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
         self.execute('''CREATE TABLE IF NOT EXISTS stats
                         (key TEXT PRIMARY KEY,
                          value TEXT NOT NULL)''')
         self.execute('INSERT OR IGNORE INTO stats VALUES ("db_version", "1")')
-        self.execute(
-            'INSERT OR IGNORE INTO stats VALUES ("ignored_headers", "AUTOCRYPT RETURN-PATH RECEIVED RECEIVED-SPF DKIM-SIGNATURE")')
+        self._init_header_rules()
         self.execute(
             'INSERT OR IGNORE INTO stats VALUES ("serverstats", "0 0")')
+        self.execute(
+            'INSERT OR IGNORE INTO stats VALUES ("serverstats_time", "0")')
         self.execute('INSERT OR IGNORE INTO stats VALUES ("credentials", "")')
         self.execute('INSERT OR IGNORE INTO stats VALUES ("savelog", "0")')
+        self.execute('INSERT OR IGNORE INTO stats VALUES ("capture", "0")')
+        self.execute(
+            'INSERT OR IGNORE INTO stats VALUES ("loglevel", "info")')
+        self.execute(
+            'INSERT OR IGNORE INTO stats VALUES ("metrics_port", "8083")')
         self.execute('INSERT OR IGNORE INTO stats VALUES ("stop", "0")')
         self.execute('INSERT OR IGNORE INTO stats VALUES ("optimize", "1")')
         self.execute('INSERT OR IGNORE INTO stats VALUES ("imap", "0")')
         self.execute('INSERT OR IGNORE INTO stats VALUES ("smtp", "0")')
         self.execute('INSERT OR IGNORE INTO stats VALUES ("imap_msgs", "0")')
         self.execute('INSERT OR IGNORE INTO stats VALUES ("smtp_msgs", "0")')
+        self.execute('INSERT OR IGNORE INTO stats VALUES ("imap_wire", "0")')
+        self.execute('INSERT OR IGNORE INTO stats VALUES ("imap_plain", "0")')
+        self.execute(
+            'INSERT OR IGNORE INTO stats VALUES ("smtp_transcoded", "0")')
+        self.execute('INSERT OR IGNORE INTO stats VALUES ("smtp_saved", "0")')
+        self.execute(
+            'INSERT OR IGNORE INTO stats VALUES ("imap_transcoded", "0")')
+        self.execute('INSERT OR IGNORE INTO stats VALUES ("imap_saved", "0")')
+        self.execute('INSERT OR IGNORE INTO stats VALUES ("cache_size", "0")')
+        self.execute('INSERT OR IGNORE INTO stats VALUES ("spool", "0")')
+        self.execute('INSERT OR IGNORE INTO stats VALUES ("prefetch", "0")')
+        self.execute('INSERT OR IGNORE INTO stats VALUES ("priority", "0")')
+        self.execute('INSERT OR IGNORE INTO stats VALUES ("rates", "0 0 0")')
+        self.execute('INSERT OR IGNORE INTO stats VALUES ("cache_hits", "0")')
+        self.execute(
+            'INSERT OR IGNORE INTO stats VALUES ("cache_misses", "0")')
+        self.execute('INSERT OR IGNORE INTO stats VALUES ("cache_saved", "0")')
+        self.execute('INSERT OR IGNORE INTO stats VALUES ("index_hits", "0")')
+        self.execute('INSERT OR IGNORE INTO stats VALUES ("index_saved", "0")')
+        self.execute('INSERT OR IGNORE INTO stats VALUES ("prefetched", "0")')
+        self.execute(
+            'INSERT OR IGNORE INTO stats VALUES ("prefetch_hits", "0")')
+        self.execute(
+            'INSERT OR IGNORE INTO stats VALUES ("prefetch_wasted", "0")')
+        self.counters = Counters(
+            self, ('imap', 'smtp', 'imap_msgs', 'smtp_msgs', 'imap_wire',
+                   'imap_plain', 'smtp_transcoded', 'smtp_saved',
+                   'imap_transcoded', 'imap_saved', 'cache_hits',
+                   'cache_misses', 'cache_saved', 'index_hits',
+                   'index_saved', 'prefetched', 'prefetch_hits',
+                   'prefetch_wasted'))
+
+        self.cache = None
+        self.spool = None
+        self.indexes = MailboxIndexes()
+        self._serverstats_claimed = 0
+        self._data_version = None
+        self.refresh()
+
+    def _init_header_rules(self):
+        self.execute('''CREATE TABLE IF NOT EXISTS header_rules
+                        (direction TEXT,
+                         name TEXT,
+                         action TEXT NOT NULL,
+                         PRIMARY KEY(direction, name))''')
+        r = self.db.execute('SELECT value FROM stats WHERE key="db_version"')
+        if r.fetchone()[0] != "1":
+            return
+        with self.lock, self.db:
+            rules = list(HeaderRules.defaults)
+            r = self.db.execute(
+                'SELECT value FROM stats WHERE key="ignored_headers"')
+            r = r.fetchone()
+            if r:  # keep headers configured with --notheaders
+                rules = [rule for rule in rules if rule[0] != 'receive']
+                rules.extend(('receive', name.lower(), 'drop')
+                             for name in r[0].split())
+            self.db.executemany(
+                'INSERT OR IGNORE INTO header_rules VALUES (?,?,?)', rules)
+            self.db.execute('DELETE FROM stats WHERE key="ignored_headers"')
+            self.db.execute(
+                'UPDATE stats SET value="2" WHERE key="db_version"')
 
-        h = self.get_ignoredheaders().encode()
+    def refresh(self):
+        """Reload the settings snapshot if another process changed the db.
+
+        ``PRAGMA data_version`` only changes when a different connection
+        commits, so this is a single cheap query when nothing changed.
+        """
+        with self.lock:
+            version = self.db.execute('PRAGMA data_version').fetchone()[0]
+            if version != self._data_version:
+                self._data_version = version
+                self._load_settings()
+
+    def watch(self, interval=1):
+        """Keep the settings snapshot fresh from a background thread."""
+        def _watch():
+            event = threading.Event()
+            while not event.wait(interval):
+                self.refresh()
+        threading.Thread(target=_watch, daemon=True).start()
+
+    def _load_settings(self):
+        with self.lock:
+            rows = dict(self.db.execute(
+                'SELECT key, value FROM stats WHERE key IN '
+                '("savelog", "loglevel", "capture", "stop", "optimize", '
+                '"cache_size", "spool", "prefetch", "priority", "rates")'))
+            self.header_rules = HeaderRules(self.db.execute(
+                'SELECT direction, name, action FROM header_rules '
+                'ORDER BY rowid'))
+        self.savelog = rows['savelog'] == "1"
+        self.capture = rows['capture'] == "1"
+        self.loglevel = rows['loglevel']
+        self.stop = rows['stop'] == "1"
+        self.optimize = int(rows['optimize'])
+        self.cache_size = int(rows['cache_size'])
+        self.spooling = rows['spool'] == "1"
+        self.prefetch = int(rows['prefetch'])
+        self.priority = rows['priority'] == "1"
+        self.rates = tuple(int(i)*1024 for i in rows['rates'].split())
+        if self.cache:
+            self.cache.max_size = self.cache_size*1024**2
+
+        h = b' '.join(self.header_rules.names('receive', self.optimize or 1))
+        h = h.upper()
         self.header_part = re.compile(
             rb'\) BODY\[HEADER\.FIELDS\.NOT \(' + h + rb'\)\] \{([0-9]+)\}')
-        self.fetch_sub = b' (FLAGS BODY.PEEK[HEADER.FIELDS.NOT (' + \
-            h + b')] BODY.PEEK[TEXT])\r\n'
+        self.header_fetch = b'BODY.PEEK[HEADER.FIELDS.NOT (' + h + b')]'
+        self.fetch_sub = b' (FLAGS ' + self.header_fetch + \
+            b' BODY.PEEK[TEXT])\r\n'
 
     def reset(self):
         self.execute('REPLACE INTO stats VALUES ("imap", "0")')
         self.execute('REPLACE INTO stats VALUES ("smtp", "0")')
         self.execute('REPLACE INTO stats VALUES ("imap_msgs", "0")')
         self.execute('REPLACE INTO stats VALUES ("smtp_msgs", "0")')
+        self.execute('REPLACE INTO stats VALUES ("imap_wire", "0")')
+        self.execute('REPLACE INTO stats VALUES ("imap_plain", "0")')
+        self.execute('REPLACE INTO stats VALUES ("smtp_transcoded", "0")')
+        self.execute('REPLACE INTO stats VALUES ("smtp_saved", "0")')
+        self.execute('REPLACE INTO stats VALUES ("imap_transcoded", "0")')
+        self.execute('REPLACE INTO stats VALUES ("imap_saved", "0")')
+        self.execute('REPLACE INTO stats VALUES ("cache_hits", "0")')
+        self.execute('REPLACE INTO stats VALUES ("cache_misses", "0")')
+        self.execute('REPLACE INTO stats VALUES ("cache_saved", "0")')
+        self.execute('REPLACE INTO stats VALUES ("index_hits", "0")')
+        self.execute('REPLACE INTO stats VALUES ("index_saved", "0")')
+        self.execute('REPLACE INTO stats VALUES ("prefetched", "0")')
+        self.execute('REPLACE INTO stats VALUES ("prefetch_hits", "0")')
+        self.execute('REPLACE INTO stats VALUES ("prefetch_wasted", "0")')
+        self.counters.reset()
 
     def execute(self, statement, args=()):
         with self.lock, self.db:
             return self.db.execute(statement, args)
 
     def get_ignoredheaders(self):
-        r = self.db.execute(
-            'SELECT value FROM stats WHERE key="ignored_headers"')
-        return r.fetchone()[0]
+        return ' '.join(name.upper() for direction, name, action
+                        in self.header_rules.rules
+                        if direction == 'receive' and action == 'drop')
 
     def set_ignoredheaders(self, val):
-        self.execute(
-            'UPDATE stats SET value=? WHERE key="ignored_headers"', (val,))
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM header_rules WHERE '
+                            'direction="receive" AND action="drop"')
+            self.db.executemany(
+                'INSERT OR REPLACE INTO header_rules VALUES (?,?,?)',
+                (('receive', name.lower(), 'drop') for name in val.split()))
+        self._load_settings()
+
+    def get_header_rules(self):
+        return self.header_rules.rules
+
+    def set_header_rule(self, direction, name, action):
+        """Set the action of a header, 'default' removes its rule.
+
+        Raises ValueError for an unknown direction or action.
+        """
+        if direction not in HeaderRules.directions:
+            raise ValueError('invalid direction: {}'.format(direction))
+        if action == 'default':
+            self.execute('DELETE FROM header_rules WHERE direction=? AND '
+                         'name=?', (direction, name.lower()))
+        else:
+            if action not in HeaderRules.actions:
+                raise ValueError('invalid action: {}'.format(action))
+            self.execute('INSERT OR REPLACE INTO header_rules VALUES (?,?,?)',
+                         (direction, name.lower(), action))
+        self._load_settings()
 
     def get_serverstats(self):
         r = self.db.execute('SELECT value FROM stats WHERE key="serverstats"')
         return tuple(int(i) for i in r.fetchone()[0].split())
 
     def set_serverstats(self, val):
-        val = '{} {}'.format(*val)
+        """Set the ``(messages, KB)`` used in the server, None keeps a value.
+        """
+        with self.lock, self.db:
+            val = ' '.join(str(old if new is None else new) for new, old in
+                           zip(val, self.get_serverstats()))
+            self.db.execute(
+                'UPDATE stats SET value=? WHERE key="serverstats"', (val,))
+            self.db.execute('UPDATE stats SET value=? WHERE '
+                            'key="serverstats_time"', (int(time.time()),))
+
+    def add_serverstats(self, messages):
+        """Add to the messages in the server, without refreshing its age."""
+        with self.lock, self.db:
+            msgs, kb = self.get_serverstats()
+            self.db.execute(
+                'UPDATE stats SET value=? WHERE key="serverstats"',
+                ('{} {}'.format(max(msgs + messages, 0), kb),))
+
+    def get_serverstats_age(self):
+        """Seconds since the server stats were last read from a QUOTA."""
+        r = self.db.execute(
+            'SELECT value FROM stats WHERE key="serverstats_time"')
+        return time.time() - int(r.fetchone()[0])
+
+    def claim_serverstats(self, max_age):
+        """Return True if the caller should update the server stats.
+
+        That is when they are older than ``max_age`` seconds and no other
+        session claimed them in that time.
+        """
+        with self.lock:
+            now = time.time()
+            if self.get_serverstats_age() < max_age or \
+               now - self._serverstats_claimed < max_age:
+                return False
+            self._serverstats_claimed = now
+            return True
+
+    def get_metrics_port(self):
+        r = self.db.execute('SELECT value FROM stats WHERE key="metrics_port"')
+        return int(r.fetchone()[0])
+
+    def set_metrics_port(self, val):
         self.execute(
-            'UPDATE stats SET value=? WHERE key="serverstats"', (val,))
+            'UPDATE stats SET value=? WHERE key="metrics_port"', (val,))
 
     def get_credentials(self):
         r = self.db.execute(
@@ -73,60 +488,219 @@ class DBManager:
             'UPDATE stats SET value=? WHERE key="credentials"', (val,))
 
     def get_savelog(self):
-        r = self.db.execute('SELECT value FROM stats WHERE key="savelog"')
-        return r.fetchone()[0] == "1"
+        return self.savelog
 
     def set_savelog(self, val):
         val = 1 if val else 0
         self.execute(
             'UPDATE stats SET value=? WHERE key="savelog"', (val,))
+        self._load_settings()
+
+    def get_loglevel(self):
+        return self.loglevel
+
+    def set_loglevel(self, val):
+        self.execute(
+            'UPDATE stats SET value=? WHERE key="loglevel"', (val,))
+        self._load_settings()
+
+    def get_capture(self):
+        return self.capture
+
+    def set_capture(self, val):
+        val = 1 if val else 0
+        self.execute(
+            'UPDATE stats SET value=? WHERE key="capture"', (val,))
+        self._load_settings()
 
     def get_stop(self):
-        r = self.db.execute('SELECT value FROM stats WHERE key="stop"')
-        return r.fetchone()[0] == "1"
+        return self.stop
 
     def set_stop(self, val):
         val = 1 if val else 0
         self.execute(
             'UPDATE stats SET value=? WHERE key="stop"', (val,))
+        self._load_settings()
 
     def get_optimize(self):
-        r = self.db.execute(
-            'SELECT value FROM stats WHERE key="optimize"').fetchone()
-        return int(r[0])
+        return self.optimize
 
     def set_optimize(self, val):
         self.execute(
             'UPDATE stats SET value=? WHERE key="optimize"', (val,))
+        self._load_settings()
 
     def get_imap(self):
-        r = self.db.execute('SELECT value FROM stats WHERE key="imap"')
-        return int(r.fetchone()[0])
+        return self.counters.get('imap')
 
     def set_imap(self, val):
-        self.execute(
-            'UPDATE stats SET value=? WHERE key="imap"', (val,))
+        self.counters.set('imap', val)
+
+    def add_imap(self, amount=1):
+        return self.counters.add('imap', amount)
 
     def get_smtp(self):
-        r = self.db.execute('SELECT value FROM stats WHERE key="smtp"')
-        return int(r.fetchone()[0])
+        return self.counters.get('smtp')
 
     def set_smtp(self, val):
-        self.execute(
-            'UPDATE stats SET value=? WHERE key="smtp"', (val,))
+        self.counters.set('smtp', val)
+
+    def add_smtp(self, amount=1):
+        return self.counters.add('smtp', amount)
 
     def get_imap_msgs(self):
-        r = self.db.execute('SELECT value FROM stats WHERE key="imap_msgs"')
-        return int(r.fetchone()[0])
+        return self.counters.get('imap_msgs')
 
     def set_imap_msgs(self, val):
-        self.execute(
-            'UPDATE stats SET value=? WHERE key="imap_msgs"', (val,))
+        self.counters.set('imap_msgs', val)
+
+    def add_imap_msgs(self, amount=1):
+        return self.counters.add('imap_msgs', amount)
 
     def get_smtp_msgs(self):
-        r = self.db.execute('SELECT value FROM stats WHERE key="smtp_msgs"')
-        return int(r.fetchone()[0])
+        return self.counters.get('smtp_msgs')
 
     def set_smtp_msgs(self, val):
+        self.counters.set('smtp_msgs', val)
+
+    def add_smtp_msgs(self, amount=1):
+        return self.counters.add('smtp_msgs', amount)
+
+    def get_imap_wire(self):
+        return self.counters.get('imap_wire')
+
+    def add_imap_wire(self, amount=1):
+        return self.counters.add('imap_wire', amount)
+
+    def get_imap_plain(self):
+        return self.counters.get('imap_plain')
+
+    def add_imap_plain(self, amount=1):
+        return self.counters.add('imap_plain', amount)
+
+    def get_smtp_saved(self):
+        """Return ``(messages, bytes)`` saved by decoding sent messages."""
+        return (self.counters.get('smtp_transcoded'),
+                self.counters.get('smtp_saved'))
+
+    def add_smtp_saved(self, saved):
+        self.counters.add('smtp_transcoded')
+        self.counters.add('smtp_saved', saved)
+
+    def get_imap_saved(self):
+        """Return ``(messages, bytes)`` saved fetching parts with BINARY."""
+        return (self.counters.get('imap_transcoded'),
+                self.counters.get('imap_saved'))
+
+    def add_imap_saved(self, saved):
+        self.counters.add('imap_transcoded')
+        self.counters.add('imap_saved', saved)
+
+    def get_cache(self):
+        """Return the message cache, or None if it is disabled."""
+        if not self.cache_size:
+            return None
+        if self.cache is None:
+            p = os.path.join(os.path.expanduser('~'), '.nauta_proxy_cache.db')
+            self.cache = MessageCache(p, self.cache_size*1024**2)
+        return self.cache
+
+    def get_indexes(self):
+        """Return the in-memory indexes of the mailboxes."""
+        return self.indexes
+
+    def get_spool(self, create=True):
+        """Return the spool of sent messages.
+
+        Without ``create`` it is None if it was never used.
+        """
+        with self.lock:
+            if self.spool is None:
+                p = os.path.join(
+                    os.path.expanduser('~'), '.nauta_proxy_spool.db')
+                if create or os.path.exists(p):
+                    self.spool = Spool(p, self)
+        return self.spool
+
+    def get_spooling(self):
+        return self.spooling
+
+    def set_spooling(self, val):
+        val = 1 if val else 0
+        self.execute(
+            'UPDATE stats SET value=? WHERE key="spool"', (val,))
+        self._load_settings()
+
+    def get_priority(self):
+        return self.priority
+
+    def set_priority(self, val):
+        val = 1 if val else 0
+        self.execute(
+            'UPDATE stats SET value=? WHERE key="priority"', (val,))
+        self._load_settings()
+
+    def get_rates(self):
+        """Return the rate cap of each traffic class in bytes/s, 0 for none.
+        """
+        return self.rates
+
+    def set_rate(self, klass, val):
+        """Set the rate cap of a traffic class in KB/s."""
+        rates = [rate//1024 for rate in self.rates]
+        rates[TRAFFIC_CLASSES.index(klass)] = val
+        self.execute('UPDATE stats SET value=? WHERE key="rates"',
+                     (' '.join(map(str, rates)),))
+        self._load_settings()
+
+    def get_cache_size(self):
+        return self.cache_size
+
+    def set_cache_size(self, val):
+        self.execute(
+            'UPDATE stats SET value=? WHERE key="cache_size"', (val,))
+        self._load_settings()
+
+    def get_prefetch(self):
+        return self.prefetch
+
+    def set_prefetch(self, val):
         self.execute(
-            'UPDATE stats SET value=? WHERE key="smtp_msgs"', (val,))
+            'UPDATE stats SET value=? WHERE key="prefetch"', (val,))
+        self._load_settings()
+
+    def get_prefetch_stats(self):
+        """Return ``(messages prefetched, used, bytes wasted)``."""
+        return (self.counters.get('prefetched'),
+                self.counters.get('prefetch_hits'),
+                self.counters.get('prefetch_wasted'))
+
+    def add_prefetched(self):
+        self.counters.add('prefetched')
+
+    def add_prefetch_hit(self):
+        self.counters.add('prefetch_hits')
+
+    def add_prefetch_wasted(self, size):
+        self.counters.add('prefetch_wasted', size)
+
+    def get_cache_stats(self):
+        return (self.counters.get('cache_hits'),
+                self.counters.get('cache_misses'),
+                self.counters.get('cache_saved'))
+
+    def add_cache_hit(self, saved):
+        self.counters.add('cache_hits')
+        self.counters.add('cache_saved', saved)
+
+    def add_cache_miss(self):
+        self.counters.add('cache_misses')
+
+    def get_index_stats(self):
+        """Return ``(fetches, bytes)`` answered from the mailbox index."""
+        return (self.counters.get('index_hits'),
+                self.counters.get('index_saved'))
+
+    def add_index_hit(self, saved):
+        self.counters.add('index_hits')
+        self.counters.add('index_saved', saved)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""Index of the messages of the mailboxes seen by the IMAP handler.
+
+The UIDs, flags and MODSEQ of every message are kept in memory as they
+pass in the responses to Delta Chat, so the handler can answer flag
+fetches when the mailbox provably didn't change and sync them by MODSEQ
+(CONDSTORE, RFC 7162) when it did.
+"""
+import array
+import bisect
+import collections
+import threading
+
+
+class MailboxIndex:
+    """UIDs, flags and MODSEQ of the messages of a mailbox.
+
+    Records are parallel arrays sorted by UID, 16 bytes per message, with
+    the flags as a bit mask over ``names``. When ``complete``, the index
+    had every message of the mailbox at MODSEQ ``modseq`` and all the
+    changes up to it but expunges. ``version`` changes on every update,
+    use ``lock`` around them.
+    """
+    __slots__ = ('uidvalidity', 'modseq', 'complete', 'version', 'uids',
+                 'flags', 'modseqs', 'names', 'lock')
+    max_names = 32
+
+    def __init__(self, uidvalidity):
+        self.uidvalidity = uidvalidity
+        self.lock = threading.RLock()
+        self.version = 0
+        self.clear()
+
+    def clear(self):
+        self.modseq = None
+        self.complete = False
+        self.version += 1
+        self.uids = array.array('I')
+        self.flags = array.array('I')
+        self.modseqs = array.array('Q')
+        self.names = []
+
+    def __len__(self):
+        return len(self.uids)
+
+    def __contains__(self, uid):
+        i = bisect.bisect_left(self.uids, uid)
+        return i < len(self.uids) and self.uids[i] == uid
+
+    def update(self, uid, flags=None, modseq=None):
+        """Add or update a message, ``flags`` is a list of flag names.
+
+        Returns False if the index was cleared, having too many flags.
+        """
+        mask = None if flags is None else self._mask(flags)
+        if mask is None and flags is not None:
+            self.clear()
+            return False
+        i = bisect.bisect_left(self.uids, uid)
+        if i == len(self.uids) or self.uids[i] != uid:
+            self.uids.insert(i, uid)
+            self.flags.insert(i, 0)
+            self.modseqs.insert(i, 0)
+        if mask is not None:
+            self.flags[i] = mask
+        if modseq is not None:
+            self.modseqs[i] = modseq
+        self.version += 1
+        return True
+
+    def remove(self, ranges):
+        """Remove the messages with UIDs in ``ranges``, return how many."""
+        keep = [i for i, uid in enumerate(self.uids)
+                if not in_ranges(uid, ranges)]
+        removed = len(self.uids) - len(keep)
+        if removed:
+            self._keep(keep)
+        return removed
+
+    def remove_at(self, i):
+        del self.uids[i]
+        del self.flags[i]
+        del self.modseqs[i]
+        self.version += 1
+
+    def restrict(self, uids):
+        """Keep only the messages with the given UIDs."""
+        keep = [i for i, uid in enumerate(self.uids) if uid in uids]
+        if len(keep) != len(self.uids):
+            self._keep(keep)
+
+    def _keep(self, keep):
+        self.uids = array.array('I', (self.uids[i] for i in keep))
+        self.flags = array.array('I', (self.flags[i] for i in keep))
+        self.modseqs = array.array('Q', (self.modseqs[i] for i in keep))
+        self.version += 1
+
+    def _mask(self, flags):
+        """Return the bit mask of ``flags``, None if there are too many."""
+        mask = 0
+        for name in flags:
+            if name.lower() == b'\\recent':
+                continue  # only meaningful in the session that got it
+            try:
+                bit = self.names.index(name)
+            except ValueError:
+                if len(self.names) == self.max_names:
+                    return None
+                self.names.append(name)
+                bit = len(self.names) - 1
+            mask |= 1 << bit
+        return mask
+
+    def flag_names(self, mask):
+        return b' '.join(name for bit, name in enumerate(self.names)
+                         if mask >> bit & 1)
+
+    def fetch(self, ranges, items, changedsince=None):
+        """Return the FETCH responses of the UIDs in ``ranges``.
+
+        ``items`` are the names of the wanted items (UID, FLAGS, MODSEQ).
+        Returns None if the MODSEQ of a message is needed and unknown, a
+        MODSEQ of 0 is one not above ``modseq``.
+        """
+        found = set()
+        for first, last in ranges:
+            found.update(range(bisect.bisect_left(self.uids, first),
+                               bisect.bisect_right(self.uids, last)))
+        modseq = changedsince is not None or b'MODSEQ' in items
+        lines = []
+        for i in sorted(found):
+            changed = self.modseqs[i]
+            if changedsince is not None and not changed and \
+               self.modseq is not None and changedsince >= self.modseq:
+                continue
+            if modseq and not changed:
+                return None
+            if changedsince is not None and changed <= changedsince:
+                continue
+            parts = [b'UID %i' % (self.uids[i],)]
+            if b'FLAGS' in items:
+                parts.append(
+                    b'FLAGS (' + self.flag_names(self.flags[i]) + b')')
+            if modseq:
+                parts.append(b'MODSEQ (%i)' % (self.modseqs[i],))
+            lines.append(b'* %i FETCH (%s)\r\n' % (i + 1, b' '.join(parts)))
+        return lines
+
+
+class MailboxIndexes:
+    """The MailboxIndex of the last ``max_mailboxes`` mailboxes used."""
+    max_mailboxes = 64
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.indexes = collections.OrderedDict()
+
+    def get(self, account, mailbox, uidvalidity):
+        """Return the index of a mailbox, empty if UIDVALIDITY changed."""
+        key = (account, mailbox)
+        with self.lock:
+            index = self.indexes.pop(key, None)
+            if index is None or index.uidvalidity != uidvalidity:
+                index = MailboxIndex(uidvalidity)
+            self.indexes[key] = index
+            while len(self.indexes) > self.max_mailboxes:
+                self.indexes.popitem(last=False)
+        return index
+
+
+class FlagsFetch:
+    """A fetch of flags of Delta Chat answered from the index.
+
+    It was replaced by a fetch of the changes since MODSEQ ``since`` of
+    the index, 0 to fill it, ``uids`` are then the messages listed.
+    ``modseq`` is the highest MODSEQ in the responses and ``dropped`` the
+    bytes of the responses that didn't reach the client.
+    """
+    __slots__ = ('tag', 'command', 'spec', 'items', 'changedsince', 'since',
+                 'uids', 'modseq', 'dropped')
+
+    def __init__(self, tag, command, spec, items, changedsince, since):
+        self.tag = tag
+        self.command = command
+        self.spec = spec
+        self.items = items
+        self.changedsince = changedsince
+        self.since = since
+        self.uids = set() if not since else None
+        self.modseq = 0
+        self.dropped = 0
+
+    def sync(self):
+        """Return the command sent instead of the one of the client."""
+        return b'%s UID FETCH 1:* (UID FLAGS) (CHANGEDSINCE %i)\r\n' % (
+            self.tag, self.since)
+
+
+def uid_ranges(spec, largest):
+    """Expand a UID set like ``1,4:*`` into ``(first, last)`` ranges."""
+    ranges = []
+    for part in spec.split(b','):
+        first, _, last = part.partition(b':')
+        first = largest if first == b'*' else int(first)
+        last = first if not last else largest if last == b'*' else int(last)
+        ranges.append((min(first, last), max(first, last)))
+    return ranges
+
+
+def uid_set(uids):
+    """Return the UID set of sorted ``uids``, like ``1:3,5``."""
+    parts = []
+    first = last = None
+    for uid in uids + [None]:
+        if last is not None and uid == last + 1:
+            last = uid
+            continue
+        if first is not None:
+            parts.append(b'%i' % (first,) if first == last else
+                         b'%i:%i' % (first, last))
+        first = last = uid
+    return b','.join(parts)
+
+
+def in_ranges(uid, ranges):
+    return any(first <= uid <= last for first, last in ranges)
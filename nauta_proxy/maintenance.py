@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""Maintenance of the account in the server (empty and expunge folders,
+server stats) from a single IMAP session."""
+import imaplib
+import queue
+import threading
+import time
+
+from .proxy import IMAP_SERVER, parse_quota
+
+
+ACTIONS = ('empty', 'expunge', 'quota')
+
+
+class Job:
+    def __init__(self, action, folders=(), quota=True):
+        assert action in ACTIONS, action
+        self.action = action
+        self.folders = tuple(folders)
+        self.quota = quota or action == 'quota'
+        self.stats = None
+        self.error = None
+        self.done = threading.Event()
+
+    def finish(self, error=None):
+        self.error = error
+        self.done.set()
+
+    def wait(self, timeout=None):
+        """Wait for the job and return the server stats after it."""
+        if not self.done.wait(timeout):
+            raise TimeoutError('maintenance job still running')
+        if self.error:
+            raise self.error
+        return self.stats
+
+
+class Maintenance:
+    """Run maintenance jobs in one IMAP session kept open between them.
+
+    All the jobs waiting when the worker is free run together: every
+    folder is selected once (emptied folders are flagged first) and closed,
+    which expunges it without the server listing every deleted message,
+    and the quota is asked once at the end. Idle sessions are kept alive
+    with NOOP, failed logins are retried with an exponential backoff.
+    """
+    keepalive = 60*10
+    timeout = 60
+    max_backoff = 60*5
+
+    def __init__(self, db, server=IMAP_SERVER):
+        self.db = db
+        self.server = server
+        self.jobs = queue.Queue()
+        self.imap = None
+        self.credentials = None
+        self.failures = 0
+        self.retry_at = 0
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, action, folders=(), quota=True):
+        job = Job(action, folders, quota)
+        self.jobs.put(job)
+        return job
+
+    def _run(self):
+        while True:
+            try:
+                job = self.jobs.get(timeout=self.keepalive)
+            except queue.Empty:
+                self._keepalive()
+            else:
+                self._run_jobs([job] + self._pending())
+
+    def run_pending(self):
+        """Run all the submitted jobs as a batch in the calling thread."""
+        batch = self._pending()
+        if batch:
+            self._run_jobs(batch)
+
+    def _pending(self):
+        jobs = []
+        while True:
+            try:
+                jobs.append(self.jobs.get_nowait())
+            except queue.Empty:
+                return jobs
+
+    def _run_jobs(self, batch):
+        for retry in (True, False):
+            reused = self.imap is not None
+            try:
+                self._run_batch(self._connect(), batch)
+            except (imaplib.IMAP4.abort, OSError) as ex:
+                # the server may have closed the session we kept
+                self.close()
+                if retry and reused:
+                    continue
+                error = ex
+            except Exception as ex:
+                self.close()
+                error = ex
+            else:
+                error = None
+            break
+        stats = self.db.get_serverstats()
+        for job in batch:
+            job.stats = stats
+            if not job.done.is_set():
+                job.finish(error)
+
+    def _run_batch(self, imap, batch):
+        # folder -> empty it, in the order they were submitted
+        folders = {}
+        for job in batch:
+            for folder in job.folders:
+                folders[folder] = folders.get(folder) or job.action == 'empty'
+        failed = {}
+        for folder, empty in folders.items():
+            typ, data = imap.select(folder)
+            if typ != 'OK':
+                failed[folder] = data[0].decode(errors='replace')
+                continue
+            if empty and int(data[0]):
+                imap.store('1:*', '+FLAGS.SILENT', r'\Deleted')
+            imap.close()
+        if any(job.quota for job in batch):
+            typ, data = imap.getquotaroot('INBOX')
+            self.db.set_serverstats(parse_quota(data[1][0]))
+        imap.untagged_responses.clear()
+        for job in batch:
+            errors = [failed[f] for f in job.folders if f in failed]
+            if errors:
+                job.stats = self.db.get_serverstats()
+                job.finish(imaplib.IMAP4.error(', '.join(errors)))
+
+    def _connect(self):
+        credentials = self.db.get_credentials()
+        if self.imap and credentials == self.credentials:
+            return self.imap
+        self.close()
+        if not credentials:
+            raise ValueError('no credentials, log in from Delta Chat first')
+        wait = self.retry_at - time.monotonic()
+        if wait > 0:
+            raise ConnectionError(
+                'login failed, retrying in {:.0f} seconds'.format(wait))
+        try:
+            imap = imaplib.IMAP4(*self.server)
+            imap.sock.settimeout(self.timeout)
+            imap.login(*credentials)
+        except Exception:
+            self.failures += 1
+            self.retry_at = time.monotonic() + min(
+                2**self.failures, self.max_backoff)
+            raise
+        self.failures = 0
+        self.imap, self.credentials = imap, credentials
+        return imap
+
+    def _keepalive(self):
+        if self.imap:
+            try:
+                self.imap.noop()
+                self.imap.untagged_responses.clear()
+            except Exception:
+                self.close()
+
+    def close(self):
+        imap, self.imap = self.imap, None
+        if imap:
+            try:
+                imap.logout()
+            except Exception:
+                pass
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""In-process metrics of the proxy, served in Prometheus text format.
+
+Engines and handlers record into the global ``METRICS``; the totals in the
+database are still kept by ``DBManager``, these are only for the current
+run of the proxy.
+"""
+import bisect
+import http.server
+import re
+import socketserver
+import threading
+import urllib.request
+
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                   10, 30, 60)
+LOOP_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                0.01, 0.025, 0.05, 0.1)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield '{}_bucket{{{},le="{}"}} {}'.format(
+                name, labels, bound, total)
+        yield '{}_sum{{{}}} {}'.format(name, labels, self.sum)
+        yield '{}_count{{{}}} {}'.format(name, labels, total)
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (protocol, command) -> Histogram
+        self.commands = {}
+        # protocol -> Histogram
+        self.loops = {}
+        # (protocol, side, direction) -> bytes
+        self.bytes = {}
+        # protocol -> [active, total]
+        self.connections = {}
+        # protocol -> messages
+        self.messages = {}
+        # protocol -> log records dropped
+        self.dropped = {}
+        # traffic class -> [upstream bytes, seconds waited]
+        self.traffic = {}
+        # (queued, failed, creation time of the oldest queued) of the spool
+        self.spooled = None
+
+    def connected(self, protocol, delta):
+        """Count a connection opened (``delta=1``) or closed (``-1``)."""
+        with self.lock:
+            conns = self.connections.setdefault(protocol, [0, 0])
+            conns[0] += delta
+            if delta > 0:
+                conns[1] += delta
+
+    def command(self, protocol, command, seconds):
+        """Record the upstream round trip time of a client command."""
+        with self.lock:
+            hist = self.commands.get((protocol, command))
+            if hist is None:
+                hist = self.commands[(protocol, command)] = Histogram(
+                    LATENCY_BUCKETS)
+            hist.observe(seconds)
+
+    def relayed(self, protocol, side, received, sent, seconds):
+        """Record one iteration of a relay loop.
+
+        ``received`` bytes were read from ``side``, before any rewriting,
+        and ``sent`` is a ``(to client, to server)`` pair of the bytes
+        written after it, ``seconds`` is the time it took.
+        """
+        with self.lock:
+            hist = self.loops.get(protocol)
+            if hist is None:
+                hist = self.loops[protocol] = Histogram(LOOP_BUCKETS)
+            hist.observe(seconds)
+            b = self.bytes
+            for key, amount in (((protocol, side, 'in'), received),
+                                ((protocol, 'client', 'out'), sent[0]),
+                                ((protocol, 'server', 'out'), sent[1])):
+                if amount:
+                    b[key] = b.get(key, 0) + amount
+
+    def scheduled(self, klass, size, wait):
+        """Record ``size`` upstream bytes of a traffic class and the
+        seconds its session then waited, see TrafficScheduler."""
+        with self.lock:
+            traffic = self.traffic.setdefault(klass, [0, 0])
+            traffic[0] += size
+            traffic[1] += wait
+
+    def log_dropped(self, protocol):
+        with self.lock:
+            self.dropped[protocol] = self.dropped.get(protocol, 0) + 1
+
+    def spool(self, queued, failed, oldest):
+        """Set the state of the SMTP spool."""
+        with self.lock:
+            self.spooled = (queued, failed, oldest)
+
+    def message(self, protocol):
+        """Count a message sent or received."""
+        with self.lock:
+            self.messages[protocol] = self.messages.get(protocol, 0) + 1
+
+    def render(self):
+        """Return all the metrics in Prometheus text format."""
+        lines = []
+        with self.lock:
+            lines.append('# HELP nauta_proxy_connections Connections being '
+                         'relayed.')
+            lines.append('# TYPE nauta_proxy_connections gauge')
+            for protocol, (active, total) in sorted(self.connections.items()):
+                lines.append('nauta_proxy_connections{{protocol="{}"}} '
+                             '{}'.format(protocol, active))
+            lines.append('# HELP nauta_proxy_connections_total Connections '
+                         'accepted.')
+            lines.append('# TYPE nauta_proxy_connections_total counter')
+            for protocol, (active, total) in sorted(self.connections.items()):
+                lines.append('nauta_proxy_connections_total{{protocol="{}"}} '
+                             '{}'.format(protocol, total))
+            lines.append('# HELP nauta_proxy_bytes_total Bytes read from '
+                         '(in) and written to (out) each side, before and '
+                         'after rewriting.')
+            lines.append('# TYPE nauta_proxy_bytes_total counter')
+            for (protocol, side, direction), amount in sorted(
+                    self.bytes.items()):
+                lines.append(
+                    'nauta_proxy_bytes_total{{protocol="{}",side="{}",'
+                    'direction="{}"}} {}'.format(
+                        protocol, side, direction, amount))
+            lines.append('# HELP nauta_proxy_messages_total Messages sent '
+                         '(SMTP) and received (IMAP).')
+            lines.append('# TYPE nauta_proxy_messages_total counter')
+            for protocol, count in sorted(self.messages.items()):
+                lines.append('nauta_proxy_messages_total{{protocol="{}"}} '
+                             '{}'.format(protocol, count))
+            lines.append('# HELP nauta_proxy_traffic_bytes_total Upstream '
+                         'bytes of each traffic class.')
+            lines.append('# TYPE nauta_proxy_traffic_bytes_total counter')
+            for klass, (size, wait) in sorted(self.traffic.items()):
+                lines.append('nauta_proxy_traffic_bytes_total{{class="{}"}} '
+                             '{}'.format(klass, size))
+            lines.append('# HELP nauta_proxy_traffic_wait_seconds_total Time '
+                         'the sessions of each traffic class were held back.')
+            lines.append('# TYPE nauta_proxy_traffic_wait_seconds_total '
+                         'counter')
+            for klass, (size, wait) in sorted(self.traffic.items()):
+                lines.append('nauta_proxy_traffic_wait_seconds_total'
+                             '{{class="{}"}} {}'.format(klass, wait))
+            lines.append('# HELP nauta_proxy_log_dropped_total Log records '
+                         'dropped because the log writer was behind.')
+            lines.append('# TYPE nauta_proxy_log_dropped_total counter')
+            for protocol, count in sorted(self.dropped.items()):
+                lines.append('nauta_proxy_log_dropped_total{{protocol="{}"}} '
+                             '{}'.format(protocol, count))
+            if self.spooled:
+                queued, failed, oldest = self.spooled
+                lines.append('# HELP nauta_proxy_spool_messages Sent '
+                             'messages waiting in the spool.')
+                lines.append('# TYPE nauta_proxy_spool_messages gauge')
+                lines.append('nauta_proxy_spool_messages{{state="queued"}} '
+                             '{}'.format(queued))
+                lines.append('nauta_proxy_spool_messages{{state="failed"}} '
+                             '{}'.format(failed))
+                if oldest:
+                    lines.append('# HELP nauta_proxy_spool_oldest_timestamp_'
+                                 'seconds Time the oldest message in the '
+                                 'spool was accepted.')
+                    lines.append('# TYPE nauta_proxy_spool_oldest_timestamp_'
+                                 'seconds gauge')
+                    lines.append('nauta_proxy_spool_oldest_timestamp_seconds'
+                                 '{{}} {}'.format(oldest))
+            lines.append('# HELP nauta_proxy_command_seconds Time from '
+                         'forwarding a client command to the server '
+                         'completing its response.')
+            lines.append('# TYPE nauta_proxy_command_seconds histogram')
+            for (protocol, command), hist in sorted(self.commands.items()):
+                lines.extend(hist.samples(
+                    'nauta_proxy_command_seconds',
+                    'protocol="{}",command="{}"'.format(protocol, command)))
+            lines.append('# HELP nauta_proxy_relay_seconds Time spent '
+                         'handling and forwarding each chunk read.')
+            lines.append('# TYPE nauta_proxy_relay_seconds histogram')
+            for protocol, hist in sorted(self.loops.items()):
+                lines.extend(hist.samples(
+                    'nauta_proxy_relay_seconds',
+                    'protocol="{}"'.format(protocol)))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def serve_metrics(port):
+    """Serve ``/metrics`` on localhost from a background thread."""
+    server = MetricsServer(('127.0.0.1', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+sample = re.compile(r'^([a-z_]+)\{(.*)\} (\S+)$')
+
+
+def scrape(port, timeout=2):
+    """Return the metrics of a running proxy as ``{(name, labels): value}``.
+
+    ``labels`` is a tuple of ``(label, value)`` pairs in their original
+    order.
+    """
+    url = 'http://127.0.0.1:{}/metrics'.format(port)
+    with urllib.request.urlopen(url, timeout=timeout) as resp:
+        return parse(resp.read().decode())
+
+
+def parse(text):
+    """Parse metrics in Prometheus text format, see :func:`scrape`."""
+    samples = {}
+    for line in text.splitlines():
+        m = sample.match(line)
+        if m:
+            labels = tuple(re.findall(r'([a-z]+)="([^"]*)"', m[2]))
+            samples[(m[1], labels)] = float(m[3])
+    return samples
+
+
+def quantile(samples, name, labels, q):
+    """Upper bound of the bucket of a histogram holding the ``q`` quantile."""
+    buckets = sorted(
+        (float(dict(key[1])['le']), value) for key, value in samples.items()
+        if key[0] == name + '_bucket' and key[1][:-1] == labels)
+    if not buckets or not buckets[-1][1]:
+        return None
+    for bound, count in buckets:
+        if count >= q*buckets[-1][1]:
+            return bound
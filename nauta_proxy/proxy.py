@@ -1,245 +1,3051 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import atexit
+import base64
+import binascii
+import concurrent.futures
 import logging
 import logging.handlers
 import os
+import queue
 import re
+import select
 import socket
 import socketserver
 import selectors
+import threading
 import time
+import zlib
 
+from .index import FlagsFetch, in_ranges, uid_ranges, uid_set
+from .metrics import METRICS
+from .trace import (FROM_CLIENT, FROM_SERVER, TO_CLIENT, TO_SERVER,
+                    TraceWriter, traces_dir)
 
 IMAP_SERVER = ('imap.nauta.cu', 143)
 SMTP_SERVER = ('smtp.nauta.cu', 25)
 
 
-class Proxy(socketserver.ThreadingTCPServer):
-    allow_reuse_address = True
-    daemon_threads = True
+TRACE = 5
+logging.addLevelName(TRACE, 'TRACE')
+LOG_LEVELS = {'trace': TRACE, 'debug': logging.DEBUG, 'info': logging.INFO,
+              'warning': logging.WARNING}
+
+
+class QueueLogHandler(logging.handlers.QueueHandler):
+    """Pass records to the writer thread without formatting them.
+
+    The queue is bounded, records that don't fit are dropped and counted,
+    so a slow terminal or disk never blocks the relay.
+    """
+
+    def __init__(self, protocol, size=1024*10):
+        super().__init__(queue.Queue(size))
+        self.protocol = protocol
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': record.name, 'levelno': logging.WARNING,
+                    'levelname': 'WARNING', 'args': (self.dropped,),
+                    'msg': '%i log messages dropped'}))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            METRICS.log_dropped(self.protocol)
 
-    def __init__(self, port, handler, db):
-        self.db = db
-        self.loggerC, self.loggerF = self._init_loggers(handler.protocol)
 
-        super().__init__(('', port), handler)
+class ChunkLog:
+    """A relayed chunk, only formatted if the record gets written."""
+    __slots__ = ('protocol', 'source', 'dump', 'received', 'total')
+
+    def __init__(self, protocol, source, dump, received, total):
+        self.protocol = protocol
+        self.source = source
+        self.dump = dump
+        self.received = received
+        self.total = total
+
+    def __str__(self):
+        text = '{} wrote:\n'.format(self.source)
+        if self.dump is not None:
+            text += '{}\n'.format(self.dump)
+            if len(self.dump) < self.received:
+                text += '(+{:,} Bytes)\n'.format(
+                    self.received - len(self.dump))
+        return text + '{:,} Bytes\n{} Total: {:,} Bytes'.format(
+            self.received, self.protocol, self.total)
+
+
+class ProxyLogger:
+    """Logging of the proxies, written by a background thread.
+
+    The console shows the records of the ``loglevel`` setting and up, with
+    ``savelog`` everything is also saved to ``~/PROTOCOL.log``, including
+    the first ``max_dump`` bytes of every relayed chunk.
+    """
+    max_dump = 1024
 
     def exception(self, ex):
-        self.loggerC.exception(ex)
-        if self.db.get_savelog():
-            self.loggerF.exception(ex)
+        self.logger.exception(ex)
 
-    def log(self, msg):
-        self.loggerC.debug(msg)
-        if self.db.get_savelog():
-            self.loggerF.debug(msg)
+    def log(self, msg, *args):
+        self.logger.info(msg, *args)
 
-    def debug(self, msg):
-        if self.db.get_savelog():
-            self.loggerC.debug(msg)
-            self.loggerF.debug(msg)
+    def debug(self, msg, *args):
+        self.logger.debug(msg, *args)
+
+    def logs_chunks(self):
+        """Whether relayed chunks are logged, checked before building them."""
+        return self.db.get_savelog() or \
+            LOG_LEVELS[self.db.get_loglevel()] <= TRACE
+
+    def log_chunk(self, protocol, source, data, received, total):
+        dump = None
+        if data is not None and self.db.get_savelog():
+            dump = bytes(data[:self.max_dump])
+        self.logger.log(TRACE, ChunkLog(
+            protocol, source, dump, received, total))
 
     def _init_loggers(self, protocol):
-        loggerC = logging.Logger(protocol)
-        loggerC.parent = None
-        formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(message)s')
+        db = self.db
         chandler = logging.StreamHandler()
-        chandler.setLevel(logging.DEBUG)
-        chandler.setFormatter(formatter)
-        loggerC.addHandler(chandler)
-
-        loggerF = logging.Logger(protocol)
-        loggerF.parent = None
-        formatter = logging.Formatter(
-            '%(asctime)s - %(message)s')
+        chandler.setFormatter(logging.Formatter(
+            '%(asctime)s - %(name)s - %(message)s'))
+        chandler.addFilter(
+            lambda record: record.levelno >= LOG_LEVELS[db.get_loglevel()])
+
         log_path = os.path.join(os.path.expanduser('~'), protocol+'.log')
         fhandler = logging.handlers.RotatingFileHandler(
-            log_path, backupCount=2, maxBytes=10000000)
-        fhandler.setLevel(logging.DEBUG)
-        fhandler.setFormatter(formatter)
-        loggerF.addHandler(fhandler)
+            log_path, backupCount=2, maxBytes=10000000, delay=True)
+        fhandler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+        fhandler.addFilter(lambda record: db.get_savelog())
+
+        handler = QueueLogHandler(protocol)
+        listener = logging.handlers.QueueListener(
+            handler.queue, chandler, fhandler)
+        listener.start()
+        atexit.register(listener.stop)
+        logger = logging.Logger(protocol, TRACE)
+        logger.parent = None
+        logger.addHandler(handler)
+        return logger
+
+
+IOV_MAX = 1024
+PIPE_SIZE = 1024*64
+NEWLINE = re.compile(rb'\n')
+CLIENT, SERVER = 'client', 'server'
+
+
+class RelayBuffer:
+    """Preallocated receive buffer reused for every read of one direction.
+
+    ``recv()`` returns a memoryview of the received bytes, which is only
+    valid until the next read, so everything queued by the handler must be
+    sent before reading again.
+    """
+
+    def __init__(self, size):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+
+    def recv(self, sock):
+        return self.view[:sock.recv_into(self.buf)]
+
+
+def _advance(views, sent):
+    while sent:
+        if sent < len(views[0]):
+            views[0] = views[0][sent:]
+            break
+        sent -= len(views.pop(0))
+    return views
+
+
+def sendmsg_all(sock, chunks):
+    """Send all chunks with a single scatter/gather call when possible."""
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(chunks))
+        return
+    views = [memoryview(c) for c in chunks if len(c)]
+    while views:
+        _advance(views, sock.sendmsg(views[:IOV_MAX]))
+
+
+def set_nodelay(sock):
+    """Disable Nagle's algorithm, so a command written right after another
+    one isn't held until the first is acknowledged."""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+async def _ready(loop, fd, write=False):
+    fut = loop.create_future()
+    add, remove = loop.add_reader, loop.remove_reader
+    if write:
+        add, remove = loop.add_writer, loop.remove_writer
+    add(fd, lambda: fut.done() or fut.set_result(None))
+    try:
+        await fut
+    finally:
+        remove(fd)
+
+
+async def sock_sendmsg(loop, sock, chunks):
+    """Like ``sendmsg_all()`` for a non-blocking socket."""
+    views = [memoryview(c) for c in chunks if len(c)]
+    while views:
+        try:
+            _advance(views, sock.sendmsg(views[:IOV_MAX]))
+        except (BlockingIOError, InterruptedError):
+            await _ready(loop, sock.fileno(), write=True)
+
+
+def splice(src, dst, size, pipe):
+    """Move up to ``size`` bytes from ``src`` to ``dst`` inside the kernel.
 
-        return (loggerC, loggerF)
+    Returns the amount of bytes moved, 0 on EOF. The pipe is filled without
+    blocking, it holds a limited number of segments and is only drained
+    after the read.
+    """
+    try:
+        size = os.splice(src.fileno(), pipe[1], min(size, PIPE_SIZE),
+                         flags=os.SPLICE_F_NONBLOCK)
+    except (BlockingIOError, InterruptedError):
+        return None
+    left = size
+    while left:
+        left -= os.splice(pipe[0], dst.fileno(), left)
+    return size
 
 
-class RequestHandler(socketserver.BaseRequestHandler):
+async def sock_splice(loop, src, dst, size, pipe, lock):
+    """Like ``splice()`` for non-blocking sockets."""
+    while True:
+        try:
+            size = os.splice(src.fileno(), pipe[1], min(size, PIPE_SIZE),
+                             flags=os.SPLICE_F_NONBLOCK)
+            break
+        except (BlockingIOError, InterruptedError):
+            await _ready(loop, src.fileno())
+    left = size
+    async with lock:
+        while left:
+            try:
+                left -= os.splice(pipe[0], dst.fileno(), left)
+            except (BlockingIOError, InterruptedError):
+                await _ready(loop, dst.fileno(), write=True)
+    return size
+
+
+class UpstreamPool:
+    """Keep ``size`` connections to ``address`` open and greeted.
+
+    A background thread connects and reads the server greeting ahead of
+    time, so a new session only has to replay the greeting to its client.
+    The pool is only filled for ``window`` seconds after a session took a
+    connection from it, so an idle proxy doesn't keep reconnecting. Idle
+    connections older than ``max_age`` seconds, or that became readable
+    (closed or timed out by the server), are closed with ``goodbye`` and
+    the bytes they used are passed to ``count``.
+    """
+
+    def __init__(self, address, size, goodbye=b'', count=None, max_age=60,
+                 window=120):
+        self.address = address
+        self.size = size
+        self.goodbye = goodbye
+        self.count = count
+        self.max_age = max_age
+        self.window = window
+        self.used = None
+        self.idle = []
+        self.cond = threading.Condition()
+        if size:
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def get(self):
+        """Return ``(sock, greeting)``, or ``(None, b'')`` if none is ready."""
+        with self.cond:
+            self.used = time.monotonic()
+            self.cond.notify()
+            # the dead ones are closed by the background thread
+            for conn in reversed(self.idle):
+                if self._alive(conn[0], conn[2]):
+                    self.idle.remove(conn)
+                    return conn[0], conn[1]
+        return None, b''
+
+    def _alive(self, sock, created):
+        if time.monotonic() - created > self.max_age:
+            return False
+        try:
+            return not select.select([sock], [], [], 0)[0]
+        except (OSError, ValueError):
+            return False
+
+    def _run(self):
+        delay = 1
+        while True:
+            with self.cond:
+                dead = [conn for conn in self.idle
+                        if not self._alive(conn[0], conn[2])]
+                for conn in dead:
+                    self.idle.remove(conn)
+                missing = 0
+                if self.used is not None and \
+                        time.monotonic() - self.used < self.window:
+                    missing = self.size - len(self.idle)
+                if not (dead or missing):
+                    self.cond.wait(self.max_age/4)
+                    continue
+            for conn in dead:
+                self._close(*conn[:2])
+            if not missing:
+                continue
+            try:
+                conn = self._connect()
+                delay = 1
+            except OSError:
+                time.sleep(delay)
+                delay = min(delay*2, 60)
+                continue
+            with self.cond:
+                self.idle.append(conn)
+
+    def _connect(self):
+        sock = socket.create_connection(self.address, timeout=30)
+        try:
+            set_nodelay(sock)
+            greeting = b''
+            while not greeting.endswith(b'\r\n') or \
+                    greeting.rsplit(b'\r\n', 2)[-2][3:4] == b'-':
+                data = sock.recv(1024)
+                if not data:
+                    raise ConnectionError('connection closed by server')
+                greeting += data
+            sock.settimeout(None)
+        except BaseException:
+            sock.close()
+            raise
+        return sock, greeting, time.monotonic()
+
+    def _close(self, sock, greeting):
+        """Log out of an unused connection, until the server closes it."""
+        size = len(greeting)
+        try:
+            sock.settimeout(5)
+            if self.goodbye:
+                sock.sendall(self.goodbye)
+                size += len(self.goodbye)
+            while True:
+                data = sock.recv(1024)
+                if not data:
+                    break
+                size += len(data)
+        except OSError:
+            pass
+        finally:
+            sock.close()
+        if self.count:
+            self.count(size)
+
+
+INTERACTIVE, MESSAGE, BULK = range(3)
+TRAFFIC_CLASSES = ('interactive', 'message', 'bulk')
+
+
+class TrafficScheduler:
+    """Share the upstream link between the sessions of all the proxies.
+
+    Handlers class the data they relay as INTERACTIVE (commands, replies
+    and notifications), MESSAGE (small message bodies) or BULK (big
+    messages and attachments). Each class has a rate cap, and with
+    ``priority`` a session moving data less than ``hold`` seconds after
+    another one moved data of a higher class goes at most at ``background``
+    bytes/s, so bulk transfers go on without filling the link while chat
+    traffic flows. Engines wait the seconds returned by ``delay()`` before
+    reading again from that session, and the kernel buffers of upstream
+    sockets are kept to ``window`` bytes, so the server or client sending
+    to it is soon held back too.
+    """
+    hold = 0.1
+    background = 1024*32
+    window = 1024*32
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # time each class is back under its cap, (time, handler) of the
+        # last data of each class
+        self.free = [0.0]*len(TRAFFIC_CLASSES)
+        self.active = [(0.0, None)]*len(TRAFFIC_CLASSES)
+
+    def delay(self, handler, side, size):
+        """Count ``size`` upstream bytes relayed by ``handler`` from
+        ``side``, return the seconds to wait."""
+        klass = handler.traffic(side)
+        rates = handler.db.get_rates()
+        priority = handler.db.get_priority()
+        if not size or not (priority or any(rates)):
+            return 0
+        wait = 0
+        now = time.monotonic()
+        with self.lock:
+            if rates[klass]:
+                self.free[klass] = max(self.free[klass], now) + \
+                    size/rates[klass]
+                wait = self.free[klass] - now
+            if priority and any(now - active < self.hold and other != handler
+                                for active, other in self.active[:klass]):
+                wait = max(wait, size/self.background)
+            self.active[klass] = (now, handler)
+        METRICS.scheduled(TRAFFIC_CLASSES[klass], size, wait)
+        return wait
+
+    def setup(self, db, sock):
+        """Bound the kernel buffers of an upstream socket, with priority."""
+        if db.get_priority():
+            for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+                sock.setsockopt(socket.SOL_SOCKET, option, self.window)
+
+
+SCHEDULER = TrafficScheduler()
+
+
+class ProxySessions:
+    """Sessions being relayed by an engine, so they can be stopped.
+
+    ``sessions`` maps the handler of each session to its client socket.
+    """
+
+    def close_sessions(self, idle_only=False):
+        """Close the sessions, with ``idle_only`` only those between commands.
+
+        Can be called from any thread, the engines see the client side
+        closed and end the session as usual. Returns the number of sessions
+        that were still open.
+        """
+        sessions = list(self.sessions.items())
+        for handler, sock in sessions:
+            if not idle_only or handler.idle():
+                try:
+                    sock.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+        return len(sessions)
+
+    def stop(self):
+        """Called once the sessions are closed after ``stop_accepting()``."""
+
+
+class Proxy(ProxySessions, ProxyLogger, socketserver.ThreadingTCPServer):
+    """Legacy engine: one thread and one selector per connection."""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port, handler, db, pool=0):
+        self.db = db
+        self.handler = handler
+        self.pool = UpstreamPool(
+            handler.real_server, pool, handler.goodbye,
+            getattr(db, 'add_' + handler.protocol.lower()))
+        self.logger = self._init_loggers(handler.protocol)
+        self.sessions = {}
 
-    def setup(self):
-        if self.server.db.get_stop():
-            self.server.log('Stopping Server...')
-            self.server.server_close()
-            self.server.shutdown()
+        super().__init__(('', port), ThreadedRelay)
+
+    def stop_accepting(self):
+        """Close the listening socket, the sessions go on."""
+        self.log('Stopping Server...')
+        self.shutdown()
+        self.server_close()
+
+
+class ThreadedRelay(socketserver.BaseRequestHandler):
 
     def handle(self):
-        self.server.log('{} CONNECTED'.format(self.client_address))
+        self.server.log('%s CONNECTED', self.client_address)
+        handler = self.server.handler(self.server, self.client_address)
+        self.server.sessions[handler] = self.request
+        METRICS.connected(handler.protocol, 1)
+        set_nodelay(self.request)
         sel = selectors.DefaultSelector()
-        sel.register(self.request, selectors.EVENT_READ, self.client_address)
+        sel.register(self.request, selectors.EVENT_READ,
+                     RelayBuffer(handler.bufsize))
         try:
-            with socket.create_connection(self.real_server) as sock:
-                forward = {self.request: sock, sock: self.request}
-                sel.register(sock, selectors.EVENT_READ, self.real_server)
-                self._handle(self.server.db, self.server.log, sel, forward)
+            if handler.local:
+                self._flush(handler, None)
+                self._handle(handler, sel, None)
+                return
+            sock, greeting = self.server.pool.get()
+            if sock is None:
+                sock = socket.create_connection(handler.real_server)
+                set_nodelay(sock)
+            SCHEDULER.setup(self.server.db, sock)
+            with sock:
+                sel.register(sock, selectors.EVENT_READ,
+                             RelayBuffer(handler.bufsize))
+                if greeting:
+                    handler.feed_server(greeting)
+                    self._flush(handler, sock)
+                self._handle(handler, sel, sock)
         except Exception as ex:
             self.server.exception(ex)
             time.sleep(30)
         finally:
+            handler.close()
+            METRICS.connected(handler.protocol, -1)
+            self.server.sessions.pop(handler, None)
             self.server.log('CLOSING CONNECTION.')
 
-    def _handle(self, db, log, sel, forward):
-        pass
+    def _handle(self, handler, sel, sock):
+        pipe = os.pipe() if handler.can_splice else None
+        try:
+            while True:
+                for key, mask in sel.select():
+                    if not self._relay(handler, key, sock, pipe):
+                        return
+        finally:
+            if pipe:
+                os.close(pipe[0])
+                os.close(pipe[1])
+
+    def _relay(self, handler, key, sock, pipe):
+        start = time.perf_counter()
+        if key.fileobj is sock:
+            side, dst = SERVER, self.request
+        else:
+            side, dst = CLIENT, sock
+        size = handler.passthrough(side) if pipe else 0
+        if size:
+            size = splice(key.fileobj, dst, size, pipe)
+            if size is None:
+                return True
+            if size:
+                handler.spliced(side, size)
+                METRICS.relayed(handler.protocol, side, size,
+                                (0, size) if side == CLIENT else (size, 0),
+                                time.perf_counter() - start)
+                self._schedule(handler, side, size)
+                return True
+            data = key.data.view[:0]
+        else:
+            data = key.data.recv(key.fileobj)
+        if side == SERVER:
+            handler.feed_server(data)
+        else:
+            handler.feed_client(data)
+        sent = self._flush(handler, sock)
+        while handler.pending:
+            concurrent.futures.wait((handler.pending[0],))
+            handler.resume()
+            more = self._flush(handler, sock)
+            sent = [sent[0] + more[0], sent[1] + more[1]]
+        METRICS.relayed(handler.protocol, side, len(data), sent,
+                        time.perf_counter() - start)
+        if not data or handler.closing:
+            self.request.close()
+            return False
+        self._schedule(handler, side, sent[1] + (
+            len(data) if side == SERVER else 0))
+        return True
+
+    def _schedule(self, handler, side, size):
+        wait = SCHEDULER.delay(handler, side, size)
+        if wait:
+            time.sleep(wait)
+
+    def _flush(self, handler, sock):
+        """Send the queued data, return the bytes sent to each side."""
+        sent = [0, 0]
+        if handler.client_out:
+            sent[0] = sum(map(len, handler.client_out))
+            sendmsg_all(self.request, handler.client_out)
+            handler.client_out.clear()
+        if handler.server_out:
+            sent[1] = sum(map(len, handler.server_out))
+            sendmsg_all(sock, handler.server_out)
+            handler.server_out.clear()
+        return sent
+
+
+class AsyncProxy(ProxySessions, ProxyLogger):
+    """Asyncio engine: all connections of all ports share one event loop."""
+
+    def __init__(self, port, handler, db, pool=0):
+        self.db = db
+        self.port = port
+        self.handler = handler
+        self.pool = UpstreamPool(
+            handler.real_server, pool, handler.goodbye,
+            getattr(db, 'add_' + handler.protocol.lower()))
+        self.sock = None
+        self.loop = None
+        self.logger = self._init_loggers(handler.protocol)
+        self.sessions = {}
+        self._serving = None
+
+    async def start(self):
+        self.loop = asyncio.get_event_loop()
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('', self.port))
+        self.sock.listen(socket.SOMAXCONN)
+        self.sock.setblocking(False)
+        self._serving = asyncio.ensure_future(self._serve())
+
+    def server_close(self):
+        if self.sock:
+            self.sock.close()
+
+    async def _stop_accepting(self):
+        self._serving.cancel()
+        self.server_close()
+
+    def stop_accepting(self):
+        """Close the listening socket, the sessions go on.
+
+        Must be called from another thread than the one of the loop.
+        """
+        self.log('Stopping Server...')
+        asyncio.run_coroutine_threadsafe(
+            self._stop_accepting(), self.loop).result()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def _serve(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            conn, client_address = await loop.sock_accept(self.sock)
+            conn.setblocking(False)
+            set_nodelay(conn)
+            asyncio.ensure_future(self._accept(conn, client_address))
+
+    async def _accept(self, conn, client_address):
+        loop = asyncio.get_event_loop()
+        self.log('%s CONNECTED', client_address)
+        handler = self.handler(self, client_address)
+        self.sessions[handler] = conn
+        METRICS.connected(handler.protocol, 1)
+        if handler.local:
+            sock, greeting = None, None
+        else:
+            sock, greeting = self.pool.get()
+            if sock is None:
+                sock = socket.socket()
+                set_nodelay(sock)
+            SCHEDULER.setup(self.db, sock)
+            sock.setblocking(False)
+        try:
+            if sock and not greeting:
+                await loop.sock_connect(sock, handler.real_server)
+            socks = {CLIENT: conn, SERVER: sock}
+            locks = {CLIENT: asyncio.Lock(), SERVER: asyncio.Lock()}
+            if greeting:
+                handler.feed_server(greeting)
+            await self._flush(loop, handler, socks, locks)
+            pumps = [asyncio.ensure_future(self._pump(
+                side, handler, socks, locks))
+                for side in (CLIENT, SERVER) if socks[side]]
+            try:
+                done, pending = await asyncio.wait(
+                    pumps, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for task in pumps:
+                    task.cancel()
+                # a cancelled pump must let go of the sockets before they
+                # are closed, their numbers are reused by new sessions
+                await asyncio.gather(*pumps, return_exceptions=True)
+            for task in done:
+                task.result()
+        except Exception as ex:
+            self.exception(ex)
+            await asyncio.sleep(30)
+        finally:
+            handler.close()
+            METRICS.connected(handler.protocol, -1)
+            self.sessions.pop(handler, None)
+            for s in (conn, sock):
+                if s is not None and s.fileno() != -1:
+                    loop.remove_reader(s.fileno())
+                    loop.remove_writer(s.fileno())
+                    s.close()
+            self.log('CLOSING CONNECTION.')
+
+    async def _pump(self, side, handler, socks, locks):
+        loop = asyncio.get_event_loop()
+        buf = RelayBuffer(handler.bufsize)
+        if side == SERVER:
+            src, dst, feed = socks[SERVER], CLIENT, handler.feed_server
+        else:
+            src, dst, feed = socks[CLIENT], SERVER, handler.feed_client
+        pipe = os.pipe() if handler.can_splice else None
+        try:
+            while True:
+                size = handler.passthrough(side) if pipe else 0
+                if size:
+                    start = time.perf_counter()
+                    size = await sock_splice(
+                        loop, src, socks[dst], size, pipe, locks[dst])
+                    if size:
+                        handler.spliced(side, size)
+                        METRICS.relayed(
+                            handler.protocol, side, size,
+                            (0, size) if side == CLIENT else (size, 0),
+                            time.perf_counter() - start)
+                        await self._schedule(handler, side, size)
+                        continue
+                    n = 0
+                else:
+                    n = await loop.sock_recv_into(src, buf.buf)
+                start = time.perf_counter()
+                feed(buf.view[:n])
+                sent = await self._flush(loop, handler, socks, locks)
+                while handler.pending:
+                    await asyncio.wait(
+                        (asyncio.wrap_future(handler.pending[0]),))
+                    handler.resume()
+                    more = await self._flush(loop, handler, socks, locks)
+                    sent = [sent[0] + more[0], sent[1] + more[1]]
+                METRICS.relayed(handler.protocol, side, n, sent,
+                                time.perf_counter() - start)
+                if not n or handler.closing:
+                    return
+                await self._schedule(
+                    handler, side, sent[1] + (n if side == SERVER else 0))
+        finally:
+            if pipe:
+                os.close(pipe[0])
+                os.close(pipe[1])
+
+    async def _schedule(self, handler, side, size):
+        wait = SCHEDULER.delay(handler, side, size)
+        if wait:
+            await asyncio.sleep(wait)
+
+    async def _flush(self, loop, handler, socks, locks):
+        """Send the queued data, return the bytes sent to each side."""
+        sent = [0, 0]
+        for i, side, out in ((0, CLIENT, handler.client_out),
+                             (1, SERVER, handler.server_out)):
+            if out:
+                chunks = out[:]
+                out.clear()
+                sent[i] = sum(map(len, chunks))
+                async with locks[side]:
+                    await sock_sendmsg(loop, socks[side], chunks)
+        return sent
+
+
+def serve_async(proxies):
+    """Serve all the given AsyncProxy on a single event loop.
+
+    Returns after ``stop()`` is called on any of them.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        for proxy in proxies:
+            loop.run_until_complete(proxy.start())
+            proxy.log('Proxy Started')
+        loop.run_forever()
+    finally:
+        for proxy in proxies:
+            proxy.server_close()
+        loop.close()
+
+
+class RequestHandler:
+    """Protocol state of a single proxied session, independent of the engine.
+
+    Engines feed the bytes read from each side with ``feed_client()`` and
+    ``feed_server()`` (an empty chunk means EOF) and then send everything
+    queued in ``client_out`` and ``server_out``. Sessions with ``local`` set
+    are answered by the handler and engines don't connect to the server.
+    """
+    protocol = None
+    real_server = None
+    bufsize = 1024*4
+    can_splice = False
+    local = False
+    # message bodies from this size are BULK traffic
+    bulk_size = 1024*64
+    # sent to close an unused connection to the server
+    goodbye = b''
+
+    def __init__(self, server, client_address):
+        self.server = server
+        self.db = server.db
+        self.client_address = client_address
+        self.client_out = []
+        self.server_out = []
+        self.closing = False
+        # (future, callback) the session waits for, see resume()
+        self.pending = None
+        self.trace = None
+        if self.db.get_capture():
+            self._start_trace()
+
+    def _start_trace(self):
+        """Save the session to a trace file, see :mod:`nauta_proxy.trace`."""
+        path = traces_dir()
+        os.makedirs(path, exist_ok=True)
+        path = os.path.join(path, '{}-{}-{}.trace'.format(
+            self.protocol.lower(), time.strftime('%Y%m%d-%H%M%S'),
+            self.client_address[1]))
+        header = {'protocol': self.protocol, 'mode': self.db.get_optimize(),
+                  'rules': self.db.get_header_rules()}
+        self.trace = TraceWriter(path, header, self.redact)
+
+        def traced(direction, feed):
+            def _feed(data):
+                self.trace.write(direction, data)
+                queued = len(self.client_out), len(self.server_out)
+                feed(data)
+                for to, out, n in ((TO_CLIENT, self.client_out, queued[0]),
+                                   (TO_SERVER, self.server_out, queued[1])):
+                    size = sum(len(chunk) for chunk in out[n:])
+                    if size:
+                        self.trace.write(to, size=size)
+            return _feed
+        self.feed_client = traced(FROM_CLIENT, self.feed_client)
+        self.feed_server = traced(FROM_SERVER, self.feed_server)
+
+    def close(self):
+        """Called by the engines when the session is over."""
+        if self.trace:
+            self.trace.close()
+
+    def feed_client(self, data):
+        self.to_server(data)
+
+    def feed_server(self, data):
+        self.to_client(data)
+
+    def resume(self):
+        """Called by the engines once the future in ``pending`` is done.
+
+        Nothing is fed to a handler with ``pending`` set, the callback gets
+        the future and may set ``pending`` again.
+        """
+        (future, callback), self.pending = self.pending, None
+        callback(future)
+
+    def traffic(self, side):
+        """Class of the data just relayed from ``side``, see
+        TrafficScheduler."""
+        return INTERACTIVE
+
+    def body_traffic(self, size):
+        """Class of the data of a message body of ``size`` bytes."""
+        return BULK if size >= self.bulk_size else MESSAGE
+
+    def to_client(self, data):
+        self._forward(self.real_server, data)
+        self.client_out.append(data)
+
+    def to_server(self, data):
+        self._forward(self.client_address, data)
+        self.server_out.append(data)
+
+    def passthrough(self, side):
+        """Amount of bytes from ``side`` that can skip the handler.
+
+        Engines may move those bytes with ``splice()`` and then report them
+        with ``spliced()`` instead of calling ``feed_*()``. It is 0 while
+        logs are being saved or the session captured, so that every byte
+        gets logged.
+        """
+        return 0
+
+    def idle(self):
+        """Whether the session is between commands and can be closed."""
+        return True
+
+    def redact(self, data):
+        """Hide the credentials sent by the client from the session trace.
+
+        The result must have the same length as ``data``.
+        """
+        return data
+
+    def spliced(self, side, size):
+        source = self.real_server if side == SERVER else self.client_address
+        self._forward(source, None, size)
+
+    def count(self, received):
+        return received
+
+    def _forward(self, source, data, received=None):
+        if received is None:
+            received = len(data)
+        total = self.count(received)
+        if self.server.logs_chunks():
+            self.server.log_chunk(
+                self.protocol, source, data, received, total)
+
+
+class SmtpDataFilter:
+    """Filter the header block of a message in the SMTP DATA phase.
+
+    The header is parsed line by line across any number of chunks: fields
+    named in ``drop`` are removed and fields in ``rewrite`` are replaced by
+    the result of calling the given function with the whole (unfolded) field.
+    Once the blank line is seen the body is passed through untouched while
+    looking for the ``<CRLF>.<CRLF>`` terminator.
+    """
+
+    msg_end = re.compile(rb'\r\n\.\r\n')
+
+    def __init__(self, drop=(), rewrite=None):
+        self.drop = drop
+        self.rewrite = rewrite or {}
+        self.headers = True
+        self.line = b''
+        self.field = b''
+        self.tail = b'\r\n'
+
+    def feed(self, data):
+        """Return ``(output, rest)``.
+
+        ``rest`` is None while the message continues, otherwise it holds the
+        data received after the end of the message.
+        """
+        out = []
+        pos, end = 0, len(data)
+        while self.headers and pos < end:
+            m = NEWLINE.search(data, pos)
+            if not m:
+                self.line += data[pos:]
+                return out, None
+            i = m.start()
+            line = self.line + data[pos:i+1]
+            self.line = b''
+            pos = i + 1
+            if line[:1] in (b' ', b'\t'):  # folded line
+                self.field += line
+                continue
+            self._end_field(out)
+            if line == b'.\r\n':
+                out.append(line)
+                return out, data[pos:]
+            if line in (b'\r\n', b'\n'):
+                self.headers = False
+                out.append(line)
+            else:
+                self.field = line
+        if self.headers:
+            return out, None
+
+        i = (self.tail + bytes(data[pos:pos+4])).find(b'\r\n.\r\n')
+        if i != -1:
+            i += pos + 5 - len(self.tail)
+        else:
+            m = self.msg_end.search(data, pos)
+            i = m.end() if m else -1
+        if i != -1:
+            out.append(data[pos:i])
+            return out, data[i:]
+        self.tail = (self.tail + bytes(data[max(pos, end-4):]))[-4:]
+        out.append(data[pos:])
+        return out, None
+
+    def _end_field(self, out):
+        field, self.field = self.field, b''
+        if not field:
+            return
+        name = field.split(b':', 1)[0].strip().lower()
+        if name in self.drop:
+            return
+        if name in self.rewrite:
+            field = self.rewrite[name](field)
+        out.append(field)
+
+    def flush(self):
+        out = []
+        self._end_field(out)
+        out.append(self.line)
+        self.line = b''
+        return out
+
+
+class BdatWriter:
+    """Turn the DATA of a message into ``BDAT`` commands (RFC 3030).
+
+    ``feed()`` takes the message as sent after DATA (dot-stuffed, ending
+    in ``<CRLF>.<CRLF>``) in any number of pieces and returns the commands
+    to send, with their data, once ``size`` bytes are buffered; ``end()``
+    returns the ``BDAT ... LAST`` command with the rest of the message.
+    """
+    size = 1024*64
+
+    def __init__(self):
+        self.buf = bytearray()
+        # the data sent so far ends a line
+        self.bol = True
+
+    def feed(self, data):
+        self.buf += data
+        # keep the last line, it may be the final dot
+        if len(self.buf) < self.size + 3:
+            return []
+        chunk = self._unstuff(self.buf[:-3])
+        del self.buf[:-3]
+        return [b'BDAT %i\r\n' % len(chunk) + chunk]
+
+    def end(self, data=b''):
+        self.buf += data
+        chunk = self._unstuff(self.buf[:-3])
+        self.buf.clear()
+        return b'BDAT %i LAST\r\n' % len(chunk) + chunk
+
+    def _unstuff(self, data):
+        data = bytes(data)
+        bol, self.bol = self.bol, data.endswith(b'\n') or \
+            not data and self.bol
+        if bol and data.startswith(b'.'):
+            data = data[1:]
+        return data.replace(b'\n.', b'\n')
+
+
+def set_body(mail, body):
+    """Return the MAIL command with its BODY parameter set to ``body``."""
+    line = mail.rstrip(b'\r\n')
+    return re.sub(rb'(?i) BODY=\S*', b'', line) + b' BODY=' + body + \
+        mail[len(line):]
+
+
+class MimeTranscoder:
+    """Decode the base64 and quoted-printable parts of a message.
+
+    Works on the DATA of the message (dot-stuffed, ending in
+    ``<CRLF>.<CRLF>``) in any number of pieces, following the multipart
+    boundaries. The body of every leaf part with one of those encodings is
+    decoded line by line as it comes and held, up to ``max_part`` bytes,
+    and then sent decoded as ``8bit`` if it is valid 8bit data (no NUL, CR
+    and LF only together, lines of 998 bytes at most) or as ``binary`` if
+    ``binary`` is set. Without ``binary`` a part is passed through as soon
+    as a line of it isn't valid 8bit, so attachments are never held for
+    long. Everything else, including signed and encrypted parts, is passed
+    through unchanged. ``saved`` is the amount of bytes saved so far.
+    """
+    max_part = 1024*1024*4
+    boundary = re.compile(rb'(?i);\s*boundary\s*=\s*(?:"([^"]+)"|([^\s;]+))')
+    HEADER, PASS, HOLD, DONE = range(4)
+
+    def __init__(self, binary=False):
+        self.binary = binary
+        self.saved = 0
+        self.buf = bytearray()
+        self.state = self.HEADER
+        self.fields = []
+        # (delimiter, protected) of the enclosing bodies, innermost last
+        self.delimiters = [(b'\r\n.\r\n', False)]
+        # where to go on looking for the delimiter in a held body
+        self.scanned = 0
+
+    def feed(self, data):
+        self.buf += data
+        out = []
+        while self._step(out):
+            pass
+        return out
+
+    def end(self):
+        """Return what is still held, unchanged."""
+        out = list(self.fields)
+        self.fields = []
+        out.append(bytes(self.buf))
+        self.buf.clear()
+        self.state = self.DONE
+        return out
+
+    def _step(self, out):
+        if self.state == self.HEADER:
+            return self._header(out)
+        if self.state == self.DONE:
+            if self.buf:
+                out.append(bytes(self.buf))
+                self.buf.clear()
+            return False
+        delimiter = self.delimiters[-1][0]
+        start = self.scanned if self.state == self.HOLD else 0
+        while True:
+            i = self.buf.find(delimiter, start)
+            if i == -1:
+                break
+            end = self.buf.find(b'\n', i + len(delimiter) - 1)
+            if end == -1:
+                if len(self.buf) - i > 1000:
+                    start = i + 1  # too long to be a boundary line
+                    continue
+                break
+            rest = self.buf[i+len(delimiter):end+1]
+            if rest.startswith(b'--') or not rest.strip():
+                self._end_body(out, i)
+                self._delimiter(out, end + 1 - i, rest.startswith(b'--'))
+                return True
+            start = i + 1
+        if self.state == self.PASS:
+            keep = len(delimiter) + 1000
+            if len(self.buf) > keep:
+                out.append(bytes(self.buf[:-keep]))
+                del self.buf[:-keep]
+        else:
+            self.scanned = max(len(self.buf) - len(delimiter) - 1000, 0)
+            if len(self.buf) > self.max_part or \
+                    not self._decode_lines(self.scanned):
+                self._pass_body(out)
+                return True
+        return False
+
+    def _header(self, out):
+        i = self.buf.find(b'\n')
+        if i == -1:
+            if len(self.buf) > 1024*64:
+                self._give_up(out)
+                return True
+            return False
+        line = bytes(self.buf[:i+1])
+        if line == b'.\r\n':
+            self._give_up(out)
+            return True
+        if line != b'\r\n':
+            del self.buf[:i+1]
+            if line[:1] in (b' ', b'\t') and self.fields:
+                self.fields[-1] += line
+            else:
+                self.fields.append(line)
+            return True
+        # the CRLF of the blank line is kept, it starts the first delimiter
+        ctype = cte = b''
+        for field in self.fields:
+            name, _, value = field.partition(b':')
+            name = name.strip().lower()
+            if name == b'content-type':
+                ctype = b' '.join(value.split())
+            elif name == b'content-transfer-encoding':
+                cte = value.strip().lower()
+        protected = self.delimiters[-1][1]
+        m = self.boundary.search(ctype)
+        if ctype.lower().startswith(b'multipart/') and m:
+            subtype = ctype[10:].split(b';', 1)[0].strip().lower()
+            self.delimiters.append((
+                b'\r\n--' + (m[1] or m[2]),
+                protected or subtype in (b'signed', b'encrypted')))
+            self.state = self.PASS
+        elif protected or cte not in (b'base64', b'quoted-printable'):
+            self.state = self.PASS
+        else:
+            self.state = self.HOLD
+            self.encoding = cte
+            self.scanned = 0
+            # the body starts after the CRLF of the blank line
+            self.decoded = 2
+            self.pending = bytearray()
+            self.data = bytearray()
+            self.checked = 0
+            return True
+        out.extend(self.fields)
+        self.fields = []
+        return True
+
+    def _give_up(self, out):
+        out.extend(self.fields)
+        self.fields = []
+        self.state = self.DONE
+
+    def _pass_body(self, out):
+        """Stop holding the body, it is passed through unchanged."""
+        out.extend(self.fields)
+        self.fields = []
+        self.data = bytearray()
+        self.state = self.PASS
+
+    def _end_body(self, out, i):
+        if self.state == self.HOLD:
+            data = self._decode(i, len(self.delimiters) == 1)
+            self.data = bytearray()
+            if data is None:
+                out.extend(self.fields)
+                out.append(bytes(self.buf[:i]))
+            else:
+                fields = [
+                    b'Content-Transfer-Encoding: ' +
+                    (b'binary' if self.binary else b'8bit') + b'\r\n'
+                    if f.split(b':', 1)[0].strip().lower() ==
+                    b'content-transfer-encoding' else f for f in self.fields]
+                self.saved += sum(map(len, self.fields)) + i - 2 - \
+                    sum(map(len, fields)) - len(data)
+                out.extend(fields)
+                out.append(b'\r\n' + data)
+            self.fields = []
+        else:
+            out.append(bytes(self.buf[:i]))
+        del self.buf[:i]
+
+    def _delimiter(self, out, end, close):
+        out.append(bytes(self.buf[:end]))
+        del self.buf[:end]
+        if len(self.delimiters) == 1:
+            self.state = self.DONE
+        elif close:
+            self.delimiters.pop()
+            self.state = self.PASS
+        else:
+            self.state = self.HEADER
+
+    def _decode_lines(self, end):
+        """Decode the held body up to the last line ending before ``end``.
+
+        Return False if it can't be decoded or, without ``binary``, isn't
+        valid 8bit data.
+        """
+        i = self.buf.rfind(b'\n', self.decoded, end)
+        if i == -1:
+            return True
+        chunk = bytes(self.buf[self.decoded:i+1])
+        self.decoded = i + 1
+        return self._decode_chunk(chunk, False)
+
+    def _decode_chunk(self, chunk, final):
+        try:
+            if self.encoding == b'base64':
+                self.pending += re.sub(rb'\s', b'', chunk)
+                n = len(self.pending)
+                if not final:
+                    n -= n % 4
+                data = base64.b64decode(
+                    bytes(self.pending[:n]), validate=True)
+                del self.pending[:n]
+            else:
+                # chunks start at the beginning of a line
+                if chunk.startswith(b'..'):
+                    chunk = chunk[1:]
+                data = binascii.a2b_qp(chunk.replace(b'\r\n..', b'\r\n.'))
+        except (binascii.Error, ValueError):
+            return False
+        self.data += data
+        if self.binary:
+            return True
+        # only whole lines are checked, the rest waits for its CRLF
+        end = len(self.data)
+        if not final:
+            i = self.data.rfind(b'\r\n', self.checked)
+            end = self.checked if i == -1 else i + 2
+        lines = bytes(self.data[self.checked:end])
+        self.checked = end
+        if (b'\0' in lines or
+                lines.count(b'\r') != lines.count(b'\r\n') or
+                lines.count(b'\n') != lines.count(b'\r\n') or
+                any(len(line) > 998 for line in lines.split(b'\r\n'))):
+            return False
+        return len(self.data) - self.checked <= 999
+
+    def _decode(self, end, last):
+        """Return the decoded and dot-stuffed body, None if it can't be.
+
+        The body of the message itself (``last``) is followed by the CRLF
+        that ends the DATA, so it must end with one.
+        """
+        if not self._decode_chunk(bytes(self.buf[self.decoded:end]), True):
+            return None
+        data = bytes(self.data)
+        if last:
+            if not data.endswith(b'\r\n'):
+                return None
+            data = data[:-2]
+        data = data.replace(b'\n.', b'\n..')
+        if data.startswith(b'.'):
+            data = b'.' + data
+        if len(data) >= end - 2:
+            return None
+        return data
 
 
 class SmtpHandler(RequestHandler):
     protocol = 'SMTP'
     real_server = SMTP_SERVER
+    bufsize = 1024
+    goodbye = b'QUIT\r\n'
 
-    autocrypt_h = re.compile(rb'\r\nAutocrypt: (.|\n)+?\r\n(?!\t)')
-    chatversion_h = re.compile(rb'\r\nChat-Version: (.|\n)+?\r\n(?!\t)')
-    xmailer_h = re.compile(rb'\r\nX-Mailer: (.|\n)+?\r\n(?!\t)')
-    subject_h = re.compile(rb'\r\nSubject: (.|\n)+?\r\n(?!\t)')
-    references_h = re.compile(rb'\r\nReferences: (.|\n)+?\r\n(?!\t)')
-    inreplyto_h = re.compile(rb'\r\nIn-Reply-To: (.|\n)+?\r\n(?!\t)')
-    # messageid_h = re.compile(rb'\r\nMessage-ID: (.|\n)+?\r\n(?!\t)')
-    contenttype_h = re.compile(rb'Content-Type: (.|\n)+?\r\n(?!\t)')
-    to_h = re.compile(rb'\r\nTo: ((.|\n)+?\r\n)(?!\t)')
     addr_field = re.compile(rb'[^,]*?<([^<>]+)>')
-    msg_sent = re.compile(rb'250 2\.0\.0 Ok: queued as ')
+    commands = frozenset((
+        'EHLO', 'HELO', 'MAIL', 'RCPT', 'DATA', 'RSET', 'NOOP', 'QUIT',
+        'AUTH', 'VRFY', 'BDAT'))
+    auth_cmd = re.compile(rb'AUTH (PLAIN|LOGIN)( [^\r\n]+)?\r?\n$',
+                          re.IGNORECASE)
+    # extensions of the server the client doesn't see, the proxy uses them
+    hidden_extensions = frozenset((b'STARTTLS', b'CHUNKING', b'BINARYMIME'))
+    # replies of the local server, in spool mode
+    max_size = 10240000
+    greeting = b'220 smtp.nauta.cu ESMTP Postfix (nauta-proxy spool)\r\n'
+    ehlo_reply = (b'250-smtp.nauta.cu\r\n250-PIPELINING\r\n'
+                  b'250-SIZE %i\r\n250-AUTH PLAIN LOGIN\r\n'
+                  b'250-ENHANCEDSTATUSCODES\r\n250 8BITMIME\r\n' % max_size)
 
-    def _handle(self, db, log, sel, forward):
-        while True:
-            events = sel.select()
-            for key, mask in events:
-                data = d = key.fileobj.recv(1024)
-                if key.data == self.real_server:
-                    while d and not data.endswith(b'\r\n'):
-                        d = key.fileobj.recv(1024)
-                        data += d
-
-                    if data.startswith(b'250-smtp.nauta.cu\r\n'):
-                        data = data.replace(
-                            b'\r\n250-STARTTLS\r\n', b'\r\n')
-                    elif self.msg_sent.match(data):
-                        msgs = db.get_smtp_msgs()
-                        db.set_smtp_msgs(msgs+1)
-                else:  # key.data == self.client_address
-                    if db.get_optimize():
-                        if self.contenttype_h.search(data):  # Outgoing message
-                            end = b'\r\n.\r\n'
-                            while d and not data.endswith(end) and len(data) < 1024*4:
-                                d = key.fileobj.recv(1024)
-                                data += d
-                            data = self.autocrypt_h.sub(b'\r\n', data, count=1)
-                            data = self.xmailer_h.sub(b'\r\n', data, count=1)
-                            if db.get_optimize() == 2:
-                                data = self.chatversion_h.sub(b'\r\n', data, count=1)
-                            data = self.subject_h.sub(b'\r\n', data, count=1)
-                            data = self.references_h.sub(b'\r\n', data, count=1)
-                            data = self.inreplyto_h.sub(b'\r\n', data, count=1)
-                            # data = self.messageid_h.sub(b'\r\n', data, count=1)
-
-                            m = self.to_h.search(data)
-                            if m:
-                                to = b'\r\nTo: '
-                                to += b', \r\n\t'.join(self.addr_field.sub(
-                                    rb'\1', m[1]).split(b','))
-                                data = data[:m.start()] + to + \
-                                    data[m.end():]
-
-                        if data == b'QUIT\r\n':
-                            self.request.sendall(b'2.0.0 Bye\r\n')
-                            self.request.close()
-
-                received = len(data)
-                total = db.get_smtp() + received
-                db.set_smtp(total)
-
-                received = '{:,} Bytes'.format(received)
-                total = '{} Total: {:,} Bytes'.format(
-                    self.protocol, total)
-                if db.get_savelog():
-                    log('{} wrote:\n{}\n{}\n{}'.format(
-                        key.data, data, received, total))
-                else:
-                    log('{} wrote:\n{}\n{}'.format(
-                        key.data, received, total))
+    def __init__(self, server, client_address):
+        super().__init__(server, client_address)
+        self._sdata = b''
+        self._cdata = b''
+        self._message = None
+        # bytes of the message read from the client, for traffic()
+        self._message_size = 0
+        # client lines of the AUTH exchange still to redact
+        self._auth_lines = 0
+        # lines of the reply being read from the server
+        self._reply = []
+        # (command, start, answered) of the commands waiting for a reply,
+        # answered if the proxy already replied to the client
+        self._commands = []
+        # (command, line, answered) of the commands not sent yet, while
+        # waiting for a reply from a server without PIPELINING
+        self._queued = []
+        # extensions of the server, learned from its EHLO reply
+        self._pipelining = False
+        self._chunking = False
+        self._8bitmime = False
+        self._binarymime = False
+        # BODY declared on the MAIL command when the parts are decoded
+        self._body = None
+        self._transcoder = None
+        # first error of an answered command, reported to the client with
+        # the reply to the message
+        self._rejected = None
+        # a recipient of the transaction was accepted by the server
+        self._accepted = False
+        # QUIT answered by the proxy once the replies before it are in
+        self._quit = False
+        # DATA line waiting for the replies to the envelope
+        self._held = None
+        self._bdat = None
+        # a mail transaction was started and not finished yet
+        self._mail = False
+        if self.db.get_spooling():
+            self.local = True
+            # MAIL command and RCPT commands of the transaction, the chunks
+            # of the message and the AUTH exchange in progress
+            self._envelope = None
+            self._spooled = None
+            self._auth = None
+            self.to_client(self.greeting)
 
-                forward[key.fileobj].sendall(data)
-                if not data:
-                    self.request.close()
+    def count(self, received):
+        if self.local:
+            return self.db.get_smtp()
+        return self.db.add_smtp(received)
+
+    def idle(self):
+        return not (self._commands or self._queued or self._held or
+                    self._message or self._cdata or self._mail or
+                    self.pending or self.local and self._auth)
+
+    def redact(self, data):
+        out = bytearray(data)
+        start = 0
+        for line in bytes(data).splitlines(True):
+            end = start + len(line)
+            if self._auth_lines and line.rstrip() != b'*':
+                self._auth_lines -= 1
+                out[start:end] = re.sub(rb'[^\r\n]', b'*', line)
+            else:
+                m = self.auth_cmd.match(line)
+                if m:
+                    self._auth_lines = 1 if m[1].upper() == b'PLAIN' else 2
+                    if m[2]:
+                        self._auth_lines -= 1
+                        out[start+m.start(2)+1:start+m.end(2)] = \
+                            b'*'*(len(m[2])-1)
+            start = end
+        return out
+
+    def feed_server(self, data):
+        self._sdata += data
+        if data and not self._sdata.endswith(b'\n'):
+            return
+        data, self._sdata = self._sdata, b''
+        if not data:
+            self.to_client(b''.join(self._reply))
+            return
+        for line in data.splitlines(True):
+            self._reply.append(line)
+            if line[3:4] != b'-':
+                reply = b''.join(self._reply)
+                self._reply.clear()
+                self._server_reply(reply)
+
+    def _server_reply(self, reply):
+        cmd, answered = None, False
+        if self._commands:
+            cmd, start, answered = self._commands.pop(0)
+            METRICS.command(self.protocol, cmd, time.monotonic() - start)
+        if cmd in ('EHLO', 'HELO', 'RSET'):
+            self._rejected = None
+        if cmd == 'EHLO' and reply.startswith(b'250'):
+            reply = self._ehlo(reply)
+        elif cmd == 'RCPT' and reply.startswith(b'2'):
+            self._accepted = True
+        elif cmd == 'MESSAGE':
+            self._mail = False
+            if self._rejected:
+                reply, self._rejected = self._rejected, None
+            if reply.startswith(b'250'):
+                self.db.add_smtp_msgs()
+                METRICS.message(self.protocol)
+        elif cmd == 'DATA' and reply.startswith(b'354'):
+            self._start_message()
+        if not answered:
+            self.to_client(reply)
+        elif reply[:1] not in (b'2', b'3') and self._rejected is None:
+            self._rejected = reply
+        self._send_queued()
+        self._quit_reply()
+        if self._held and self._ready():
+            self._release()
+
+    def _ehlo(self, reply):
+        """Learn the extensions of the server and rewrite the list for the
+        client, which can always pipeline its commands."""
+        lines = [line[4:] for line in reply.splitlines()]
+        keywords = [None] + [line.split(b' ', 1)[0].upper()
+                             for line in lines[1:]]
+        self._pipelining = b'PIPELINING' in keywords
+        self._chunking = b'CHUNKING' in keywords
+        self._8bitmime = b'8BITMIME' in keywords
+        # binary data can only be sent with BDAT, which needs PIPELINING
+        # to go without a round trip for the 354
+        self._binarymime = b'BINARYMIME' in keywords and \
+            self._chunking and self._pipelining
+        lines = [line for line, keyword in zip(lines, keywords)
+                 if keyword not in self.hidden_extensions]
+        if not self._pipelining:
+            lines.insert(1, b'PIPELINING')
+        return b''.join(b'250-' + line + b'\r\n' for line in lines[:-1]) + \
+            b'250 ' + lines[-1] + b'\r\n'
+
+    def feed_client(self, data):
+        if not data:
+            if self.local:
+                return
+            if self._message and not self._bdat:
+                out = self._message.flush()
+                if self._transcoder:
+                    out = self._transcode(out, True)
+                for chunk in out:
+                    self.to_server(chunk)
+            if not self._held:
+                self.to_server(self._cdata)
+            return
+        self._feed_client(data)
+
+    def _feed_client(self, data):
+        while data:
+            if self._held or self.pending:
+                # a pipelined DATA is always the last command of a group,
+                # and nothing is read while waiting for the spool
+                self._cdata += data
+                return
+            if self._message:
+                self._message_size += len(data)
+                out, data = self._message.feed(data)
+                if self._transcoder:
+                    out = self._transcode(out, data is not None)
+                if self.local:
+                    self._spool_chunks(out)
+                elif self._bdat:
+                    for chunk in out:
+                        for cmd in self._bdat.feed(chunk):
+                            self._send('BDAT', cmd, True)
+                else:
+                    for chunk in out:
+                        self.to_server(chunk)
+                if data is None:
                     return
+                self._message = None
+                if self.local:
+                    self._spool_message()
+                elif self._bdat:
+                    self._send('MESSAGE', self._bdat.end(), False)
+                    self._bdat = None
+                else:
+                    self._commands.append(
+                        ('MESSAGE', time.monotonic(), False))
+            else:
+                m = NEWLINE.search(data)
+                if not m:
+                    self._cdata += data
+                    return
+                i = m.start()
+                line = self._cdata + data[:i+1]
+                self._cdata, data = b'', data[i+1:]
+                if self.local:
+                    self._local_command(line)
+                else:
+                    self._command(line)
+
+    def _command(self, line):
+        cmd = line[:4].upper().decode(errors='replace')
+        if cmd not in self.commands:
+            cmd = 'OTHER'  # ex. AUTH responses, don't leak them in metrics
+        elif cmd == 'MAIL' or cmd == 'RSET':
+            self._mail = cmd == 'MAIL'
+        if cmd == 'DATA':
+            self._held = line
+            if self._ready():
+                self._release()
+            return
+        if cmd == 'MAIL':
+            self._body = None
+            self._accepted = False
+            if self.db.get_optimize() and self._binarymime:
+                self._body = b'BINARYMIME'
+            elif self.db.get_optimize() and self._8bitmime:
+                self._body = b'8BITMIME'
+            if self._body:
+                line = set_body(line, self._body)
+        if self.db.get_optimize() and line == b'QUIT\r\n':
+            self._quit = True
+            self._send(cmd, line, True)
+            self._quit_reply()
+            return
+        self._send(cmd, line, False)
+
+    def _quit_reply(self):
+        """Answer the QUIT and close once every other reply was relayed, so
+        the client still learns the fate of a pipelined message."""
+        if self._quit and not self._queued and \
+                all(cmd == 'QUIT' for cmd, _, _ in self._commands):
+            self._quit = False
+            self.to_client(b'221 2.0.0 Bye\r\n')
+            self.closing = True
+
+    def _answered(self):
+        return any(c[2] for c in self._commands + self._queued)
+
+    def _ready(self):
+        """Whether the held DATA can go on."""
+        if self._chunking and self._pipelining:
+            # the replies to the envelope tell if it can go with BDAT
+            return not (self._commands or self._queued)
+        return not self._answered()
+
+    def _release(self):
+        """Go on with the held DATA, the envelope replies are all in."""
+        line, self._held = self._held, None
+        if self._chunking and self._pipelining and self._accepted and \
+           not self._commands:
+            # no round trip for the 354, the message goes in BDAT chunks
+            self._bdat = BdatWriter()
+            self._start_message()
+            self.to_client(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+        else:
+            self._send('DATA', line, False)
+        self._feed_held()
+
+    def _feed_held(self):
+        data, self._cdata = self._cdata, b''
+        if data:
+            self._feed_client(data)
+
+    def traffic(self, side):
+        size = self._message_size
+        if side == SERVER or not size:
+            return INTERACTIVE
+        if not self._message:
+            self._message_size = 0
+        return self.body_traffic(size)
+
+    def _start_message(self):
+        self._message = self.message_filter()
+        if self._body:
+            self._transcoder = MimeTranscoder(self._body == b'BINARYMIME')
+
+    def _transcode(self, chunks, end):
+        out = []
+        for chunk in chunks:
+            out.extend(self._transcoder.feed(chunk))
+        if end:
+            out.extend(self._transcoder.end())
+            if self._transcoder.saved:
+                self.db.add_smtp_saved(self._transcoder.saved)
+            self._transcoder = None
+        return out
+
+    def _send(self, cmd, line, answered):
+        self._queued.append((cmd, line, answered))
+        self._send_queued()
+
+    def _send_queued(self):
+        while self._queued and (self._pipelining or not self._commands):
+            cmd, line, answered = self._queued.pop(0)
+            self._commands.append((cmd, time.monotonic(), answered))
+            self.to_server(line)
+
+    def _local_command(self, line):
+        """Answer a command as the server, in spool mode."""
+        if self._auth is not None:
+            self._auth_response(line)
+            return
+        cmd = line[:4].upper()
+        if cmd == b'EHLO':
+            self._envelope = None
+            self.to_client(self.ehlo_reply)
+        elif cmd == b'HELO':
+            self._envelope = None
+            self.to_client(b'250 smtp.nauta.cu\r\n')
+        elif cmd == b'AUTH':
+            self._auth_start(line)
+        elif cmd == b'MAIL':
+            if self._envelope:
+                self.to_client(b'503 5.5.1 Error: nested MAIL command\r\n')
+            else:
+                self._envelope = (line.rstrip(b'\r\n'), [])
+                self.to_client(b'250 2.1.0 Ok\r\n')
+        elif cmd == b'RCPT':
+            if not self._envelope:
+                self.to_client(b'503 5.5.1 Error: need MAIL command\r\n')
+            else:
+                self._envelope[1].append(line.rstrip(b'\r\n'))
+                self.to_client(b'250 2.1.5 Ok\r\n')
+        elif cmd == b'DATA':
+            if not self._envelope or not self._envelope[1]:
+                self.to_client(b'554 5.5.1 Error: no valid recipients\r\n')
+            else:
+                self._message = self.message_filter()
+                self._spooled = [0, []]
+                self.to_client(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+        elif cmd == b'RSET':
+            self._envelope = None
+            self.to_client(b'250 2.0.0 Ok\r\n')
+        elif cmd == b'NOOP':
+            self.to_client(b'250 2.0.0 Ok\r\n')
+        elif cmd == b'QUIT':
+            self.to_client(b'221 2.0.0 Bye\r\n')
+            self.closing = True
+        else:
+            self.to_client(b'502 5.5.2 Error: command not recognized\r\n')
+        self._mail = self._envelope is not None
+
+    def _auth_start(self, line):
+        args = line.split()
+        mech = args[1].upper() if len(args) > 1 else b''
+        if mech == b'PLAIN':
+            self._auth = [mech]
+            if len(args) > 2:
+                self._auth_response(args[2])
+            else:
+                self.to_client(b'334 \r\n')
+        elif mech == b'LOGIN':
+            self._auth = [mech]
+            if len(args) > 2:
+                self._auth_response(args[2])
+            else:
+                self.to_client(b'334 VXNlcm5hbWU6\r\n')
+        else:
+            self.to_client(b'535 5.7.8 Error: authentication failed: '
+                           b'Invalid authentication mechanism\r\n')
+
+    def _auth_response(self, line):
+        """Check the credentials with the server through the spool.
+
+        The ones the spool already used are accepted right away, so Delta
+        Chat can log in while the server is unreachable.
+        """
+        line = line.strip()
+        if line == b'*':
+            self._auth = None
+            self.to_client(b'501 5.7.0 Authentication aborted\r\n')
+            return
+        try:
+            self._auth.append(base64.b64decode(line, validate=True))
+        except binascii.Error:
+            self._auth = None
+            self.to_client(b'501 5.5.2 Cannot decode response\r\n')
+            return
+        if self._auth[0] == b'PLAIN':
+            credentials = self._auth[1].split(b'\0')[1:]
+        elif len(self._auth) == 2:
+            self.to_client(b'334 UGFzc3dvcmQ6\r\n')
+            return
+        else:
+            credentials = self._auth[1:]
+        self._auth = None
+        if len(credentials) != 2:
+            self.to_client(b'535 5.7.8 Error: authentication failed\r\n')
+            return
+        if [c.decode(errors='replace') for c in credentials] == \
+                self.db.get_credentials():
+            self.to_client(b'235 2.7.0 Authentication successful\r\n')
+            return
+        self.pending = (self.db.get_spool().login(
+            self.real_server, credentials), self._logged_in)
+
+    def _logged_in(self, future):
+        code, msg = future.result()
+        self.to_client(b'%d %s\r\n' % (code, msg))
+        self._feed_held()
+
+    def _spool_chunks(self, chunks):
+        for chunk in chunks:
+            self._spooled[0] += len(chunk)
+            if self._spooled[0] <= self.max_size:
+                self._spooled[1].append(bytes(chunk))
+
+    def _spool_message(self):
+        size, chunks = self._spooled
+        mail, rcpts = self._envelope
+        self._spooled = self._envelope = None
+        self._mail = False
+        if size > self.max_size:
+            self.to_client(b'552 5.3.4 Message size exceeds fixed limit\r\n')
+            return
+        spool = self.db.get_spool()
+        self.pending = (spool.add(mail, rcpts, b''.join(chunks)),
+                        self._queued_message)
+        spool.start(self.real_server)
+
+    def _queued_message(self, future):
+        self.to_client(b'250 2.0.0 Ok: queued as %X\r\n' % (future.result(),))
+        self._feed_held()
+
+    def message_filter(self):
+        drop, rewrite = self.db.header_rules.select(
+            'send', self.db.get_optimize())
+        rewrite = {name: getattr(self, 'rewrite_' + action)
+                   for name, action in rewrite.items()}
+        return SmtpDataFilter(drop, rewrite)
+
+    def rewrite_to(self, field):
+        to = field.split(b':', 1)[1].lstrip(b' ')
+        return b'To: ' + b', \r\n\t'.join(
+            self.addr_field.sub(rb'\1', to).split(b','))
+
+
+LINE, LITERAL = 0, 1
+
+
+def parse_quota(resp):
+    """Return the ``(messages, KB)`` used from an IMAP QUOTA response.
+
+    Resources missing from the response are None.
+    """
+    m = re.search(rb'\(([^()]*)\)\s*$', resp)
+    items = m[1].upper().split() if m else []
+    used = {items[i]: int(items[i+1]) for i in range(0, len(items) - 2, 3)}
+    return used.get(b'MESSAGE'), used.get(b'STORAGE')
+
+
+class ImapTokenizer:
+    """Split an IMAP stream into line parts and ``{n}`` literal data.
+
+    ``feed()`` yields ``(LINE, line, size)`` for every complete line, where
+    ``size`` is the length of the literal announced at the end of the line
+    or None, and ``(LITERAL, chunk, remaining)`` for literal bytes as soon
+    as they arrive, so literals are never buffered.
+    """
+    literal = re.compile(rb'\{([0-9]+)\+?\}\r\n$')
+
+    def __init__(self):
+        self.line = b''
+        self.remaining = 0
+
+    def feed(self, data):
+        pos, end = 0, len(data)
+        while pos < end:
+            if self.remaining:
+                chunk = data[pos:pos+self.remaining]
+                pos += len(chunk)
+                self.remaining -= len(chunk)
+                yield LITERAL, chunk, self.remaining
+                continue
+            m = NEWLINE.search(data, pos)
+            if not m:
+                self.line += data[pos:]
+                return
+            i = m.start()
+            line = self.line + data[pos:i+1]
+            self.line = b''
+            pos = i + 1
+            m = self.literal.search(line)
+            if m:
+                self.remaining = int(m[1])
+            yield LINE, line, m and self.remaining
+
+    def flush(self):
+        line, self.line = self.line, b''
+        return line
+
+
+imap_token = re.compile(
+    rb' *(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|~?\{([0-9]+)\+?\}\r\n|'
+    rb'([^ ()"{}\r\n\[]+(?:\[[^\]]*\](?:<[0-9.]+>)?)?))', re.S)
+
+
+def parse_imap(data, pos=0):
+    """Parse the IMAP value at ``data[pos:]``, return ``(value, end)``.
+
+    Parenthesized lists become lists, NIL None and strings, literals and
+    atoms (like ``BODY[TEXT]<0>``) bytes.
+    """
+    stack = [[]]
+    while True:
+        m = imap_token.match(data, pos)
+        if not m or m.end() == pos:
+            raise ValueError('invalid IMAP data at {}'.format(pos))
+        pos = m.end()
+        if m[1]:
+            stack.append([])
+            continue
+        if m[2]:
+            if len(stack) == 1:
+                raise ValueError('unbalanced ) at {}'.format(pos))
+            value = stack.pop()
+        elif m[3] is not None:
+            value = re.sub(rb'\\(.)', rb'\1', m[3])
+        elif m[4] is not None:
+            value = bytes(data[pos:pos+int(m[4])])
+            pos += len(value)
+        else:
+            value = None if m[5].upper() == b'NIL' else m[5]
+        stack[-1].append(value)
+        if len(stack) == 1:
+            return value, pos
+
+
+def fetch_items(response):
+    """Return the items of a FETCH response as ``{NAME: value}``."""
+    items = parse_imap(response, response.index(b'('))[0]
+    return {bytes(k).upper(): v for k, v in zip(items[::2], items[1::2])}
+
+
+def find_base64_part(text, structure, min_size, section=(), pos=0):
+    """Find the first base64 part of ``min_size`` octets or more.
+
+    ``text`` is the start of the body described by ``structure`` (a parsed
+    BODYSTRUCTURE), the parts before the wanted one must be in it. Returns
+    ``(section, start, size, after)`` where ``after`` is the delimiter
+    that must follow the part, None for the body of the message itself.
+    Returns the end of the body if no such part is found and None if the
+    text doesn't match the structure.
+    """
+    if not isinstance(structure[0], list):
+        try:
+            size = int(structure[6])
+        except (IndexError, TypeError, ValueError):
+            return None
+        if (structure[5] or b'').upper() == b'BASE64' and size >= min_size:
+            return section or (1,), pos, size, None
+        return pos + size
+    n = 0
+    while isinstance(structure[n], list):
+        n += 1
+    params = structure[n+1] if len(structure) > n + 1 else None
+    params = dict(zip(params[::2], params[1::2])) if params else {}
+    boundary = {k.upper(): v for k, v in params.items()}.get(b'BOUNDARY')
+    if not boundary:
+        return None
+    delimiter = b'--' + boundary
+    if text.startswith(delimiter, pos):
+        i = pos
+    else:
+        i = text.find(b'\r\n' + delimiter, pos) + 2
+        if i == 1:
+            return None
+    for number, part in enumerate(structure[:n], 1):
+        eol = text.find(b'\r\n', i)
+        if eol == -1:
+            return None
+        start = eol + 2
+        if not text.startswith(b'\r\n', start):
+            start = text.find(b'\r\n\r\n', start) + 2
+            if start == 1:
+                return None
+        found = find_base64_part(
+            text, part, min_size, section + (number,), start + 2)
+        if found is None or isinstance(found, tuple):
+            if found and found[3] is None:
+                found = found[:3] + (b'\r\n' + delimiter,)
+            return found
+        if isinstance(part[0], list):
+            i = text.find(b'\r\n' + delimiter, found) + 2
+            if i == 1:
+                return None
+        elif text.startswith(b'\r\n' + delimiter, found):
+            i = found + 2
+        else:
+            return None
+    if not text.startswith(delimiter + b'--', i):
+        return None
+    return i + len(delimiter) + 2
+
+
+class Base64Lines:
+    """Encode a stream in base64 lines of ``width`` characters and CRLF.
+
+    Only whole lines are returned, the rest is kept for the next call.
+    """
+
+    def __init__(self, width):
+        self.width = width
+        self.block = width//4*3
+        self.pending = b''
+
+    def feed(self, data):
+        data = self.pending + bytes(data)
+        end = len(data) - len(data) % self.block
+        self.pending = data[end:]
+        if not end:
+            return b''
+        text = binascii.b2a_base64(data[:end])[:-1]
+        w = self.width
+        return b''.join(text[i:i+w] + b'\r\n' for i in range(0, len(text), w))
+
+
+class BinaryFetch:
+    """Fetch a message with its first big attachment decoded by the server.
+
+    Servers with BINARY (RFC 3516) send a base64 part decoded, a quarter
+    smaller, but the client must get the exact ``BODY[]`` it asked for, so
+    the part is encoded again and it is only fetched this way when the
+    proxy can tell that the result is the same:
+
+    1. ``BODYSTRUCTURE`` and the first ``prefix`` bytes of ``BODY[TEXT]``
+       locate the part and give the width of its lines.
+    2. With the client tag: the header, the text from ``tail`` bytes before
+       the end of the part and the part decoded after the lines that came
+       in the prefix. The decoded size must give the size of the part and
+       its end must have the layout of the encoder, else the message is
+       fetched again without BINARY.
+
+    The part is encoded in whole lines as it arrives, its start and end go
+    to the client as they came from the server. Messages without such a
+    part get the rest of their text after the prefix.
+
+    Feed it the server tokens, ``client`` and ``server`` are the data to
+    send to each side and ``done`` is set when the client tag is answered.
+    """
+    tag = b'NPB'
+    prefix = 1024*8
+    tail = 128
+    min_size = 1024*32
+    max_line = 76
+    item = re.compile(
+        rb'(BODY|BINARY)\[([^\]]*)\](?:<([0-9]+)>)? ~?\{([0-9]+)\}\r\n$')
+    empty_item = re.compile(
+        rb' ?(?:BODY|BINARY)\[[^\]]*\](?:<[0-9]+>)? (?:""|NIL)')
+    COMPLETE, PLAIN, BINARY = range(3)
+
+    def __init__(self, client_tag, uid, size, header):
+        self.client_tag = client_tag + b' '
+        self.uid = uid
+        # RFC822.SIZE, the length of the partial fetches
+        self.size = size
+        self.header = header
+        self.client = []
+        self.server = []
+        self.done = False
+        self.sent = False
+        self.saved = 0
+        self.mode = None
+        self.receiving = False
+        self.response = bytearray()
+        self.text = None
+        # (section, start, size, after) of the part and its line width
+        self.part = None
+        self.width = self.lines = 0
+
+    def command(self):
+        return b'%s UID FETCH %i (BODYSTRUCTURE BODY.PEEK[TEXT]<0.%i>)\r\n' % (
+            self.tag, self.uid, self.prefix)
+
+    def feed(self, kind, token, size):
+        """Take a server token, return False if it isn't ours."""
+        if self.receiving:
+            if self.mode is None:
+                self.response += token
+                if kind == LINE and size is None:
+                    self.receiving = False
+                    self._structure(bytes(self.response))
+            elif kind == LITERAL:
+                self._literal(token)
+            else:
+                self._line(token, size)
+            return True
+        if kind == LITERAL:
+            return False
+        if token.startswith(b'* ') and b' FETCH (' in token and \
+           re.search(rb'\bUID %i\b' % (self.uid,), token):
+            if self.mode is None and b'BODYSTRUCTURE' in token:
+                self.receiving = True
+                return self.feed(kind, token, size)
+            if self.mode is not None and self.item.search(token):
+                self._start()
+                return self.feed(kind, token, size)
+        elif self.mode is None and token.startswith(self.tag + b' '):
+            self._plan()
+            return True
+        elif self.mode is not None and token.startswith(self.client_tag):
+            if self.mode == self.BINARY and not self.sent:
+                # NO [UNKNOWN-CTE] or the part isn't what it seemed
+                self._fetch(self.PLAIN)
+                return True
+            self.done = True
+        return False
+
+    def _structure(self, response):
+        try:
+            items = fetch_items(response)
+        except ValueError:
+            return
+        for name, value in items.items():
+            if name.startswith(b'BODY[TEXT]') and isinstance(value, bytes):
+                self.text = value
+        structure = items.get(b'BODYSTRUCTURE')
+        if self.text is None or len(self.text) < self.prefix or \
+           not isinstance(structure, list):
+            return
+        try:
+            found = find_base64_part(self.text, structure, self.min_size)
+        except (IndexError, TypeError, AttributeError):
+            return
+        if not isinstance(found, tuple):
+            return
+        start = found[1]
+        width = self.text.find(b'\r\n', start) - start
+        if not 0 < width <= self.max_line or width % 4:
+            return
+        m = re.compile(rb'(?:[A-Za-z0-9+/]{%i}\r\n)+' % (width,)).match(
+            self.text, start)
+        lines = (m.end() - start)//(width + 2) if m else 0
+        if lines and lines*(width + 2) + self.tail < found[2]:
+            self.part, self.width, self.lines = found, width, lines
+
+    def _plan(self):
+        if self.text is None:
+            self.text = b''
+            self._fetch(self.PLAIN)
+        elif self.part:
+            self._fetch(self.BINARY)
+        elif len(self.text) < self.prefix:
+            self._fetch(self.COMPLETE)
+        else:
+            self._fetch(self.PLAIN)
+
+    def _fetch(self, mode):
+        self.mode = mode
+        items = [b'FLAGS', self.header]
+        if mode == self.PLAIN:
+            items.append(b'BODY.PEEK[TEXT]<%i.%i>' % (
+                len(self.text), self.size))
+        elif mode == self.BINARY:
+            section, start, size, after = self.part
+            items.append(b'BODY.PEEK[TEXT]<%i.%i>' % (
+                start + size - self.tail, self.size))
+            items.append(b'BINARY.PEEK[%s]<%i.%i>' % (
+                b'.'.join(b'%i' % (n,) for n in section),
+                self.lines*self.width//4*3, self.size))
+        self.server.append(b'%sUID FETCH %i (%s)\r\n' % (
+            self.client_tag, self.uid, b' '.join(items)))
+
+    def _start(self):
+        self.receiving = True
+        self.head = None
+        self.trailer = []
+        # literals received, the one being received is ``current``
+        self.pieces = {}
+        self.origins = {}
+        self.current = None
+        self.streaming = False
+        self.failed = False
+
+    def _streamed(self):
+        return 'binary' if self.mode == self.BINARY else 'text'
+
+    def _line(self, line, size):
+        m = self.item.search(line) if size is not None else None
+        other = self.empty_item.sub(b'', line[:m.start()] if m else line)
+        if self.head is None:
+            self.head = other
+        elif m and other.strip():
+            self.trailer.append(b' ' + other.strip())
+        if m is None:
+            self.receiving = False
+            self.current = None
+            if not self.sent and not self.failed:
+                self._send()
+            if self.sent:
+                self._end()
+                self.client.append(b''.join(self.trailer) + other)
+            return
+        if m[1] == b'BINARY':
+            self.current = 'binary'
+        elif m[2].upper() == b'TEXT':
+            self.current = 'text'
+        else:
+            self.current = 'header'
+        self.pieces[self.current] = []
+        self.origins[self.current] = int(m[3] or 0)
+        if self.current == self._streamed() and not self.sent and \
+           not self.failed:
+            self.streaming = self._send(int(m[4]))
+
+    def _literal(self, chunk):
+        if self.streaming and self.current == self._streamed():
+            if self.mode == self.BINARY:
+                self._encode(chunk)
+            else:
+                self.client.append(chunk)
+        elif not self.failed:
+            self.pieces[self.current].append(bytes(chunk))
+
+    def _send(self, size=None):
+        """Send the FETCH line and what goes before the streamed literal.
+
+        ``size`` is the size of the streamed literal as it starts, without
+        it everything was held. Returns False if it can't be sent yet.
+        """
+        held = {name: b''.join(pieces) for name, pieces in
+                self.pieces.items() if name != self.current}
+        if 'header' not in held or \
+           self.mode == self.BINARY and 'text' not in held:
+            self.failed = size is None
+            return False
+        text, tail = self.text, b''
+        if self.mode == self.BINARY:
+            if size is None:
+                size = len(held.get('binary', b''))
+            section, start, part, after = self.part
+            decoded = self.lines*self.width//4*3
+            if self.origins.get('binary') != decoded or \
+               not self._check(held['text'], decoded + size):
+                self.failed = True
+                return False
+            text = text[:start + self.lines*(self.width + 2)]
+            tail = held['text']
+            middle = self.left = start + part - self.tail - len(text)
+            self.encoder = Base64Lines(self.width)
+            self.saved = middle - size
+        elif self.mode == self.PLAIN:
+            middle = len(held.get('text', b'')) if size is None else size
+        else:
+            middle = 0
+        self.held = held
+        self.client.append(self.head + b'BODY[] {%i}\r\n' % (
+            len(held['header']) + len(text) + middle + len(tail),))
+        self.client.append(held['header'])
+        self.client.append(text)
+        self.sent = True
+        return True
+
+    def _check(self, tail, decoded):
+        """Check that the part has the layout of the encoder.
+
+        ``tail`` is the text from ``tail`` bytes before the end of the part
+        and ``decoded`` the size of the part decoded.
+        """
+        section, start, size, after = self.part
+        end, rest = tail[:self.tail], tail[self.tail:]
+        if self.origins['text'] != start + size - self.tail:
+            return False
+        if after is None and rest or \
+           after is not None and not rest.startswith(after):
+            return False
+        body = end.rstrip(b'\r\n')
+        suffix = end[len(body):]
+        encoded = (decoded + 2)//3*4
+        lines = (encoded + self.width - 1)//self.width
+        last = encoded - (lines - 1)*self.width
+        return suffix == b'\r\n'*(len(suffix)//2) and \
+            last + len(suffix) + 2 <= self.tail and \
+            size - len(suffix) == encoded + 2*(lines - 1) and \
+            body[-last-2:-last] == b'\r\n' and \
+            body.endswith(b'='*(-decoded % 3))
+
+    def _encode(self, chunk):
+        data = self.encoder.feed(chunk)[:self.left]
+        self.left -= len(data)
+        if data:
+            self.client.append(data)
+
+    def _end(self):
+        """Send the literals held after the FETCH line."""
+        if self.mode == self.BINARY:
+            if not self.streaming:
+                self._encode(self.held.get('binary', b''))
+            self.client.append(self.held['text'])
+        elif self.mode == self.PLAIN and not self.streaming:
+            self.client.append(self.held.get('text', b''))
 
 
 class ImapHandler(RequestHandler):
     protocol = 'IMAP'
     real_server = IMAP_SERVER
+    goodbye = b'a LOGOUT\r\n'
+    can_splice = hasattr(os, 'splice')
+    max_header = 1024*64
 
-    text_part = re.compile(rb'\r\n\r\n BODY\[TEXT\] \{([0-9]+)\}\r\n')
+    text_part = re.compile(rb' BODY\[TEXT\] \{([0-9]+)\}\r\n$')
     msg_received = re.compile(
-        rb'\* [0-9]+ FETCH \(UID [0-9]+ FLAGS \(.*?\) BODY')
+        rb'\* [0-9]+ FETCH \(UID [0-9]+ (?:MODSEQ \([0-9]+\) )?FLAGS \(.*?\) '
+        rb'BODY')
     login_cmd = re.compile(rb'[a-zA-Z0-9]+ LOGIN "(.+?)" "(.+?)"\r\n')
+    select_cmd = re.compile(
+        rb'([a-zA-Z0-9]+) (?:SELECT|EXAMINE) "?(.+?)"?(?: \(.*\))?\r\n$',
+        re.IGNORECASE)
+    uidvalidity = re.compile(rb'\* OK \[UIDVALIDITY ([0-9]+)\]')
+    body_fetch = re.compile(
+        rb'([a-zA-Z0-9]+) UID FETCH ([0-9]+) \(FLAGS BODY\.PEEK\[\]\)\r\n$')
+    body_line = re.compile(
+        rb'\* [0-9]+ FETCH \(.*\bUID ([0-9]+)\b.* BODY\[\] \{([0-9]+)\}\r\n$')
+    command_name = re.compile(rb'([a-zA-Z0-9.]+) ((?:UID )?[a-zA-Z]+)\b')
+    mailbox_size = re.compile(rb'\* ([0-9]+) (EXISTS|EXPUNGE)\r\n$', re.I)
+    message_size = re.compile(
+        rb'\* [0-9]+ FETCH \(.*\bRFC822\.SIZE ([0-9]+)\b')
+    fetch_uid = re.compile(rb'\* [0-9]+ FETCH \(.*\bUID ([0-9]+)\b')
+    fetch_seq = re.compile(rb'\* ([0-9]+) FETCH \(')
+    fetch_flags = re.compile(rb'\bFLAGS \(([^)]*)\)')
+    fetch_modseq = re.compile(rb'\bMODSEQ \(([0-9]+)\)')
+    flags_fetch = re.compile(
+        rb'([a-zA-Z0-9.]+) UID FETCH ([0-9]+(?::(?:[0-9]+|\*))?'
+        rb'(?:,[0-9]+(?::(?:[0-9]+|\*))?)*) \(?((?:UID|FLAGS|MODSEQ)'
+        rb'(?: (?:UID|FLAGS|MODSEQ))*)\)?(?: \(CHANGEDSINCE ([0-9]+)\))?'
+        rb'\r\n$', re.I)
+    select_code = re.compile(rb'\* OK \[(HIGHESTMODSEQ|UIDNEXT) ([0-9]+)\]')
+    modseq_code = re.compile(rb'\* OK \[(?:HIGHESTMODSEQ [0-9]+|NOMODSEQ)\]')
+    modseq_item = re.compile(
+        rb'(?<=\()MODSEQ \([0-9]+\) ?| MODSEQ \([0-9]+\)', re.I)
+    # commands that enable CONDSTORE (RFC 7162, section 3.1)
+    condstore_cmd = re.compile(
+        rb'[a-zA-Z0-9.]+ .*\b(?:CONDSTORE|QRESYNC|MODSEQ|HIGHESTMODSEQ|'
+        rb'CHANGEDSINCE|UNCHANGEDSINCE)\b', re.I)
+    vanished = re.compile(
+        rb'\* VANISHED (\(EARLIER\) )?([0-9:,]+)\r\n$', re.I)
+    compress_tag = b'NPZ'
+    quota_tag = b'NPQ'
+    # seconds before the server stats are asked again in a client session
+    quota_max_age = 60*15
+    # bytes of messages fetched ahead a session may keep
+    prefetch_buffer = 1024*1024*2
+
+    def __init__(self, server, client_address):
+        super().__init__(server, client_address)
+        self._stokens = ImapTokenizer()
+        self._ctokens = ImapTokenizer()
+        self._continuation = False
+        # (line, header_part match, header literal) of a FETCH response
+        # waiting for its BODY[TEXT] part to be merged into BODY[]
+        self._held = None
+        # COMPRESS=DEFLATE (RFC 4978) with the server, the client side
+        # stays uncompressed
+        self._can_compress = False
+        self._login_tag = None
+        self._login_ok = None
+        self._negotiating = b''
+        self._queued = []
+        self._inflate = None
+        self._deflate = None
+        # message cache: selected mailbox, pending hit/miss and the body
+        # being captured for the cache
+        self._account = None
+        self._select = None
+        self._mailbox = None
+        self._hit = None
+        self._miss = None
+        self._capture = None
+        # tag -> (command, start) of the commands waiting for a response
+        self._commands = {}
+        self._cliteral = False
+        # server stats: QUOTA capability, our GETQUOTAROOT waiting for its
+        # response, EXISTS of the selected mailbox and the messages added
+        # or expunged since the last tagged response
+        self._can_quota = False
+        self._quota = False
+        self._exists = None
+        self._server_msgs = 0
+        # BINARY (RFC 3516): RFC822.SIZE of the big messages of the
+        # selected mailbox by UID and the fetch being rebuilt
+        self._can_binary = False
+        self._sizes = {}
+        self._binary = None
+        # mailbox index (CONDSTORE, RFC 7162): index of the selected
+        # mailbox and its version when it last was the view of this
+        # session, if a tagged response came since the last fetch answered
+        # from it, HIGHESTMODSEQ and UIDNEXT at SELECT, UID of the FETCH
+        # response being relayed, the flags fetch being synced and the
+        # client data waiting for it, if the client enabled CONDSTORE and
+        # if only the proxy did, so that its responses must be hidden
+        self._can_condstore = False
+        self._client_condstore = False
+        self._hide_modseq = False
+        self._index = None
+        self._current = None
+        self._fresh = False
+        self._modseq = None
+        self._uidnext = None
+        self._index_uid = None
+        self._flags = None
+        self._waiting = []
+        # read-ahead: responses fetched ahead by UID as (seq, parts), their
+        # size, UIDs already fetched by the client, (tag, UIDs) of the
+        # fetch getting them and [tokenizer, parts, UID] of the response
+        # being kept
+        self._ahead = {}
+        self._ahead_size = 0
+        self._fetched = set()
+        self._batch = None
+        self._kept = None
+        # size of the biggest literal relayed from each side since the
+        # last traffic()
+        self._literals = {CLIENT: 0, SERVER: 0}
+
+    def close(self):
+        self._drop_ahead()
+        super().close()
+
+    def count(self, received):
+        return self.db.add_imap(received)
+
+    def idle(self):
+        return not (self._commands or self._quota or self._held or
+                    self._binary or self._flags or self._batch or
+                    self._login_ok or
+                    self._ctokens.line or self._ctokens.remaining or
+                    self._stokens.remaining)
+
+    def redact(self, data):
+        out = bytearray(data)
+        for m in self.login_cmd.finditer(data):
+            for group in (1, 2):
+                out[m.start(group):m.end(group)] = b'*'*len(m[group])
+        return out
+
+    def passthrough(self, side):
+        if self.db.get_savelog() or self.trace or self._login_ok \
+           or self._inflate or self._capture or self._binary or self._flags \
+           or self._batch:
+            return 0
+        if side == SERVER:
+            return 0 if self._held else self._stokens.remaining
+        return self._ctokens.remaining
+
+    def spliced(self, side, size):
+        tokens = self._stokens if side == SERVER else self._ctokens
+        tokens.remaining -= size
+        self.db.add_imap_wire(size)
+        self.db.add_imap_plain(size)
+        super().spliced(side, size)
+
+    def traffic(self, side):
+        tokens = self._stokens if side == SERVER else self._ctokens
+        size = self._literals[side]
+        if not tokens.remaining:
+            self._literals[side] = 0
+        if side == SERVER and self._binary:
+            return BULK  # only big messages are fetched with BINARY
+        return self.body_traffic(size) if size else INTERACTIVE
+
+    def to_client(self, data):
+        if self._batch and self._keep(data):
+            return
+        capture = self._capture
+        if capture:
+            capture[2].append(bytes(data))
+            capture[1] -= len(data)
+            if capture[1] <= 0:
+                self._capture = None
+                self.db.get_cache().put(capture[0], b''.join(capture[2]))
+        elif self._miss:
+            m = self.body_line.match(data)
+            if m and int(m[1]) == self._miss[1]:
+                self._capture = [self._miss[2], int(m[2]), []]
+        super().to_client(data)
+
+    def to_server(self, data):
+        if self._login_ok:
+            self._queued.append(bytes(data))
+            return
+        self._forward(self.client_address, data)
+        self.db.add_imap_plain(len(data))
+        if self._deflate and data:
+            data = self._deflate.compress(data) + \
+                self._deflate.flush(zlib.Z_SYNC_FLUSH)
+        self.db.add_imap_wire(len(data))
+        self.server_out.append(data)
+
+    def feed_server(self, data):
+        self.db.add_imap_wire(len(data))
+        if self._inflate:
+            data = self._inflate.decompress(data) if data else \
+                self._inflate.flush()
+        elif self._login_ok:
+            data = self._negotiate(data)
+            if data is None:
+                return
+        self.db.add_imap_plain(len(data))
+        self._feed_server(data)
+
+    def _negotiate(self, data):
+        """Wait for the answer to COMPRESS DEFLATE.
 
-    def _handle(self, db, log, sel, forward):
+        Returns the data received after it, None if it didn't arrive yet.
+        """
+        data = self._negotiating + data
+        line = b''
         while True:
-            events = sel.select()
-            for key, mask in events:
-                # self.server.loggerC.debug('{} writing...'.format(key.data))
-                data = d = key.fileobj.recv(1024*4)
-                if key.data == self.real_server:
-                    if self.msg_received.match(data):
-                        end = b'OK Fetch completed.\r\n'
-                        while d and not data.endswith(end):
-                            d = key.fileobj.recv(1024*4)
-                            data += d
-                        if db.get_optimize():
-                            try:
-                                m1 = db.header_part.search(data)
-                                size = int(m1[1])
-                                m2 = self.text_part.search(data)
-                                size += int(m2[1])
-                                data = data[:m2.start()] + \
-                                    b'\r\n\r\n' + data[m2.end():]
-                                data = data[:m1.start()] + \
-                                    b') BODY[] {%i}' % (
-                                        size,) + data[m1.end():]
-                            except Exception as ex:
-                                self.server.exception(ex)
-                        msgs = db.get_imap_msgs()
-                        db.set_imap_msgs(msgs+1)
-                    else:
-                        while d and not data.endswith(b'\r\n'):
-                            d = key.fileobj.recv(1024*4)
-                            data += d
-                        if data.startswith(b'* OK [CAPABILITY '):
-                            data = data.replace(b'STARTTLS', b'')
-                else:  # key.data == self.client_address
-                    while d and not data.endswith(b'\r\n'):
-                        d = key.fileobj.recv(1024*4)
-                        data += d
-
-                    if db.get_optimize():
-                        req = b' (FLAGS BODY.PEEK[])\r\n'
-                        if data.endswith(req) and data.find(b' UID FETCH ') != -1:
-                            data = data[:-len(req)] + db.fetch_sub
-
-                    m = self.login_cmd.match(data)
-                    if m:
-                        db.set_credentials(m.group(1, 2))
-
-                received = len(data)
-                total = db.get_imap() + received
-                db.set_imap(total)
-
-                received = '{:,} Bytes'.format(received)
-                total = '{} Total: {:,} Bytes'.format(
-                    self.protocol, total)
-                if db.get_savelog():
-                    log('{} wrote:\n{}\n{}\n{}'.format(
-                        key.data, data, received, total))
+            i = data.find(b'\n')
+            if i == -1:
+                if not data:
+                    break  # EOF
+                self._negotiating = data
+                return None
+            line, data = data[:i+1], data[i+1:]
+            if line.startswith(self.compress_tag + b' '):
+                break
+            self.db.add_imap_plain(len(line))
+            self._feed_server(line)
+        self._negotiating = b''
+        login_ok, self._login_ok = self._login_ok, None
+        if line.startswith(self.compress_tag + b' OK'):
+            self._inflate = zlib.decompressobj(-15)
+            self._deflate = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+            data = self._inflate.decompress(data)
+        self.to_client(login_ok)
+        queued, self._queued = self._queued, []
+        for chunk in queued:
+            self.to_server(chunk)
+        return data
+
+    def _feed_server(self, data):
+        for kind, token, size in self._stokens.feed(data):
+            if size and kind == LINE:
+                self._literals[SERVER] = max(self._literals[SERVER], size)
+            if self._binary and self._binary_token(kind, token, size):
+                continue
+            if kind == LITERAL:
+                if self._held:
+                    self._held[2].append(bytes(token))
                 else:
-                    log('{} wrote:\n{}\n{}'.format(
-                        key.data, received, total))
+                    self.to_client(token)
+            else:
+                self._server_line(token, size)
+        if not data:
+            if self._held:
+                self._release()
+            self.to_client(self._stokens.flush())
+        if self._waiting and not self._flags:
+            waiting, self._waiting = self._waiting, []
+            for chunk in waiting:
+                self._feed_client(chunk)
 
-                forward[key.fileobj].sendall(data)
-                if not data:
-                    self.request.close()
+    def _server_line(self, line, size):
+        db = self.db
+        if self._ahead and not self._continuation:
+            self._ahead_line(line)
+        if self._index is not None and self._index_line(line, size):
+            return
+        if self._hide_modseq and not self._continuation:
+            line = self._strip_modseq(line)
+            if line is None:
+                return
+        if self._held:
+            m = self.text_part.search(line)
+            if m:
+                line, m1, header = self._held
+                header = b''.join(header)
+                self._held = None
+                size = len(header) + int(m[1])
+                line = line[:m1.start()] + b') BODY[] {%i}\r\n' % (size,)
+                self.to_client(line)
+                self.to_client(header)
+            else:
+                self._release()
+                self.to_client(line)
+        elif self._continuation:
+            self.to_client(line)
+        else:
+            if self._hit and size is None and self._inject(line):
+                return
+            if self.msg_received.match(line) and not self._in_batch(line):
+                db.add_imap_msgs()
+                METRICS.message(self.protocol)
+            if db.get_optimize() and size is not None \
+               and size <= self.max_header:
+                m1 = db.header_part.search(line)
+                if m1 and m1.end() == len(line) - 2:
+                    self._held = (line, m1, [])
+                    self._continuation = True
                     return
+            if line.startswith(b'* OK [CAPABILITY '):
+                line = line.replace(b'STARTTLS', b'')
+            if b'CAPABILITY' in line and b' COMPRESS=DEFLATE' in line:
+                self._can_compress = True
+                line = line.replace(b' COMPRESS=DEFLATE', b'')
+            if b'CAPABILITY' in line and b' QUOTA' in line:
+                self._can_quota = True
+            if b'CAPABILITY' in line and re.search(rb' BINARY\b', line):
+                self._can_binary = True
+            if b'CAPABILITY' in line and b' CONDSTORE' in line:
+                self._can_condstore = True
+            if b'RFC822.SIZE' in line:
+                self._message_size(line)
+            if self._serverstats(line):
+                return
+            if not line.startswith(b'* '):
+                self._tagged(line)
+            elif self._select:
+                m = self.uidvalidity.match(line)
+                if m:
+                    self._select[2] = int(m[1])
+                m = self.select_code.match(line)
+                if m and m[1] == b'UIDNEXT':
+                    self._uidnext = int(m[2])
+                elif m:
+                    self._modseq = int(m[2])
+            if self._login_tag and line.startswith(self._login_tag):
+                tag, self._login_tag = self._login_tag, None
+                if self._can_compress and line.startswith(b'OK', len(tag)):
+                    self._login_ok = line
+                    cmd = self.compress_tag + b' COMPRESS DEFLATE\r\n'
+                    db.add_imap_wire(len(cmd))
+                    self.server_out.append(cmd)
+                    self._continuation = False
+                    return
+            if self._hide_modseq and self.modseq_code.match(line):
+                return
+            self.to_client(line)
+        self._continuation = size is not None
+
+    def _strip_modseq(self, line):
+        """Take the MODSEQ out of a FETCH response, None if nothing is left.
+
+        The proxy enables CONDSTORE for the mailbox index, the client that
+        didn't must not get its data.
+        """
+        if not self.fetch_seq.match(line):
+            return line
+        line = self.modseq_item.sub(b'', line)
+        if line.endswith(b' FETCH ()\r\n'):
+            return None
+        return line
+
+    def _serverstats(self, line):
+        """Learn the server stats from the responses to the client.
+
+        QUOTA responses give both values, EXISTS and EXPUNGE only keep the
+        message count up to date in between. Returns True if ``line``
+        answers our GETQUOTAROOT and must not reach the client.
+        """
+        if line.startswith(b'* QUOTA '):
+            self.db.set_serverstats(parse_quota(line))
+            self._server_msgs = 0
+            return self._quota
+        if line.startswith(b'* QUOTAROOT '):
+            return self._quota
+        if self._quota and line.startswith(self.quota_tag + b' '):
+            self._quota = False
+            if not line.startswith(b'OK', len(self.quota_tag) + 1):
+                self._can_quota = False
+            return True
+        m = self.mailbox_size.match(line)
+        if m:
+            if m[2].upper() == b'EXPUNGE':
+                self._server_msgs -= 1
+                if self._exists:
+                    self._exists -= 1
+            else:
+                if self._exists is not None and int(m[1]) > self._exists:
+                    self._server_msgs += int(m[1]) - self._exists
+                self._exists = int(m[1])
+        return False
+
+    def _ask_quota(self):
+        """Send GETQUOTAROOT before IDLE if the server stats are stale."""
+        if self._can_quota and not self._quota and not self._commands \
+           and self.db.claim_serverstats(self.quota_max_age):
+            self._quota = True
+            self.to_server(self.quota_tag + b' GETQUOTAROOT "INBOX"\r\n')
+
+    def _tagged(self, line):
+        tag = line.split(b' ', 1)[0]
+        cmd = self._commands.pop(tag, None)
+        if cmd:
+            METRICS.command(self.protocol, cmd[0], time.monotonic() - cmd[1])
+        self._fresh = True
+        if self._server_msgs:
+            self.db.add_serverstats(self._server_msgs)
+            self._server_msgs = 0
+        if self._select and self._select[0] == tag:
+            ok = line.startswith(b'OK', len(tag)+1)
+            self._mailbox = self._select[1:] if ok else None
+            self._select = None
+            self._index_select()
+        if self._hit and self._hit[0] == tag:
+            self._hit = None
+        if self._miss and self._miss[0] == tag:
+            self._miss = self._capture = None
+        if self._batch and self._batch[0] == tag:
+            self._batch = self._kept = None
+
+    def _inject(self, line):
+        """Add the cached body to the FLAGS response of a cache hit."""
+        tag, uid, body = self._hit
+        if not line.startswith(b'* ') or not line.endswith(b')\r\n') or \
+           not re.search(rb'\bUID %i\b' % (uid,), line):
+            return False
+        self.to_client(line[:-3] + b' BODY[] {%i}\r\n' % (len(body),))
+        self.to_client(body)
+        self.to_client(b')\r\n')
+        self.db.add_imap_msgs()
+        METRICS.message(self.protocol)
+        self.db.add_cache_hit(len(body))
+        return True
+
+    def _cached_fetch(self, token):
+        """Ask only for the FLAGS of messages in the cache."""
+        cache = self.db.get_cache()
+        m = self.body_fetch.match(token)
+        if not m or not cache or not self._account or not self._mailbox \
+           or self._mailbox[1] is None:
+            return token
+        tag, uid = m[1], int(m[2])
+        key = (self._account, self._mailbox[0], self._mailbox[1], uid)
+        body = cache.get(key)
+        if body is None:
+            self._miss = (tag, uid, key)
+            self.db.add_cache_miss()
+            return token
+        self._hit = (tag, uid, body)
+        return b'%s UID FETCH %i (FLAGS)\r\n' % (tag, uid)
+
+    def _message_size(self, line):
+        """Keep the size of the messages, for BINARY and read-ahead."""
+        m = self.message_size.match(line)
+        if m:
+            uid = self.fetch_uid.match(line)
+            if uid:
+                self._sizes[int(uid[1])] = int(m[1])
+
+    def _binary_fetch(self, token):
+        """Fetch big messages in pieces, see BinaryFetch."""
+        m = self.body_fetch.match(token)
+        if not m or not self._can_binary or self._binary:
+            return token
+        size = self._sizes.get(int(m[2]))
+        if size is None or size < BinaryFetch.min_size:
+            return token
+        self._binary = BinaryFetch(m[1], int(m[2]), size,
+                                   self.db.header_fetch)
+        return self._binary.command()
+
+    def _binary_token(self, kind, token, size):
+        fetch = self._binary
+        ours = fetch.feed(kind, token, size)
+        for data in fetch.client:
+            if self._index is not None and self.fetch_seq.match(data):
+                self._index_line(data, None)  # the FLAGS of the message
+            if self._hide_modseq:
+                data = self._strip_modseq(data)
+                if data is None:
+                    continue
+            self.to_client(data)
+        for cmd in fetch.server:
+            self.to_server(cmd)
+        fetch.client.clear()
+        fetch.server.clear()
+        if fetch.done:
+            self._binary = None
+            if fetch.sent:
+                self.db.add_imap_msgs()
+                METRICS.message(self.protocol)
+            if fetch.sent and fetch.saved > 0:
+                self.db.add_imap_saved(fetch.saved)
+        return ours
+
+    def _ahead_fetch(self, token):
+        """Answer a body fetch with the response fetched ahead.
+
+        Returns the command to send, None if it was answered.
+        """
+        m = self.body_fetch.match(token)
+        if not m:
+            return token
+        tag, uid = m[1], int(m[2])
+        self._fetched.add(uid)
+        ahead = self._ahead.pop(uid, None)
+        if ahead is None:
+            return token
+        seq, parts = ahead
+        size = sum(map(len, parts))
+        self._ahead_size -= size
+        if len(self._commands) > 1 or self._quota or self._batch or \
+           self._flags or self._binary:
+            # the server might answer the other commands with changes
+            self.db.add_prefetch_wasted(size)
+            return token
+        self._commands.pop(tag, None)
+        for data in parts:
+            super().to_client(data)
+        super().to_client(tag + b' OK Fetch completed.\r\n')
+        self.db.add_imap_msgs()
+        METRICS.message(self.protocol)
+        self.db.add_prefetch_hit()
+        cache = self.db.get_cache()
+        m = self.body_line.match(parts[0])
+        if cache and m and parts[-1] == b')\r\n' and self._account and \
+           self._mailbox and self._mailbox[1] is not None:
+            cache.put((self._account, self._mailbox[0], self._mailbox[1], uid),
+                      b''.join(parts[1:-1]))
+        return None
+
+    def _read_ahead(self, token):
+        """Fetch the next messages of the mailbox with a body fetch.
+
+        The messages of known size after the one asked that the client
+        didn't fetch yet are added, as many as allowed and fit in the
+        buffer, their responses are kept by _keep() until the client asks.
+        """
+        m = self.body_fetch.match(token)
+        count = self.db.get_prefetch()
+        if not m or not count or self._batch or len(self._commands) > 1:
+            return token
+        tag, uid = m[1], int(m[2])
+        cache = self.db.get_cache()
+        key = None
+        if cache and self._account and self._mailbox and \
+           self._mailbox[1] is not None:
+            key = (self._account, self._mailbox[0], self._mailbox[1])
+        room = self.prefetch_buffer - self._ahead_size
+        uids = []
+        for other in sorted(self._sizes):
+            size = self._sizes[other]
+            if len(uids) == count or size > room:
+                break
+            if other <= uid or other in self._fetched or \
+               other in self._ahead or key and key + (other,) in cache or \
+               self._can_binary and size >= BinaryFetch.min_size:
+                continue
+            uids.append(other)
+            room -= size
+        if not uids:
+            return token
+        self._batch = (tag, set(uids))
+        return b'%s UID FETCH %s (FLAGS BODY.PEEK[])\r\n' % (
+            tag, uid_set(sorted([uid] + uids)))
+
+    def _in_batch(self, line):
+        if not self._batch:
+            return False
+        m = self.fetch_uid.match(line)
+        return bool(m) and int(m[1]) in self._batch[1]
+
+    def _keep(self, data):
+        """Keep the responses fetched ahead, returns True if ``data`` was."""
+        if self._kept is None:
+            if not self._in_batch(data):
+                return False
+            uid = int(self.fetch_uid.match(data)[1])
+            self._kept = [ImapTokenizer(), [], uid]
+        tokens, parts, uid = self._kept
+        rest = []
+        for kind, token, size in tokens.feed(data):
+            if self._kept is None:
+                rest.append(bytes(token))
+                continue
+            parts.append(bytes(token))
+            if kind == LINE and size is None:
+                self._kept = None
+                seq = int(self.fetch_seq.match(parts[0])[1])
+                self._ahead_put(uid, seq, parts)
+        for token in rest:
+            self.to_client(token)
+        return True
+
+    def _ahead_put(self, uid, seq, parts):
+        size = sum(map(len, parts))
+        if uid in self._fetched or uid in self._ahead:
+            self.db.add_prefetch_wasted(size)
+            return
+        self._ahead[uid] = (seq, parts)
+        self._ahead_size += size
+        self.db.add_prefetched()
+
+    def _ahead_line(self, line):
+        """Drop the responses fetched ahead changed by ``line``."""
+        m = self.mailbox_size.match(line)
+        if m and m[2].upper() == b'EXPUNGE' or self.vanished.match(line):
+            self._drop_ahead()  # the sequence numbers changed
+            return
+        m = self.fetch_seq.match(line)
+        if not m or self._in_batch(line):
+            return
+        seq = int(m[1])
+        flags = self.fetch_flags.search(line)
+        for other, parts in self._ahead.values():
+            if other == seq:
+                kept = self.fetch_flags.search(parts[0])
+                if not flags or not kept or flags[1] != kept[1]:
+                    self._drop_ahead(seq)
+                break
+
+    def _drop_ahead(self, seq=None):
+        """Drop the responses fetched ahead, only that of ``seq`` if set."""
+        for uid, (other, parts) in list(self._ahead.items()):
+            if seq is None or other == seq:
+                del self._ahead[uid]
+                size = sum(map(len, parts))
+                self._ahead_size -= size
+                self.db.add_prefetch_wasted(size)
+
+    def _index_select(self):
+        """Take the index of the mailbox just selected with CONDSTORE.
+
+        The index is the view of the session if the mailbox didn't change
+        since it was synced: same HIGHESTMODSEQ and message count and no
+        UID past UIDNEXT.
+        """
+        self._index = self._current = None
+        if not self.db.get_optimize() or self._modseq is None or \
+           not self._account or not self._mailbox or \
+           self._mailbox[1] is None:
+            return
+        index = self._index = self.db.get_indexes().get(
+            self._account, *self._mailbox)
+        with index.lock:
+            if index.complete and index.modseq == self._modseq and \
+               len(index) == self._exists and (
+                   not index.uids or self._uidnext is None or
+                   index.uids[-1] < self._uidnext):
+                self._current = index.version
+
+    def _index_line(self, line, size):
+        """Keep the index of the selected mailbox up to date.
+
+        Returns True if ``line`` answers the sync of a flags fetch and must
+        not reach the client.
+        """
+        index = self._index
+        with index.lock:
+            current = self._current == index.version
+            if self._continuation:
+                uid = self._index_uid
+            else:
+                m = self.fetch_seq.match(line)
+                if not m:
+                    return self._index_other(line, current)
+                uid = self.fetch_uid.match(line)
+                if uid:
+                    uid = int(uid[1])
+                elif current and int(m[1]) <= len(index):
+                    uid = index.uids[int(m[1]) - 1]
+            self._index_uid = uid if size is not None else None
+            flags = self.fetch_flags.search(line)
+            modseq = self.fetch_modseq.search(line)
+            if not flags and not modseq:
+                return False
+            if uid is None:
+                self._current = None
+                return False
+            if uid not in index:
+                current = False
+            if not index.update(uid, flags and flags[1].split(),
+                                modseq and int(modseq[1])):
+                current = False
+            self._current = index.version if current else None
+            fetch = self._flags
+            if fetch is None:
+                return False
+            if modseq:
+                fetch.modseq = max(fetch.modseq, int(modseq[1]))
+            if fetch.uids is not None:
+                fetch.uids.add(uid)
+            largest = index.uids[-1] if index.uids else uid
+            if size is None and not self._continuation and \
+               in_ranges(uid, uid_ranges(fetch.spec, largest)):
+                # it is in the answer from the index
+                fetch.dropped += len(line)
+                return True
+        return False
+
+    def _index_other(self, line, current):
+        index = self._index
+        m = self.mailbox_size.match(line)
+        if m and m[2].upper() == b'EXPUNGE':
+            if current and int(m[1]) <= len(index):
+                index.remove_at(int(m[1]) - 1)
+                self._current = index.version
+            else:
+                self._current = None
+        elif m:
+            if int(m[1]) != len(index):
+                self._current = None
+        elif self._flags and line.startswith(self._flags.tag + b' '):
+            return self._flags_done(line)
+        else:
+            m = self.vanished.match(line)
+            if m:
+                ranges = uid_ranges(m[2], 0)
+                removed = index.remove(ranges)
+                expected = 0
+                if not m[1]:  # not EARLIER, like EXPUNGE
+                    expected = sum(last - first + 1 for first, last in ranges)
+                    self._server_msgs -= expected
+                    if self._exists is not None:
+                        self._exists -= expected
+                if not current or removed != expected:
+                    self._current = None
+                elif removed:
+                    self._current = index.version
+        return False
+
+    def _index_fetch(self, spec, items, changedsince):
+        index = self._index
+        largest = index.uids[-1] if index.uids else 0
+        return index.fetch(uid_ranges(spec, largest), items, changedsince)
+
+    def _flags_fetch(self, token):
+        """Answer fetches of flags and UIDs from the mailbox index.
+
+        They are answered right away while the index is the view of the
+        session, as of the last response of the server, otherwise only the
+        changes since the index was synced are asked first, see FlagsFetch.
+        Returns the command to send, None if it was answered.
+        """
+        m = self.flags_fetch.match(token)
+        index = self._index
+        if not m or index is None or len(self._commands) > 1 or \
+           self._quota or self._binary or self._hit or self._miss:
+            return token
+        tag = m[1]
+        items = set(m[3].upper().split())
+        changedsince = int(m[4]) if m[4] else None
+        with index.lock:
+            if self._current == index.version and self._fresh:
+                lines = self._index_fetch(m[2], items, changedsince)
+                if lines is not None:
+                    self._commands.pop(tag, None)
+                    self._fresh = False
+                    lines.append(tag + b' OK Fetch completed.\r\n')
+                    for line in lines:
+                        self.to_client(line)
+                    self.db.add_index_hit(len(token) + sum(map(len, lines)))
+                    return None
+            if index.complete:
+                since = index.modseq
+            elif m[2] == b'1:*':
+                since = 0  # list all the messages to fill the index
+            else:
+                return token
+        self._flags = FlagsFetch(tag, token, m[2], items, changedsince, since)
+        return self._flags.sync()
+
+    def _flags_done(self, line):
+        """Answer the synced flags fetch from the index.
+
+        As the changes don't list expunged messages, the index must have as
+        many messages as the mailbox, if not the command of the client is
+        sent after all.
+        """
+        fetch, self._flags = self._flags, None
+        index = self._index
+        if not line.startswith(b'OK', len(fetch.tag) + 1):
+            self._index = None  # no CONDSTORE in this mailbox after all
+            self.to_server(fetch.command)
+            return True
+        if fetch.uids is not None:
+            index.restrict(fetch.uids)
+            index.complete = True
+        if index.complete and len(index) == self._exists:
+            index.modseq = max(index.modseq or 0, fetch.modseq, self._modseq)
+            self._current = index.version
+            lines = self._index_fetch(
+                fetch.spec, fetch.items, fetch.changedsince)
+            if lines is not None:
+                for data in lines:
+                    self.to_client(data)
+                self.db.add_index_hit(
+                    max(sum(map(len, lines)) - fetch.dropped, 0))
+                return False
+        index.complete = False
+        self.to_server(fetch.command)
+        return True
+
+    def _release(self):
+        line, m1, header = self._held
+        self._held = None
+        self.to_client(line + b''.join(header))
+
+    def feed_client(self, data):
+        self._feed_client(data)
+
+    def _feed_client(self, data):
+        db = self.db
+        if self._flags:
+            self._waiting.append(bytes(data))
+            return
+        for kind, token, size in self._ctokens.feed(data):
+            if self._flags:
+                # sent once the flags fetch is synced, see _flags_done()
+                self._waiting.append(bytes(token))
+                continue
+            if kind == LINE:
+                if size:
+                    self._literals[CLIENT] = max(self._literals[CLIENT], size)
+                m = None if self._cliteral else self.command_name.match(token)
+                if m and m[2].upper() == b'IDLE':
+                    self._ask_quota()
+                elif m:
+                    self._commands[m[1]] = (
+                        m[2].upper().decode(), time.monotonic())
+                if m and self.condstore_cmd.match(token):
+                    self._client_condstore = True
+                    self._hide_modseq = False
+                self._cliteral = size is not None
+                m = self.select_cmd.match(token)
+                if m:
+                    self._select = [m[1], m[2].decode(errors='replace'), None]
+                    self._mailbox = None
+                    self._exists = None
+                    self._sizes = {}
+                    self._fetched = set()
+                    self._drop_ahead()
+                    self._index = self._current = None
+                    self._modseq = self._uidnext = None
+                    if db.get_optimize() and self._can_condstore and \
+                       size is None and not token.endswith(b')\r\n'):
+                        # HIGHESTMODSEQ is needed to use the index
+                        token = token[:-2] + b' (CONDSTORE)\r\n'
+                        self._hide_modseq = not self._client_condstore
+                if db.get_optimize():
+                    token = self._flags_fetch(token)
+                    if token is not None:
+                        token = self._ahead_fetch(token)
+                    if token is None:
+                        continue
+                    token = self._cached_fetch(token)
+                    token = self._binary_fetch(token)
+                    token = self._read_ahead(token)
+                    req = b' (FLAGS BODY.PEEK[])\r\n'
+                    if token.endswith(req) and token.find(b' UID FETCH ') != -1:
+                        token = token[:-len(req)] + db.fetch_sub
+
+                m = self.login_cmd.match(token)
+                if m:
+                    db.set_credentials(m.group(1, 2))
+                    self._account = m[1].decode(errors='replace')
+                    self._login_tag = token.split(b' ', 1)[0] + b' '
+            self.to_server(token)
+        if self._flags:
+            self._waiting.append(self._ctokens.flush())
+            if not data:
+                self._waiting.append(b'')
+            self._ctokens = ImapTokenizer()
+        elif not data:
+            self.to_server(self._ctokens.flush())
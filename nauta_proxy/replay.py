@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""Replay session traces through the proxy, see ``nauta-proxy --replay``."""
+import asyncio
+import os
+import select
+import socket
+import tempfile
+import threading
+import time
+
+from .database import DBManager
+from .proxy import AsyncProxy, ImapHandler, Proxy, SmtpHandler
+from .trace import FROM_CLIENT, TO_CLIENT, TO_SERVER, read_trace
+
+
+HANDLERS = {'IMAP': ImapHandler, 'SMTP': SmtpHandler}
+
+
+class Replay:
+    """Play both the client and the server of a trace against the proxy.
+
+    The server is a loopback stand-in that answers with the recorded
+    chunks. Before sending each chunk, the proxy is given up to ``timeout``
+    seconds to forward as many bytes to each side as it did when the trace
+    was captured, so the handler sees both sides in the same order. With
+    ``realtime`` the chunks are also sent with their original timing.
+    """
+    timeout = 1
+
+    def __init__(self, path, engine='legacy', realtime=False):
+        self.header, self.records = read_trace(path)
+        self.engine = engine
+        self.realtime = realtime
+        self.expected = {TO_CLIENT: 0, TO_SERVER: 0}
+        self.received = {TO_CLIENT: 0, TO_SERVER: 0}
+        self.waited = dict(self.received)
+        self.diverged = 0
+        self.buf = bytearray(1024*64)
+
+    def run(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = DBManager(os.path.join(tmp, 'replay.db'))
+            db.set_optimize(self.header['mode'])
+            db.execute('DELETE FROM header_rules')
+            for rule in self.header['rules']:
+                db.set_header_rule(*rule)
+            with socket.socket() as upstream:
+                upstream.bind(('127.0.0.1', 0))
+                upstream.listen(1)
+                upstream.settimeout(10)
+                handler = HANDLERS[self.header['protocol']]
+                handler = type(handler.__name__, (handler,), {
+                    'real_server': upstream.getsockname()})
+                port, stop = self._start_proxy(db, handler)
+                try:
+                    client = socket.create_connection(('127.0.0.1', port))
+                    server = upstream.accept()[0]
+                    with client, server:
+                        return self._play(client, server)
+                finally:
+                    stop()
+
+    def _start_proxy(self, db, handler):
+        """Return the port of the proxy and a function to stop it."""
+        if self.engine == 'asyncio':
+            loop = asyncio.new_event_loop()
+            proxy = AsyncProxy(0, handler, db)
+            loop.run_until_complete(proxy.start())
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+
+            def stop():
+                loop.call_soon_threadsafe(loop.stop)
+                proxy.server_close()
+            return proxy.sock.getsockname()[1], stop
+        proxy = Proxy(0, handler, db)
+        threading.Thread(target=proxy.serve_forever, daemon=True).start()
+
+        def stop():
+            proxy.shutdown()
+            proxy.server_close()
+        return proxy.server_address[1], stop
+
+    def _play(self, client, server):
+        self.socks = {TO_CLIENT: client, TO_SERVER: server}
+        for sock in (client, server):
+            sock.setblocking(False)
+        start = time.monotonic()
+        for direction, timestamp, data in self.records:
+            if direction in (TO_CLIENT, TO_SERVER):
+                self.expected[direction] += data
+                continue
+            self._wait(start + timestamp if self.realtime else 0)
+            sock = client if direction == FROM_CLIENT else server
+            if data:
+                self._send(sock, data)
+            else:
+                sock.shutdown(socket.SHUT_WR)
+        self._wait(0)
+        return time.monotonic() - start
+
+    def _pending(self):
+        return [side for side, sock in self.socks.items()
+                if sock and self.waited[side] < self.expected[side]]
+
+    def _wait(self, until):
+        """Read from the proxy until it caught up with the trace."""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            now = time.monotonic()
+            pending = self._pending()
+            if not pending and now >= until:
+                return
+            if pending and now >= deadline:
+                # the proxy sent less than the traced session, go on
+                self.diverged += 1
+                for side in pending:
+                    self.waited[side] = self.expected[side]
+                continue
+            self._read((deadline if pending else until) - now)
+
+    def _read(self, timeout, writing=()):
+        socks = [sock for sock in self.socks.values() if sock]
+        readable, writable = select.select(socks, writing, [], timeout)[:2]
+        for side, sock in self.socks.items():
+            if sock in readable:
+                try:
+                    n = sock.recv_into(self.buf)
+                except ConnectionError:
+                    n = 0
+                if not n:
+                    self.socks[side] = None
+                self.received[side] += n
+                self.waited[side] += n
+        return writable
+
+    def _send(self, sock, data):
+        view = memoryview(data)
+        while view:
+            if self._read(self.timeout*10, (sock,)):
+                try:
+                    view = view[sock.send(view):]
+                except BlockingIOError:
+                    pass
+                except OSError:  # closed by the proxy
+                    return
+
+    def report(self, seconds):
+        mode = ('Normal', 'Lite', 'Lite+')[self.header['mode']]
+        lines = ['{} session: {:,} records in {:.3f}s ({} engine, {})'.format(
+            self.header['protocol'], len(self.records), seconds, self.engine,
+            mode)]
+        for side, name in ((TO_CLIENT, 'client'), (TO_SERVER, 'server')):
+            lines.append('To {}: {:,} Bytes (traced: {:,} Bytes)'.format(
+                name, self.received[side], self.expected[side]))
+        if self.diverged:
+            lines.append('The proxy differed from the trace {:,} times'.format(
+                self.diverged))
+        return '\n'.join(lines)
+
+
+def replay(path, engine='legacy', realtime=False):
+    """Replay a trace and return a report of the run."""
+    r = Replay(path, engine, realtime)
+    return r.report(r.run())
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""Store and forward of sent messages, see ``nauta-proxy --spool``.
+
+In spool mode the SMTP handler answers Delta Chat itself and saves every
+message in the spool, a SQLite queue, before confirming it. A background
+sender delivers the queue in order over a single SMTP session.
+"""
+import concurrent.futures
+import smtplib
+import sqlite3
+import threading
+import time
+
+from .metrics import METRICS
+from .proxy import BdatWriter, MimeTranscoder, set_body
+
+
+class SpoolSMTP(smtplib.SMTP):
+    """SMTP client that counts the bytes exchanged with the server."""
+
+    def __init__(self, *args, counter=None, **kwargs):
+        self.counter = counter
+        super().__init__(*args, **kwargs)
+
+    def send(self, s):
+        self.counter(len(s))
+        super().send(s)
+
+    def getreply(self):
+        code, msg = super().getreply()
+        # every line is 'NNN-text\r\n', msg has the texts joined by '\n'
+        self.counter(len(msg) + 5*(msg.count(b'\n') + 1) + 1)
+        return code, msg
+
+
+class DeliveryError(Exception):
+    def __init__(self, code, msg):
+        self.code = code
+        super().__init__('{} {}'.format(code, msg.decode(errors='replace')))
+
+
+class Spool:
+    """Queue of messages waiting to be sent, with its sender thread.
+
+    Messages are kept with the MAIL and RCPT commands of the client and
+    the DATA exactly as it must be sent (dot-stuffed, headers filtered,
+    ending in ``<CRLF>.<CRLF>``). Messages the server rejects are kept with
+    the ``failed`` state, the others are retried with an exponential
+    backoff without changing the order. A message delivered to only some
+    of its recipients is kept as failed for the rejected ones. The envelope is pipelined and the
+    message sent with BDAT when the server supports it, the parts are
+    decoded as in the relayed sessions. Messages are saved and logins
+    checked by worker threads, so sessions don't wait for the disk or the
+    server on their own thread.
+    """
+    max_backoff = 60*5
+    timeout = 60
+    # seconds the SMTP session is kept open after the queue is empty
+    linger = 60
+
+    def __init__(self, path, db):
+        self.db = db
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=FULL')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS queue
+                                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                  created REAL NOT NULL,
+                                  mail BLOB NOT NULL,
+                                  rcpts BLOB NOT NULL,
+                                  data BLOB NOT NULL,
+                                  attempts INTEGER NOT NULL DEFAULT 0,
+                                  failed INTEGER NOT NULL DEFAULT 0,
+                                  error TEXT)''')
+        self.workers = concurrent.futures.ThreadPoolExecutor(2)
+        self.event = threading.Event()
+        self.sender = None
+        self.smtp = None
+        self.failures = 0
+        self.retry_at = 0
+        self._update_metrics()
+
+    def add(self, mail, rcpts, data):
+        """Save a message, return a future of its id, done once it is on
+        disk."""
+        return self.workers.submit(self._add, mail, rcpts, data)
+
+    def _add(self, mail, rcpts, data):
+        with self.lock, self.conn:
+            cur = self.conn.execute(
+                'INSERT INTO queue (created, mail, rcpts, data) '
+                'VALUES (?,?,?,?)',
+                (time.time(), mail, b'\n'.join(rcpts), data))
+        self._update_metrics()
+        self.event.set()
+        return cur.lastrowid
+
+    def login(self, server, credentials):
+        """Log in to ``server`` with ``(user, password)`` and save them for
+        the sender if they work.
+
+        Returns a future of the ``(code, text)`` reply for the client.
+        """
+        return self.workers.submit(self._login, server, credentials)
+
+    def _login(self, server, credentials):
+        try:
+            user, password = (c.decode() for c in credentials)
+        except UnicodeDecodeError:
+            return 535, b'5.7.8 Error: authentication failed'
+        try:
+            smtp = SpoolSMTP(*server, timeout=self.timeout,
+                             counter=self.db.add_smtp)
+            try:
+                smtp.ehlo()
+                if smtp.has_extn('auth'):
+                    smtp.login(user, password)
+            finally:
+                try:
+                    smtp.quit()
+                except (smtplib.SMTPException, OSError):
+                    smtp.close()
+        except smtplib.SMTPAuthenticationError as ex:
+            return ex.smtp_code, b' '.join(ex.smtp_error.split(b'\n'))
+        except (smtplib.SMTPException, OSError):
+            return 454, b'4.7.0 Temporary authentication failure'
+        self.db.set_credentials(credentials)
+        return 235, b'2.7.0 Authentication successful'
+
+    def stats(self):
+        """Return ``(queued, failed, creation time of the oldest queued)``.
+        """
+        with self.lock:
+            queued, oldest = self.conn.execute(
+                'SELECT COUNT(*), MIN(created) FROM queue WHERE failed=0'
+            ).fetchone()
+            failed = self.conn.execute(
+                'SELECT COUNT(*) FROM queue WHERE failed=1').fetchone()[0]
+        return queued, failed, oldest
+
+    def _update_metrics(self):
+        METRICS.spool(*self.stats())
+
+    def start(self, server):
+        """Start delivering the queue to ``server`` if it isn't already."""
+        with self.lock:
+            if self.sender:
+                return
+            self.sender = threading.Thread(
+                target=self._run, args=(server,), daemon=True)
+        self.sender.start()
+
+    def _next(self):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT id, mail, rcpts, data FROM queue WHERE failed=0 '
+                'ORDER BY id LIMIT 1').fetchone()
+
+    def _run(self, server):
+        while True:
+            msg = self._next()
+            if msg is None:
+                self.event.clear()
+                if not self.event.wait(self.linger if self.smtp else None):
+                    self._close()
+                continue
+            wait = self.retry_at - time.monotonic()
+            if wait > 0:
+                self.event.wait(wait)
+                continue
+            try:
+                rejected = self._deliver(self._connect(server), *msg[1:])
+            except DeliveryError as ex:
+                self._finish(msg[0], str(ex), failed=ex.code >= 500)
+                try:
+                    self.smtp.rset()
+                except (smtplib.SMTPException, OSError):
+                    self._close()
+                if ex.code < 500:
+                    self._backoff()
+            except (smtplib.SMTPException, OSError) as ex:
+                self._close()
+                self._finish(msg[0], str(ex))
+                self._backoff()
+            else:
+                self.failures = 0
+                if rejected:
+                    # the client was told they were all accepted
+                    self._finish(msg[0], '; '.join(
+                        '{}: {} {}'.format(rcpt.decode(errors='replace'),
+                                           code, m.decode(errors='replace'))
+                        for rcpt, code, m in rejected), failed=True,
+                        rcpts=b'\n'.join(rcpt for rcpt, _, _ in rejected))
+                else:
+                    self._finish(msg[0])
+
+    def _backoff(self):
+        self.failures += 1
+        self.retry_at = time.monotonic() + min(
+            2**self.failures, self.max_backoff)
+
+    def _connect(self, server):
+        if self.smtp is None:
+            smtp = SpoolSMTP(*server, timeout=self.timeout,
+                             counter=self.db.add_smtp)
+            smtp.ehlo()
+            credentials = self.db.get_credentials()
+            if credentials and smtp.has_extn('auth'):
+                smtp.login(*credentials)
+            self.smtp = smtp
+        return self.smtp
+
+    def _close(self):
+        smtp, self.smtp = self.smtp, None
+        if smtp:
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp.close()
+
+    def _deliver(self, smtp, mail, rcpts, data):
+        body = transcoder = None
+        if self.db.get_optimize():
+            if smtp.has_extn('binarymime') and smtp.has_extn('chunking'):
+                body = b'BINARYMIME'
+            elif smtp.has_extn('8bitmime'):
+                body = b'8BITMIME'
+        if body:
+            mail = set_body(mail, body)
+            transcoder = MimeTranscoder(body == b'BINARYMIME')
+            data = b''.join(transcoder.feed(data) + transcoder.end())
+        lines = [mail] + rcpts.split(b'\n')
+        if smtp.has_extn('pipelining'):
+            # all the replies are read before checking them, so the session
+            # stays in sync when one fails
+            smtp.send(b''.join(line + b'\r\n' for line in lines))
+            replies = [smtp.getreply() for line in lines]
+        else:
+            replies = []
+            for line in lines:
+                smtp.send(line + b'\r\n')
+                replies.append(smtp.getreply())
+        code, msg = replies[0]
+        if code != 250:
+            raise DeliveryError(code, msg)
+        accepted = 0
+        rejected = []
+        for line, (code, msg) in zip(lines[1:], replies[1:]):
+            if code in (250, 251):
+                accepted += 1
+            elif code < 500:
+                raise DeliveryError(code, msg)
+            else:
+                rejected.append((line, code, msg))
+        if not accepted:
+            raise DeliveryError(554, b'5.5.1 no valid recipients')
+        if smtp.has_extn('chunking'):
+            smtp.send(BdatWriter().end(data))
+        else:
+            self._command(smtp, b'DATA', 354)
+            smtp.send(data)
+        code, msg = smtp.getreply()
+        if code != 250:
+            raise DeliveryError(code, msg)
+        if transcoder and transcoder.saved:
+            self.db.add_smtp_saved(transcoder.saved)
+        self.db.add_smtp_msgs()
+        METRICS.message('SMTP')
+        return rejected
+
+    def _command(self, smtp, line, *ok):
+        smtp.send(line + b'\r\n')
+        code, msg = smtp.getreply()
+        if code not in ok:
+            raise DeliveryError(code, msg)
+
+    def _finish(self, id, error=None, failed=False, rcpts=None):
+        """Delete a delivered message or record the error, ``rcpts`` keeps
+        only the given recipients."""
+        with self.lock, self.conn:
+            if error is None:
+                self.conn.execute('DELETE FROM queue WHERE id=?', (id,))
+            else:
+                self.conn.execute(
+                    'UPDATE queue SET attempts=attempts+1, failed=?, error=?, '
+                    'rcpts=COALESCE(?, rcpts) WHERE id=?',
+                    (int(failed), error, rcpts, id))
+        self._update_metrics()
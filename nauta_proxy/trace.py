@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""Binary traces of proxied sessions, see ``nauta-proxy --capture``.
+
+A trace starts with a JSON header line and then has one record per chunk
+fed to the handler (with its bytes) or queued by it (only its length)::
+
+    direction (1 byte) | seconds since start (double) | length (uint32)
+
+Credentials are replaced with asterisks of the same length, so the chunk
+boundaries of the session are kept.
+"""
+import json
+import os
+import struct
+import time
+
+
+MAGIC = b'NPTRACE1\n'
+FROM_CLIENT, FROM_SERVER, TO_CLIENT, TO_SERVER = range(4)
+RECORD = struct.Struct('!BdI')
+
+
+def traces_dir():
+    return os.path.join(os.path.expanduser('~'), 'nauta_proxy_traces')
+
+
+class TraceWriter:
+    """Write the trace of a session.
+
+    Records are held in memory while the client is in the middle of a
+    line (up to ``max_held`` bytes), so that credentials split between two
+    reads can be redacted before they reach the disk.
+    """
+    max_held = 1024*64
+
+    def __init__(self, path, header, redact):
+        self.fd = open(path, 'wb')
+        self.fd.write(MAGIC + json.dumps(header).encode() + b'\n')
+        self.redact = redact
+        self.start = time.monotonic()
+        self.held = []
+        self.held_size = 0
+
+    def write(self, direction, data=None, size=None):
+        record = [direction, time.monotonic() - self.start, data]
+        if data is None:
+            record[2] = size
+        elif direction == FROM_CLIENT:
+            record[2] = bytearray(data)
+            self.held_size += len(data)
+        else:
+            record[2] = bytes(data)
+        self.held.append(record)
+        if direction == FROM_CLIENT and (
+                not data or data[-1:] == b'\n' or
+                self.held_size > self.max_held):
+            self.flush()
+        elif not self.held_size:
+            self.flush()
+
+    def flush(self):
+        chunks = [r[2] for r in self.held if r[0] == FROM_CLIENT]
+        if chunks:
+            data = self.redact(b''.join(chunks))
+            i = 0
+            for chunk in chunks:
+                chunk[:] = data[i:i+len(chunk)]
+                i += len(chunk)
+        for direction, timestamp, data in self.held:
+            if isinstance(data, int):
+                self.fd.write(RECORD.pack(direction, timestamp, data))
+            else:
+                self.fd.write(RECORD.pack(direction, timestamp, len(data)))
+                self.fd.write(data)
+        self.held.clear()
+        self.held_size = 0
+
+    def close(self):
+        if self.fd.closed:
+            return
+        self.flush()
+        self.fd.close()
+
+
+def read_trace(path):
+    """Return ``(header, records)`` of a trace.
+
+    Records are ``(direction, timestamp, data)`` tuples, where ``data`` is
+    the length of the chunk for the TO_CLIENT and TO_SERVER directions.
+    """
+    with open(path, 'rb') as fd:
+        if fd.readline() != MAGIC:
+            raise ValueError('not a nauta-proxy trace: {}'.format(path))
+        header = json.loads(fd.readline().decode())
+        records = []
+        while True:
+            data = fd.read(RECORD.size)
+            if len(data) < RECORD.size:
+                break
+            direction, timestamp, size = RECORD.unpack(data)
+            if direction in (FROM_CLIENT, FROM_SERVER):
+                data = fd.read(size)
+            else:
+                data = size
+            records.append((direction, timestamp, data))
+    return header, records
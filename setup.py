@@ -54,7 +54,7 @@ setup(
     author=author,
     author_email='adbenitez@nauta.cu',
     url='https://github.com/adbenitez/nauta_proxy',
-    packages=['nauta_proxy'],
+    packages=['nauta_proxy', 'nauta_proxy.bench'],
     classifiers=['Development Status :: 3 - Alpha',
                  'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
                  'Topic :: Utilities',